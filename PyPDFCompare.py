@@ -1,77 +1,31 @@
-import fitz
+from __future__ import annotations
+
+import re
 import sys
-from os import path
-from tempfile import TemporaryDirectory
-from time import sleep
-from numpy import array, where, all, unique
-from PIL import Image, ImageChops, ImageDraw, ImageOps
-from cv2 import findContours, threshold, contourArea, boundingRect, THRESH_BINARY, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE
-from sklearn.cluster import DBSCAN
-from PySide6.QtCore import QThread, Signal
-from PySide6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QProgressBar, QTextBrowser, QApplication
-from PySide6.QtCore import Slot
-
-class ProgressWindow(QMainWindow):
-    def __init__(self):
-        super().__init__()
-        self.setWindowTitle("PyPDFCompare")
-        self.resize(600, 500)
-        
-        self.centralWidget = QWidget()
-        self.setCentralWidget(self.centralWidget)
-        self.layout = QVBoxLayout()
-        
-        self.progressBar = QProgressBar()
-        self.progressBar.setFixedHeight(32)
-        self.progressBar.setTextVisible(True)
-        self.progressBar.setMaximum(100)
-        self.progressBar.setMinimum(0)
-        self.progressBar.setValue(0)
-        self.logArea = QTextBrowser()
-        self.logArea.setReadOnly(True)
-        
-        self.layout.addWidget(self.progressBar)
-        self.layout.addWidget(self.logArea)
-        
-        self.centralWidget.setLayout(self.layout)
-        
-        self.setStyleSheet("""
-            QProgressBar {
-                border: 1px solid #004a88;
-                border-radius: 5px;
-                text-align: center;
-                color: #c8c8c8;
-                background-color: #202020;
-            }
-            QProgressBar::chunk {
-                background-color: #0075d5;
-                width: 1px;
-                border: 1px solid transparent;
-                border-radius: 5px;
-            }
-        """)
-        
-    @Slot(int)
-    def update_progress(self, progress):
-        self.progressBar.setValue(progress)
-        
-    @Slot(str)
-    def update_log(self, message):
-        self.logArea.append(message)
-    
-    @Slot(int)
-    def operation_complete(self, time):
-        sleep(time)
-        self.close()
+from contextlib import contextmanager, nullcontext
+from hashlib import sha256
+from importlib.abc import MetaPathFinder
+from io import BytesIO
+from multiprocessing import current_process, get_context
+from os import getpid, makedirs, path, remove, replace, stat, utime, walk
+from threading import get_native_id
+from time import perf_counter
+from typing import TYPE_CHECKING
 
-class CompareThread(QThread):
-    progressUpdated = Signal(int)
-    compareComplete = Signal(int)
-    logMessage = Signal(str)
-    
-    def __init__(self, files: list[str], progress_window: ProgressWindow, options: list[str] = None, parent=None):
-        super(CompareThread, self).__init__(parent)
+# fitz, numpy, PIL and cv2 are imported by the stage that first needs them
+if TYPE_CHECKING:
+    import fitz
+    from PIL import Image
+
+class ComparisonCancelled(Exception):
+    """
+    Raised by Comparer.compare when the comparison was cancelled with Comparer.cancel.
+    """
+
+class Comparer:
+    def __init__(self, options: list[str] = None, log=None, progress=None, pages=None, pool=None):
         compare_settings = load_settings(options)
+        self.compare_settings = compare_settings
         self.DPI_LEVEL = compare_settings.get("DPI_LEVEL")
         self.PAGE_SIZE = tuple(compare_settings.get("PAGE_SIZES").get(compare_settings.get("PAGE_SIZE")))
         self.INCLUDE_IMAGES = compare_settings.get("INCLUDE_IMAGES")
@@ -84,277 +38,2367 @@ class CompareThread(QThread):
         self.OUTPUT_BW = compare_settings.get("OUTPUT_BW")
         self.OUTPUT_GS = compare_settings.get("OUTPUT_GS")
         self.REDUCE_FILESIZE = compare_settings.get("REDUCE_FILESIZE")
-        self.files = files
-        self.progress_window = progress_window
+        self.WORKERS = compare_settings.get("WORKERS")
+        self.SKIP_IDENTICAL = compare_settings.get("SKIP_IDENTICAL")
+        self.TILE_SIZE = compare_settings.get("TILE_SIZE")
+        self.RENDER_GRAY = compare_settings.get("RENDER_GRAY")
+        self.RESAMPLE = compare_settings.get("RESAMPLE")
+        self.CHECKPOINT_INTERVAL = compare_settings.get("CHECKPOINT_INTERVAL")
+        self.CACHE_PATH = compare_settings.get("CACHE_PATH")
+        self.CACHE_SIZE = compare_settings.get("CACHE_SIZE")
+        self.PREVIEW_DPI = compare_settings.get("PREVIEW_DPI")
+        self.PREVIEW_MARGIN = compare_settings.get("PREVIEW_MARGIN")
+        self.COMPARE_MODE = compare_settings.get("COMPARE_MODE")
+        self.VECTOR_TOLERANCE = compare_settings.get("VECTOR_TOLERANCE")
+        self.REGION_METHOD = compare_settings.get("REGION_METHOD")
+        self.CLOSE_GAP = compare_settings.get("CLOSE_GAP")
+        self.ALIGN = compare_settings.get("ALIGN")
+        self.MATCH_PAGES = compare_settings.get("MATCH_PAGES")
+        self.MAX_MEMORY = compare_settings.get("MAX_MEMORY")
+        self.PROFILE = compare_settings.get("PROFILE")
+        # Pixels the difference kernel works on at a time, the size of the buffers it reuses, see plan_memory
+        self.STRIP_PIXELS = DIFFERENCE_STRIP_PIXELS
+        # Estimated peak megabytes of the plan plan_memory picked
+        self.memory_estimate = None
+        self.render_cache = RenderCache(self.CACHE_PATH, self.CACHE_SIZE * 1024 * 1024) if self.CACHE_PATH else None
+        self.options = options
+        # Callbacks receive log messages (str), overall progress (int, 0-100) and pages written (done, total)
+        self.log = log if log is not None else lambda message: None
+        self.progress = progress if progress is not None else lambda value: None
+        self.pages = pages if pages is not None else lambda done, total: None
+        # A worker pool kept by the caller between comparisons, pages are compared on it instead of on a pool started
+        # per comparison. WORKERS should be its number of processes
+        self.pool = pool
+        self.cancelled = False
+        # Page being compared, profile spans are tagged with it
+        self.current_page = None
+        self.statistics = {}
+        self.reset_statistics()
+
+    def reset_statistics(self):
         self.statistics = {
             "NUM_PAGES": 0,
             "MAIN_PAGE": None,
             "TOTAL_DIFFERENCES": 0,
-            "PAGES_WITH_DIFFERENCES": []
+            "PAGES_WITH_DIFFERENCES": [],
+            "IDENTICAL_PAGES": [],
+            "CACHE_HITS": 0,
+            "CACHE_MISSES": 0,
+            "VECTOR_CHANGES": [],
+            "TEXT_CHANGES": [],
+            "ALIGNMENTS": [],
+            "INSERTED_PAGES": [],
+            "REMOVED_PAGES": [],
+            # Chrome trace events of the stages, see span
+            "PROFILE": []
             }
-        
-        self.progressUpdated.connect(self.progress_window.update_progress)
-        self.logMessage.connect(self.progress_window.update_log)
-        self.compareComplete.connect(self.progress_window.operation_complete)
-    
-    def run(self):
+        # (main page, secondary page) numbers compared as each output page, None where a document has no page there.
+        # None pairs pages by number, see page_numbers
+        self.page_pairs = None
+        self.identical_pages = set()
+        self.text_changes = {}
+        # (scale, x, y in points) the secondary page of the page being compared is rendered with, see render_secondary
+        self.alignment = (1.0, 0, 0)
+
+    def cancel(self):
+        # Stops the running comparison before its next page, compare raises ComparisonCancelled. Safe from any thread
+        self.cancelled = True
+
+    def span(self, name: str, page_num: int | None = None):
+        # Times the stage it wraps into the PROFILE statistics when profiling. Like every other statistic, spans
+        # recorded in a worker come back with its page results
+        if self.PROFILE is not True:
+            return nullcontext()
+        return profile_span(self.statistics["PROFILE"], name, self.current_page if page_num is None else page_num)
+
+    def import_modules(self):
+        # Heavy modules are otherwise imported by the first stage that needs them and counted in its time, when
+        # profiling they are imported up front in a span of their own
+        if self.PROFILE is True and any(module not in sys.modules for module in PROFILE_IMPORTS):
+            from importlib import import_module
+            with self.span("Import modules"):
+                for module in PROFILE_IMPORTS:
+                    import_module(module)
+
+    def run(self, files: list[str]) -> str | None:
+        import fitz
         try:
-            self.handle_files(self.files)
+            return self.compare(files)
         except fitz.FileDataError as e:
-            self.logMessage.emit(f"Error opening file: {e}")
-            self.compareComplete.emit(5)
-
-    def cluster_contours(self, contours, eps=50, min_samples=1):
-        if not contours:
-            return []
-        
-        # Calculate the centroid of each contour's bounding box
-        centroids = []
-        for contour in contours:
-            x, y, w, h = boundingRect(contour)
-            centroids.append([x + w / 2, y + h / 2])
-        
-        # Use DBSCAN clustering on the centroids
-        db = DBSCAN(eps=eps, min_samples=min_samples).fit(centroids)
-        labels = db.labels_
-        
-        # Group contours by cluster label
-        clustered_contours = []
-        for label in unique(labels):
-            if label != -1:
-                clustered_contours.append([contours[i] for i in range(len(contours)) if labels[i] == label])
-        
-        return clustered_contours
+            self.log(f"Error opening file: {e}")
+            return None
+
+    def layer_channels(self) -> tuple:
+        # Grayscale renders only get colour layers when the output keeps colour
+        if self.RENDER_GRAY is True and (self.OUTPUT_GS is True or self.OUTPUT_BW is True):
+            return ()
+        return (3,)
+
+    def change_regions(self, mask, origin: tuple[int, int] = (0, 0)) -> tuple:
+        # Boxes (x, y, w, h) and areas of every change region of mask as (N, 4) and (N,) arrays, offset by origin
+        from numpy import float64, int64
+        from cv2 import getStructuringElement, morphologyEx, MORPH_CLOSE, MORPH_RECT
+        with self.span("Find regions"):
+            if self.CLOSE_GAP:
+                mask = morphologyEx(mask, MORPH_CLOSE, getStructuringElement(MORPH_RECT, (self.CLOSE_GAP + 1, self.CLOSE_GAP + 1)))
+            if self.REGION_METHOD == "COMPONENTS":
+                from cv2 import connectedComponentsWithStats, CC_STAT_AREA
+                _, _, stats, _ = connectedComponentsWithStats(mask, connectivity=8)
+                boxes = stats[1:, :CC_STAT_AREA].astype(int64)
+                areas = stats[1:, CC_STAT_AREA].astype(float64)
+            else:
+                from cv2 import findContours, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE
+                contours, _ = findContours(mask, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
+                boxes, areas = contour_boxes(contours), contour_areas(contours)
+        if len(boxes) and origin != (0, 0):
+            boxes[:, :2] += origin
+        return boxes, areas
+
+    def difference_boxes(self, boxes, areas=None, eps: float = 50):
+        # Clusters the region boxes whose centres are within eps of each other, directly or through other boxes,
+        # and returns the (N, 4) union box of every cluster large enough to mark. Without areas every cluster is kept.
+        from numpy import bincount, flatnonzero, full, int64, maximum, minimum, stack
+        if not len(boxes):
+            return boxes
+        with self.span("Cluster boxes"):
+            labels = grid_labels(boxes[:, :2] + boxes[:, 2:] / 2, eps)
+            count = int(labels.max()) + 1
+            low = full((count, 2), boxes[:, :2].max(), dtype=int64)
+            high = full((count, 2), 0, dtype=int64)
+            minimum.at(low, labels, boxes[:, :2])
+            maximum.at(high, labels, boxes[:, :2] + boxes[:, 2:])
+            clusters = stack([low[:, 0], low[:, 1], high[:, 0] - low[:, 0], high[:, 1] - low[:, 1]], axis=1)
+        if areas is None:
+            return clusters
+        # Filter out small clusters that are likely to be minor differences
+        return clusters[flatnonzero(bincount(labels, weights=areas, minlength=count) >= self.MIN_AREA * 10)]
+
+    def draw_difference_boxes(self, image: Image.Image, boxes: list, origin: tuple[int, int] = (0, 0), mode: str | None = None) -> Image.Image:
+        # Draws the (x, y, w, h) page boxes over a single copy of image converted to mode, whose top left corner sits at
+        # origin on the page. Each box blends its fill in through one masked colour paste and its outline is pasted
+        # opaque as four strips, the same pixels pasting a box image per box gave. An RGBA copy keeps the alpha those
+        # pasted boxes left.
+        from PIL import Image
+        marked_image = image.convert(mode) if mode is not None else image.copy()
+        width, height = image.size
+        # Determine outline thickness based on DPI and page size
+        thickness = max(1, int(self.DPI_LEVEL / 100))
+
+        # Fill with a quarter opaque green and outline in red, grayscale images get the luminance of green and red
+        if marked_image.mode == "L":
+            fill, edge = 150, 76
+        else:
+            fill, edge = (0, 255, 0, 64), (255, 0, 0, 255)
+        for x, y, w, h in boxes:
+            x, y = x - origin[0], y - origin[1]
+            box_left, box_top, box_right, box_bottom = max(0, x), max(0, y), min(x + w, width), min(y + h, height)
+            if box_right <= box_left or box_bottom <= box_top:
+                continue
+            inner_left, inner_top = max(box_left, x + thickness), max(box_top, y + thickness)
+            inner_right, inner_bottom = min(box_right, x + w - thickness), min(box_bottom, y + h - thickness)
+            if inner_right <= inner_left or inner_bottom <= inner_top:
+                strips = [(box_left, box_top, box_right, box_bottom)]
+            else:
+                marked_image.paste(fill, (inner_left, inner_top, inner_right, inner_bottom),
+                                   Image.new("L", (inner_right - inner_left, inner_bottom - inner_top), 64))
+                strips = [(box_left, box_top, box_right, inner_top), (box_left, inner_bottom, box_right, box_bottom),
+                          (box_left, inner_top, inner_left, inner_bottom), (inner_right, inner_top, box_right, inner_bottom)]
+            for strip in strips:
+                if strip[0] < strip[2] and strip[1] < strip[3]:
+                    marked_image.paste(edge, strip)
+        return marked_image
 
     def mark_differences(self, page_num: int, image1: Image.Image, image2: Image.Image) -> list[Image.Image]:
+        from numpy import asarray, empty, uint8
+        from PIL import Image
+        if image1.size != image2.size:
+            image2 = image2.resize(image1.size, self.resample_filter())
+            self.log("Page sizes don't match and the 'Scale Pages' setting is off, attempting to match page sizes... results may be inaccurate.")
+
+        # Overlay, difference and change mask layers all come out of a single pass over both pages
+        width, height = image1.size
+        channels = self.layer_channels()
+        overlay = empty((height, width) + channels, dtype=uint8) if self.INCLUDE_IMAGES["Overlay"] is True else None
+        diff = empty((height, width) + channels, dtype=uint8) if self.INCLUDE_IMAGES["Markup"] is True or self.INCLUDE_IMAGES["Difference"] is True else None
+        mask = empty((height, width), dtype=uint8) if self.INCLUDE_IMAGES["Markup"] is True else None
+        with self.span("Difference kernel"):
+            difference_kernel(asarray(image1), asarray(image2), self.THRESHOLD, diff=diff, overlay=overlay, mask=mask, strip_pixels=self.STRIP_PIXELS)
+
         # Overlay Image
-        if self.INCLUDE_IMAGES["Overlay"] is True:
-            if not self.SCALE_OUTPUT and image1.size != image2.size:
-                image2 = image2.resize(image1.size)
-                self.logMessage.emit("Page sizes don't match and the 'Scale Pages' setting is off, attempting to match page sizes... results may be inaccurate.")
-            image1array = array(image1)
-            image2array = array(image2)
-            image2array[~all(image2array == [255, 255, 255], axis=-1)] = [255, 0, 0] # Convert non-white pixels in image2array to red for overlay.
-            overlay_image = Image.fromarray(where(all(image1array == [255, 255, 255], axis=-1, keepdims=True), image2array, image1array))
-            del image1array, image2array
+        if overlay is not None:
+            overlay_image = Image.fromarray(overlay)
+            del overlay
 
         # Markup Image / Differences Image
-        if self.INCLUDE_IMAGES["Markup"] is True or self.INCLUDE_IMAGES["Difference"] is True:
-            # Increase the threshold for difference detection to ignore minor changes
-            diff_image = Image.fromarray(where(all(array(ImageOps.colorize(ImageOps.invert(ImageChops.subtract(image2, image1).convert("L")), black="blue", white="white").convert("RGB")) == [255, 255, 255], axis=-1)[:,:,None], array(ImageOps.colorize(ImageOps.invert(ImageChops.subtract(image1, image2).convert("L")), black="red", white="white").convert("RGB")), array(ImageOps.colorize(ImageOps.invert(ImageChops.subtract(image2, image1).convert("L")), black="blue", white="white").convert("RGB"))))
+        if diff is not None:
+            diff_image = Image.fromarray(diff)
+            del diff
 
             if self.INCLUDE_IMAGES["Markup"] is True:
-                # Increase the threshold to reduce minor differences
-                contours, _ = findContours(threshold(array(ImageChops.difference(image2, image1).convert("L")), self.THRESHOLD, 255, THRESH_BINARY)[1], RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
-                del _
+                boxes = self.difference_boxes(*self.change_regions(mask))
+                del mask
 
-                # Cluster the contours
-                clustered_contours = self.cluster_contours(contours)
+                marked_image = self.markup_image(page_num, image1, boxes)
 
-                marked_image = Image.new("RGBA", image1.size, (255, 0, 0, 255))
-                marked_image.paste(image1, (0, 0))
-                marked_image_draw = ImageDraw.Draw(marked_image)
+        return self.output_layers(image1, image2, marked_image if self.INCLUDE_IMAGES["Markup"] else None,
+                                  diff_image if self.INCLUDE_IMAGES["Difference"] else None,
+                                  overlay_image if self.INCLUDE_IMAGES["Overlay"] else None)
 
-                previous_differences = self.statistics["TOTAL_DIFFERENCES"]
+    def markup_image(self, page_num: int, image: Image.Image, boxes) -> Image.Image:
+        # Draws the (x, y, w, h) difference boxes over a copy of the main page. Pillow resizes RGBA with premultiplied
+        # alpha, so the markup keeps the alpha of the boxes when it still gets resized to the output page size.
+        mode = None
+        if self.layer_channels():
+            mode = "RGBA" if self.SCALE_OUTPUT is not True and image.size != self.target_size() else "RGB"
+        with self.span("Draw markup"):
+            marked_image = self.draw_difference_boxes(image, boxes.tolist(), mode=mode)
 
-                # Determine outline thickness based on DPI and page size
-                outline_thickness = max(1, int(self.DPI_LEVEL / 100))  # Adjust this value as needed for visibility
+        self.statistics["TOTAL_DIFFERENCES"] += len(boxes)
+        self.statistics["PAGES_WITH_DIFFERENCES"].append((page_num, len(boxes)))
+        return marked_image
 
-                for cluster in clustered_contours:
-                    # Filter out small contours that are likely to be minor differences
-                    cluster_area = sum([contourArea(contour) for contour in cluster])
-                    if cluster_area < self.MIN_AREA * 10:  # Increase MIN_AREA threshold to ignore smaller changes
-                        continue
+    def candidate_regions(self, list1: fitz.DisplayList | None, list2: fitz.DisplayList | None, size: tuple[int, int]) -> list[tuple[int, int, int, int]]:
+        # Diffs both pages at PREVIEW_DPI and returns the page regions (x0, y0, x1, y1) that changed, padded by PREVIEW_MARGIN pixels
+        from math import ceil, floor
+        from numpy import asarray, uint8
+        from cv2 import connectedComponentsWithStats
+        preview_size = (max(1, round(size[0] * self.PREVIEW_DPI / self.DPI_LEVEL)), max(1, round(size[1] * self.PREVIEW_DPI / self.DPI_LEVEL)))
+        preview1 = asarray(self.render_tile(list1, (0, 0) + preview_size, preview_size))
+        preview2 = asarray(self.render_secondary(list2, (0, 0) + preview_size, preview_size))
+        changed = preview1 != preview2
+        if changed.ndim == 3:
+            changed = changed.any(axis=-1)
+        del preview1, preview2
+        count, _, stats, _ = connectedComponentsWithStats(changed.astype(uint8), connectivity=8)
+
+        scale_x, scale_y = size[0] / preview_size[0], size[1] / preview_size[1]
+        return self.merge_regions([(floor(x * scale_x), floor(y * scale_y), ceil((x + w) * scale_x), ceil((y + h) * scale_y))
+                                   for x, y, w, h, _ in stats[1:count].tolist()], size)
+
+    def merge_regions(self, regions: list[tuple[int, int, int, int]], size: tuple[int, int]) -> list[tuple[int, int, int, int]]:
+        # Pads every region by PREVIEW_MARGIN and merges the ones that overlap, so a change never straddles two regions
+        margin = self.PREVIEW_MARGIN
+        regions = [(max(0, x0 - margin), max(0, y0 - margin), min(size[0], x1 + margin), min(size[1], y1 + margin)) for x0, y0, x1, y1 in regions]
+        merging = True
+        while merging:
+            merging = False
+            merged = []
+            for region in regions:
+                for index, other in enumerate(merged):
+                    if region[0] < other[2] and other[0] < region[2] and region[1] < other[3] and other[1] < region[3]:
+                        merged[index] = (min(region[0], other[0]), min(region[1], other[1]), max(region[2], other[2]), max(region[3], other[3]))
+                        merging = True
+                        break
+                else:
+                    merged.append(region)
+            regions = merged
+        return regions
+
+    def page_pixel_size(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> tuple[int, int]:
+        # Size pdf_to_image renders the main page at, or the secondary page where the main document has no page
+        import fitz
+        if self.SCALE_OUTPUT is True:
+            return self.target_size()
+        page1, page2 = self.load_pages(page_num, doc1, doc2)
+        page_rect = (page1 or page2).rect * fitz.Matrix(self.DPI_LEVEL / 72, self.DPI_LEVEL / 72)
+        return page_rect.irect.width, page_rect.irect.height
+
+    def page_numbers(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> tuple[int | None, int | None]:
+        # Numbers of the main and secondary pages compared as output page page_num, None where a document has no page
+        if self.page_pairs is not None:
+            return self.page_pairs[page_num]
+        return page_num if page_num < doc1.page_count else None, page_num if page_num < doc2.page_count else None
+
+    def load_pages(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> tuple[fitz.Page | None, fitz.Page | None]:
+        number1, number2 = self.page_numbers(page_num, doc1, doc2)
+        return doc1.load_page(number1) if number1 is not None else None, doc2.load_page(number2) if number2 is not None else None
+
+    def match_pages(self, doc1: fitz.Document, doc2: fitz.Document) -> list[tuple[int | None, int | None]]:
+        # Pairs pages that look alike from perceptual hashes of thumbnails, so an inserted or removed page doesn't shift
+        # every later page onto the wrong partner
+        from numpy import array, float32
+        hashes1 = array([perceptual_hash(page) for page in doc1], dtype=float32).reshape(-1, PAGE_HASH_SIZE ** 2)
+        hashes2 = array([perceptual_hash(page) for page in doc2], dtype=float32).reshape(-1, PAGE_HASH_SIZE ** 2)
+        # Fraction of bits that differ between every pair of pages
+        distances = (hashes1 @ (1 - hashes2).T + (1 - hashes1) @ hashes2.T) / PAGE_HASH_SIZE ** 2
+        pairs = match_sequences(distances.tolist(), PAGE_MATCH_GAP)
+        main_is_new = "new" in self.MAIN_PAGE.lower()
+        for page_num, (number1, number2) in enumerate(pairs):
+            if number2 is None:
+                self.statistics["INSERTED_PAGES" if main_is_new else "REMOVED_PAGES"].append((page_num, number1))
+            elif number1 is None:
+                self.statistics["REMOVED_PAGES" if main_is_new else "INSERTED_PAGES"].append((page_num, number2))
+        return pairs
+
+    def estimate_alignment(self, list1: fitz.DisplayList, list2: fitz.DisplayList, size: tuple[int, int]) -> tuple[float, float, float]:
+        # Phase correlation of low resolution renders gives the scale (with ALIGN SCALE, from the log-polar magnitude
+        # spectra) and a coarse shift of the secondary page, which are then refined on windows of the page at full
+        # resolution. Returns the scale and the offset in pixels of the secondary page rendered at size / scale, or
+        # (1.0, 0, 0) when the pages don't correlate well enough to align.
+        from math import exp, log
+        from numpy import abs, argmax, asarray, float64, log1p, unravel_index
+        from numpy.fft import fft2, fftshift
+        from cv2 import blur, createHanningWindow, Laplacian, phaseCorrelate, warpPolar, CV_64F, INTER_LINEAR, WARP_POLAR_LOG
+
+        factor = max(1.0, max(size) / ALIGN_PREVIEW_SIZE)
+        low_size = (max(1, round(size[0] / factor)), max(1, round(size[1] / factor)))
+        low1 = 255 - asarray(self.render_tile(list1, (0, 0) + low_size, low_size).convert("L"), dtype=float64)
+        window = createHanningWindow(low_size, CV_64F)
+        scale = 1.0
+        if self.ALIGN == "SCALE":
+            # Scaling the page scales its magnitude spectrum by the inverse, a shift along log radius in polar space
+            low2 = 255 - asarray(self.render_tile(list2, (0, 0) + low_size, low_size).convert("L"), dtype=float64)
+            radius = min(low_size) / 2
+            polar = [warpPolar(log1p(abs(fftshift(fft2(image * window)))), (ALIGN_PREVIEW_SIZE, ALIGN_PREVIEW_SIZE),
+                               (low_size[0] / 2, low_size[1] / 2), radius, WARP_POLAR_LOG | INTER_LINEAR) for image in (low1, low2)]
+            (shift, _), response = phaseCorrelate(polar[0], polar[1])
+            if response >= ALIGN_MIN_RESPONSE and abs(shift * log(radius) / ALIGN_PREVIEW_SIZE) <= ALIGN_MAX_SCALE:
+                scale = exp(-shift * log(radius) / ALIGN_PREVIEW_SIZE)
+
+        low2 = 255 - asarray(self.render_tile(list2, (0, 0) + low_size, (low_size[0] / scale, low_size[1] / scale)).convert("L"), dtype=float64)
+        (x, y), response = phaseCorrelate(low1, low2, window)
+        if response < ALIGN_MIN_RESPONSE:
+            return 1.0, 0, 0
+        offset = (x * factor, y * factor)
+
+        # The window of the page with the most edges (line work and text, which render to the same fraction of a
+        # pixel wherever they are, where images snap to whole pixels) is refined at full resolution. With a scale, so is
+        # the window with the most edges at the other end of the page, and the offsets of both windows give the scale.
+        extent = min(ALIGN_WINDOW, *size)
+        low_extent = max(1, round(extent / factor))
+        edges = blur(abs(Laplacian(low1, CV_64F)), (low_extent, low_extent))
+        long_axis = 1 if size[0] >= size[1] else 0
+        ends = [slice(None)] if scale == 1.0 else [slice(None, edges.shape[long_axis] // 3), slice(-edges.shape[long_axis] // 3, None)]
+        tiles = []
+        for end in ends:
+            part = edges[:, end] if long_axis else edges[end]
+            row, column = unravel_index(argmax(part), part.shape)
+            if end.start is not None:
+                row, column = (row, column + edges.shape[1] + end.start) if long_axis else (row + edges.shape[0] + end.start, column)
+            x0 = min(max(0, round(column * factor) - extent // 2), size[0] - extent)
+            y0 = min(max(0, round(row * factor) - extent // 2), size[1] - extent)
+            tiles.append((x0, y0, x0 + extent, y0 + extent))
+        # A window only refines the offset of the whole page, one that moved further than that is content that changed
+        offsets = [self.fit_offset(list1, list2, tile, size, (scale,) + offset) for tile in tiles]
+        offsets = [fitted if fitted is not None and abs(fitted[0] - offset[0]) <= 2 * factor and abs(fitted[1] - offset[1]) <= 2 * factor else None
+                   for fitted in offsets]
+        alignment = (scale,) + next((fitted for fitted in offsets if fitted is not None), offset)
+        if len(offsets) == 2 and None not in offsets:
+            # Offsets grow across the page by the ratio of the true scale to the estimated one, less one
+            (ax0, ay0, ax1, ay1), (bx0, by0, bx1, by1) = tiles
+            (ax, ay), (bx, by) = offsets
+            dx, dy = (bx0 + bx1 - ax0 - ax1) / 2, (by0 + by1 - ay0 - ay1) / 2
+            ratio = 1 + ((bx - ax) * dx + (by - ay) * dy) / (dx * dx + dy * dy)
+            if abs(log(scale * ratio)) < ALIGN_MIN_SCALE:
+                ratio = 1 / scale
+            if abs(log(scale * ratio)) <= ALIGN_MAX_SCALE:
+                offset = ((ax - (ax0 + ax1) / 2 * (ratio - 1)) / ratio, (ay - (ay0 + ay1) / 2 * (ratio - 1)) / ratio)
+                alignment = (scale * ratio,) + (self.fit_offset(list1, list2, tiles[0], size, (scale * ratio,) + offset) or offset)
+        if abs(log(alignment[0])) < ALIGN_MIN_SCALE:
+            alignment = (1.0,) + alignment[1:]
+        if abs(alignment[0] - 1) < ALIGN_MIN_SCALE and abs(alignment[1]) < ALIGN_MIN_SHIFT and abs(alignment[2]) < ALIGN_MIN_SHIFT:
+            return 1.0, 0, 0
+        # Only an alignment that clearly matches the pages better than leaving them as they are is used
+        if self.window_residual(list1, list2, tiles[0], size, alignment) > ALIGN_MIN_GAIN * self.window_residual(list1, list2, tiles[0], size, (1.0, 0, 0)):
+            return 1.0, 0, 0
+        return alignment
 
-                    # Calculate bounding box for the entire cluster
-                    cluster_points = [point for contour in cluster for point in contour]
-                    cluster_x, cluster_y, cluster_w, cluster_h = boundingRect(array(cluster_points))
-
-                    # Draw the bounding box and fill with green
-                    diff_box = Image.new("RGBA", (cluster_w, cluster_h), (0, 255, 0, 64))
-                    ImageDraw.Draw(diff_box).rectangle([(0, 0), (cluster_w - 1, cluster_h - 1)], outline=(255, 0, 0, 255), width=outline_thickness)
-                    marked_image.paste(diff_box, (cluster_x, cluster_y), mask=diff_box)
-                    del diff_box
-
-                    self.statistics["TOTAL_DIFFERENCES"] += 1
-
-                self.statistics["PAGES_WITH_DIFFERENCES"].append((page_num, self.statistics["TOTAL_DIFFERENCES"] - previous_differences))
-                del contours, marked_image_draw
-
-        # Output
-        output = []
-        if not self.SCALE_OUTPUT:
-            if self.INCLUDE_IMAGES["New Copy"]:
-                output.append(image1.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL))) if "new" in self.MAIN_PAGE.lower() else image2.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL))))
-            if self.INCLUDE_IMAGES["Old Copy"]:
-                output.append(image2.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL))) if "new" in self.MAIN_PAGE.lower() else image1.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL))))
-            if self.INCLUDE_IMAGES["Markup"]:
-                output.append(marked_image.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL))))
-            if self.INCLUDE_IMAGES["Difference"]:
-                output.append(diff_image.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL))))
-            if self.INCLUDE_IMAGES["Overlay"]:
-                output.append(overlay_image.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL))))
+    def window_residual(self, list1: fitz.DisplayList, list2: fitz.DisplayList, tile: tuple[int, int, int, int], size: tuple[int, int],
+                        alignment: tuple[float, float, float]) -> float:
+        # Sum of squared differences between a window of the main page and the secondary page moved by alignment
+        from numpy import asarray, float64, vdot
+        scale, x, y = alignment
+        residual = asarray(self.render_tile(list1, tile, size).convert("L"), dtype=float64)
+        residual -= asarray(self.render_tile(list2, tile, (size[0] / scale, size[1] / scale), (x, y)).convert("L"), dtype=float64)
+        return float(vdot(residual, residual))
+
+    def fit_offset(self, list1: fitz.DisplayList, list2: fitz.DisplayList, tile: tuple[int, int, int, int], size: tuple[int, int],
+                   alignment: tuple[float, float, float]) -> tuple[float, float] | None:
+        # Offset that aligns a window of the secondary page rendered at the alignment scale, starting from the
+        # alignment offset. Phase correlation gets it to within a pixel but its subpixel peak is biased by a few tenths,
+        # so a quadratic is fitted to the squared differences on a grid of offsets around it, finer each time.
+        # Returns None when the window doesn't correlate.
+        from numpy import asarray, array, clip, float64, vdot
+        from numpy.linalg import LinAlgError, lstsq, solve
+        from cv2 import createHanningWindow, phaseCorrelate, CV_64F
+        scale, x, y = alignment
+        secondary_size = (size[0] / scale, size[1] / scale)
+        tile1 = 255 - asarray(self.render_tile(list1, tile, size).convert("L"), dtype=float64)
+        tile2 = 255 - asarray(self.render_tile(list2, tile, secondary_size, (x, y)).convert("L"), dtype=float64)
+        (shift_x, shift_y), response = phaseCorrelate(tile1, tile2, createHanningWindow(tile1.shape[::-1], CV_64F))
+        if response < ALIGN_MIN_RESPONSE:
+            return None
+        x, y = x + shift_x, y + shift_y
+
+        grid = [(i, j) for i in (-1, 0, 1) for j in (-1, 0, 1)]
+        terms = array([(i * i, j * j, i * j, i, j, 1) for i, j in grid], dtype=float64)
+        for step in ALIGN_STEPS:
+            errors = []
+            for i, j in grid:
+                residual = tile1 - (255 - asarray(self.render_tile(list2, tile, secondary_size, (x + i * step, y + j * step)).convert("L"), dtype=float64))
+                errors.append(vdot(residual, residual))
+            xx, yy, xy, gx, gy, _ = lstsq(terms, array(errors), rcond=None)[0]
+            try:
+                vertex = solve([[2 * xx, xy], [xy, 2 * yy]], [-gx, -gy])
+            except LinAlgError:
+                break
+            if xx <= 0 or 4 * xx * yy <= xy * xy:
+                break
+            x, y = x + clip(vertex[0], -1, 1) * step, y + clip(vertex[1], -1, 1) * step
+        return float(x), float(y)
+
+    def render_secondary(self, display_list: fitz.DisplayList | None, tile: tuple[int, int, int, int], size: tuple[int, int]) -> Image.Image:
+        # Renders a tile of the secondary page moved onto the main page: the page is rendered at size / scale and
+        # offset by the alignment shift, so the page is aligned to a fraction of a pixel without resampling
+        scale, x, y = self.alignment
+        if (scale, x, y) == (1.0, 0, 0) or display_list is None:
+            return self.render_tile(display_list, tile, size)
+        size = (size[0] / scale, size[1] / scale)
+        return self.render_tile(display_list, tile, size, (x * size[0] / display_list.rect.width, y * size[1] / display_list.rect.height))
+
+    def align_page(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document, size: tuple[int, int]) -> tuple[fitz.DisplayList, fitz.DisplayList]:
+        # Sets the alignment render_secondary uses for this page and returns the display lists of both pages
+        page1, page2 = self.load_pages(page_num, doc1, doc2)
+        list1, list2 = page1.get_displaylist(), page2.get_displaylist()
+        self.log(f"Aligning pages...")
+        with self.span("Align pages"):
+            scale, x, y = self.estimate_alignment(list1, list2, size)
+        # Kept in points, so the same alignment holds at any size the page is rendered at
+        self.alignment = (scale, x * scale * list2.rect.width / size[0], y * scale * list2.rect.height / size[1])
+        if (scale, x, y) != (1.0, 0, 0):
+            self.log(f"Secondary page is offset by {self.alignment[1]:.2f}, {self.alignment[2]:.2f} points ({x * scale:.1f}, {y * scale:.1f} pixels) "
+                     f"and scaled by {scale:.4f}, aligning it to the main page")
+            self.statistics["ALIGNMENTS"].append((page_num,) + self.alignment[1:] + (scale,))
         else:
-            if self.INCLUDE_IMAGES["New Copy"]:
-                output.append(image1 if "new" in self.MAIN_PAGE.lower() else image2)
-            if self.INCLUDE_IMAGES["Old Copy"]:
-                output.append(image2 if "new" in self.MAIN_PAGE.lower() else image1)
-            if self.INCLUDE_IMAGES["Markup"]:
-                output.append(marked_image)
-            if self.INCLUDE_IMAGES["Difference"]:
-                output.append(diff_image)
-            if self.INCLUDE_IMAGES["Overlay"]:
-                output.append(overlay_image)
-        return output
-
-    def pdf_to_image(self, page_number: int, doc: fitz.Document) -> Image.Image:
-        if page_number < doc.page_count:
-            pix = doc.load_page(page_number).get_pixmap(dpi=self.DPI_LEVEL)
-            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            self.log(f"Pages are already aligned")
+        return list1, list2
+
+    def mark_differences_pyramid(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> list[Image.Image]:
+        # Coarse to fine: only the regions that changed at PREVIEW_DPI are rendered and diffed at DPI_LEVEL
+        size = self.page_pixel_size(page_num, doc1, doc2)
+        page1, page2 = self.load_pages(page_num, doc1, doc2)
+        list1 = page1.get_displaylist() if page1 is not None else None
+        list2 = page2.get_displaylist() if page2 is not None else None
+        with self.span("Preview regions"):
+            regions = self.candidate_regions(list1, list2, size)
+        return self.compare_regions(page_num, doc1, doc2, list1, list2, size, regions)
+
+    def mark_differences_vector(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> list[Image.Image]:
+        # Changes come from matching the drawing paths, text and images of both pages, rendering is only done for the output layers
+        from numpy import array, int64
+        size = self.page_pixel_size(page_num, doc1, doc2)
+        page1, page2 = self.load_pages(page_num, doc1, doc2)
+        new_page, old_page = (page1, page2) if "new" in self.MAIN_PAGE.lower() else (page2, page1)
+        with self.span("Match vector content"):
+            added, removed, moved = vector_changes(old_page, new_page, self.VECTOR_TOLERANCE)
+        self.statistics["VECTOR_CHANGES"].append((page_num, len(added), len(removed), len(moved)))
+
+        changed = [self.pixel_box(new_page, rect, size) for rect in added] + [self.pixel_box(old_page, rect, size) for rect in removed]
+        for old_rect, new_rect in moved:
+            changed += [self.pixel_box(old_page, old_rect, size), self.pixel_box(new_page, new_rect, size)]
+        changed = [box for box in changed if box[0] < box[2] and box[1] < box[3]]
+
+        # Every vector change is real, so clusters are boxed regardless of their area
+        boxes = self.difference_boxes(array([(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in changed], dtype=int64).reshape(-1, 4))
+        list1 = page1.get_displaylist() if page1 is not None else None
+        list2 = page2.get_displaylist() if page2 is not None else None
+        return self.compare_regions(page_num, doc1, doc2, list1, list2, size, self.merge_regions(changed, size), boxes)
+
+    def mark_differences_text(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> list[Image.Image]:
+        # Boxes the words found by find_text_changes, only the main page is rendered whole
+        from numpy import array, int64
+        size = self.page_pixel_size(page_num, doc1, doc2)
+        page1, page2 = self.load_pages(page_num, doc1, doc2)
+        added, removed = self.text_changes.get(page_num, ([], []))
+        self.statistics["TEXT_CHANGES"].append((page_num, sum([count for _, count in added]), sum([count for _, count in removed])))
+        boxes = [self.pixel_box(page1, rect, size) for rect, _ in added + removed] if page1 is not None else []
+        regions = self.merge_regions(boxes, size)
+        boxes = array([(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes], dtype=int64).reshape(-1, 4)
+        list1 = page1.get_displaylist() if page1 is not None else None
+        list2 = page2.get_displaylist() if page2 is not None else None
+        return self.compare_regions(page_num, doc1, doc2, list1, list2, size, regions, boxes)
+
+    def find_text_changes(self, doc1: fitz.Document, doc2: fitz.Document) -> dict:
+        """
+        Aligns the words of both documents as one sequence each, so text that reflows onto another page still
+        matches. Returns {page_num: (added, removed)} for pages of the main document, each a list of
+        (rect, word_count) in PDF coordinates. Runs of words only found in the main document are boxed where they
+        are, words only found in the other document get a narrow box after the main document word they follow (or
+        where they were, when the main document has no words).
+        """
+        import fitz
+        main_words = document_words(doc1)
+        other_words = document_words(doc2)
+        main_is_new = "new" in self.MAIN_PAGE.lower()
+        changes = {}
+
+        def add(page_num, rect, count, in_main):
+            # Added and removed are relative to the new document
+            added, removed = changes.setdefault(page_num, ([], []))
+            (added if in_main == main_is_new else removed).append((rect, count))
+
+        for other_start, other_end, main_start, main_end in sequence_changes([word[5] for word in other_words], [word[5] for word in main_words]):
+            run = None
+            for page_num, x0, y0, x1, y1, _, line in main_words[main_start:main_end]:
+                if run is not None and run[0] == page_num and run[2] == line:
+                    run[1] |= fitz.Rect(x0, y0, x1, y1)
+                    run[3] += 1
+                    continue
+                if run is not None:
+                    add(run[0], run[1], run[3], True)
+                run = [page_num, fitz.Rect(x0, y0, x1, y1), line, 1]
+            if run is not None:
+                add(run[0], run[1], run[3], True)
+
+            if other_end > other_start and main_words:
+                if main_start > 0:
+                    page_num, _, y0, x0, y1, _, _ = main_words[main_start - 1]
+                else:
+                    page_num, x0, y0, _, y1, _, _ = main_words[0]
+                add(page_num, fitz.Rect(x0, y0, x0 + (y1 - y0) / 4, y1), other_end - other_start, False)
+            elif other_end > other_start:
+                # The main document has no words (all its text was removed, or it is only images), so the words of
+                # each page of the other document get a marker where the first of them was, on the page paired with it
+                pages = {}
+                for number2, x0, y0, _, y1, _, _ in other_words[other_start:other_end]:
+                    pages.setdefault(number2, [fitz.Rect(x0, y0, x0 + (y1 - y0) / 4, y1), 0])[1] += 1
+                for number2, (rect, count) in pages.items():
+                    page_num = next((number1 for number1, paired in self.page_pairs or [] if paired == number2 and number1 is not None),
+                                    min(number2, doc1.page_count - 1))
+                    add(page_num, rect, count, False)
+        return changes
+
+    def pixel_box(self, page: fitz.Page, rect: fitz.Rect, size: tuple[int, int]) -> tuple[int, int, int, int]:
+        # Maps a rect in PDF coordinates of page to (x0, y0, x1, y1) pixels on the page rendered at size, at least one pixel wide and tall
+        rect = (rect * page.rotation_matrix) - (page.rect.x0, page.rect.y0, page.rect.x0, page.rect.y0)
+        x0, y0 = int(rect.x0 * size[0] / page.rect.width), int(rect.y0 * size[1] / page.rect.height)
+        x1, y1 = int(rect.x1 * size[0] / page.rect.width) + 1, int(rect.y1 * size[1] / page.rect.height) + 1
+        return max(0, x0), max(0, y0), min(size[0], max(x1, x0 + 1)), min(size[1], max(y1, y0 + 1))
+
+    def compare_regions(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document, list1: fitz.DisplayList | None, list2: fitz.DisplayList | None,
+                        size: tuple[int, int], regions: list[tuple[int, int, int, int]], boxes: list[tuple[int, int, int, int]] | None = None) -> list[Image.Image]:
+        # Diffs only the given regions at DPI_LEVEL, whole pages are only rendered for the layers that show them.
+        # Markup boxes come from the change regions unless boxes are given.
+        from numpy import asarray, concatenate, empty, int64, uint8
+        from PIL import Image
+        self.log(f"Comparing {len(regions)} changed regions...")
+        main_copy = "New Copy" if "new" in self.MAIN_PAGE.lower() else "Old Copy"
+        secondary_copy = "Old Copy" if main_copy == "New Copy" else "New Copy"
+        number1, number2 = self.page_numbers(page_num, doc1, doc2)
+        image1 = None
+        if self.INCLUDE_IMAGES[main_copy] or self.INCLUDE_IMAGES["Markup"] or self.INCLUDE_IMAGES["Overlay"]:
+            with self.span("Render main page"):
+                image1 = self.pdf_to_image(number1, doc1, size)
+        image2 = None
+        if self.INCLUDE_IMAGES[secondary_copy]:
+            with self.span("Render secondary page"):
+                image2 = self.pdf_to_image(number2, doc2, size)
+        if image2 is not None and image2.size != size:
+            image2 = image2.resize(size, self.resample_filter())
+
+        channels = self.layer_channels()
+        layer_mode = "RGB" if channels else "L"
+        diff_image = Image.new(layer_mode, size, "white") if self.INCLUDE_IMAGES["Difference"] else None
+        overlay_image = image1.convert(layer_mode) if self.INCLUDE_IMAGES["Overlay"] else None
+        find_regions = boxes is None and self.INCLUDE_IMAGES["Markup"] is True
+        region_boxes, region_areas = [empty((0, 4), dtype=int64)], [empty(0)]
+        for region in regions if diff_image is not None or overlay_image is not None or find_regions else []:
+            x0, y0, x1, y1 = region
+            width, height = x1 - x0, y1 - y0
+            overlay = empty((height, width) + channels, dtype=uint8) if overlay_image is not None else None
+            diff = empty((height, width) + channels, dtype=uint8) if diff_image is not None else None
+            mask = empty((height, width), dtype=uint8) if find_regions else None
+            with self.span("Render regions"):
+                region1, region2 = self.render_tile(list1, region, size), self.render_secondary(list2, region, size)
+            with self.span("Difference kernel"):
+                difference_kernel(asarray(region1), asarray(region2), self.THRESHOLD, diff=diff, overlay=overlay, mask=mask, strip_pixels=self.STRIP_PIXELS)
+            del region1, region2
+            if diff is not None:
+                diff_image.paste(Image.fromarray(diff), (x0, y0))
+            if overlay is not None:
+                overlay_image.paste(Image.fromarray(overlay), (x0, y0))
+            if mask is not None:
+                found_boxes, found_areas = self.change_regions(mask, (x0, y0))
+                region_boxes.append(found_boxes)
+                region_areas.append(found_areas)
+            del overlay, diff, mask
+
+        marked_image = None
+        if self.INCLUDE_IMAGES["Markup"] is True:
+            if boxes is None:
+                boxes = self.difference_boxes(concatenate(region_boxes), concatenate(region_areas))
+            marked_image = self.markup_image(page_num, image1, boxes)
+        return self.output_layers(image1, image2, marked_image, diff_image, overlay_image)
+
+    def output_layers(self, image1: Image.Image, image2: Image.Image, marked_image: Image.Image | None, diff_image: Image.Image | None, overlay_image: Image.Image | None) -> list[Image.Image]:
+        layers = []
+        if self.INCLUDE_IMAGES["New Copy"]:
+            layers.append(image1 if "new" in self.MAIN_PAGE.lower() else image2)
+        if self.INCLUDE_IMAGES["Old Copy"]:
+            layers.append(image2 if "new" in self.MAIN_PAGE.lower() else image1)
+        if self.INCLUDE_IMAGES["Markup"]:
+            layers.append(marked_image)
+        if self.INCLUDE_IMAGES["Difference"]:
+            layers.append(diff_image)
+        if self.INCLUDE_IMAGES["Overlay"]:
+            layers.append(overlay_image)
+        if self.SCALE_OUTPUT:
+            return layers
+
+        # Pages were compared at their own size, each distinct layer is resized to the output page size once
+        resized = {}
+        for layer in layers:
+            if id(layer) not in resized:
+                resized[id(layer)] = layer if layer.size == self.target_size() else layer.resize(self.target_size(), self.resample_filter())
+        return [resized[id(layer)] for layer in layers]
+
+    def target_size(self) -> tuple[int, int]:
+        return int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL)
+
+    def resample_filter(self):
+        from PIL import Image
+        return Image.Resampling[self.RESAMPLE]
+
+    def pdf_to_image(self, page_number: int | None, doc: fitz.Document, blank_size: tuple[int, int]) -> Image.Image:
+        # A missing page (None) renders blank at blank_size, the size its partner page renders at
+        import fitz
+        from PIL import Image
+        mode = "L" if self.RENDER_GRAY is True else "RGB"
+        cache_key = None
+        if self.render_cache is not None and page_number is not None and doc.name:
+            target_size = self.target_size() if self.SCALE_OUTPUT is True else None
+            cache_key = self.render_cache.key(document_hash(doc.name), page_number, self.DPI_LEVEL, mode, target_size)
+            image = self.render_cache.get(cache_key)
+            if image is not None:
+                self.statistics["CACHE_HITS"] += 1
+                return image
+            self.statistics["CACHE_MISSES"] += 1
+
+        colorspace = fitz.csGRAY if mode == "L" else fitz.csRGB
+        if page_number is not None:
+            page = doc.load_page(page_number)
+            if self.SCALE_OUTPUT is True:
+                # Rasterize straight to the output page size instead of rendering at DPI and resampling
+                target_size = self.target_size()
+                pix = page.get_pixmap(matrix=fitz.Matrix(target_size[0] / page.rect.width, target_size[1] / page.rect.height), colorspace=colorspace)
+            else:
+                pix = page.get_pixmap(dpi=self.DPI_LEVEL, colorspace=colorspace)
+            image = Image.frombytes(mode, (pix.width, pix.height), pix.samples_mv)
+            del pix
+            if self.SCALE_OUTPUT is True and image.size != target_size:
+                image = image.resize(target_size, self.resample_filter())
         else:
-            pix = doc.load_page(0).get_pixmap(dpi=self.DPI_LEVEL)
-            image = Image.new("RGB", (pix.width, pix.height), (255, 255, 255))
-        del pix
-        if self.SCALE_OUTPUT is True:
-            image = image.resize((int(self.PAGE_SIZE[0] * self.DPI_LEVEL), int(self.PAGE_SIZE[1] * self.DPI_LEVEL)))
+            image = Image.new(mode, blank_size, "white")
+        if cache_key is not None:
+            self.render_cache.put(cache_key, image)
         return image
 
-    def handle_files(self, files: list[str]):
-        self.logMessage.emit(f"""Processing files:
-        {files[0]}
-        {files[1]}""")
-        current_progress = 0
-        with fitz.open(files[0 if "new" in self.MAIN_PAGE.lower() else 1]) as doc1, fitz.open(files[0 if "old" in self.MAIN_PAGE.lower() else 1]) as doc2:
-            size = doc1.load_page(0).rect
-            # If page size is auto, self.PAGESIZE will be none
-            if self.PAGE_SIZE[0] is None:
-                # Assume 72 DPI for original document resolution
-                self.PAGE_SIZE = (size.width / 72, size.height / 72)
-            self.statistics["MAIN_PAGE"] = files[0 if "new" in self.MAIN_PAGE.lower() else 1]
-            filename = files[0 if "new" in self.MAIN_PAGE.lower() else 1].split("/")[-1]
-            source_path = False
-            if self.OUTPUT_PATH is None:
-                self.OUTPUT_PATH = files[0].replace(filename, "")
-                source_path = True
-            
-            total_operations = max(doc1.page_count, doc2.page_count)
-            self.logMessage.emit(f"Total pages {total_operations}.")
-            progress_per_operation = 100.0 / total_operations
-
-            self.logMessage.emit("Creating temporary directory...")
-            with TemporaryDirectory() as temp_dir:
-                self.logMessage.emit(f"Temporary directory created: {temp_dir}")
-                image_files = []
-                toc = []
-                output_page_number = 2  # Start from 2 because the statistics page will be the first page
+    def open_documents(self, files: list[str]) -> tuple[fitz.Document, fitz.Document]:
+        import fitz
+        doc1 = fitz.open(files[0 if "new" in self.MAIN_PAGE.lower() else 1])
+        doc2 = fitz.open(files[0 if "old" in self.MAIN_PAGE.lower() else 1])
+        return doc1, doc2
+
+    def encode_image(self, image: Image.Image) -> bytes:
+        if self.OUTPUT_GS is True:
+            image = image.convert("L")
+        if self.OUTPUT_BW is True:
+            image = image.convert("1")
+        elif image.mode != "L":
+            image = image.convert("RGB")
+        encoded = BytesIO()
+        image.save(encoded, format="PDF", resolution=self.DPI_LEVEL, optimize=self.REDUCE_FILESIZE)
+        return encoded.getvalue()
+
+    def statistics_snapshot(self) -> dict:
+        return {key: len(value) if isinstance(value, list) else value for key, value in self.statistics.items() if isinstance(value, (list, int))}
+
+    def statistics_since(self, snapshot: dict) -> dict:
+        # Statistics recorded after the snapshot was taken, in the form merge_statistics expects
+        return {key: value[snapshot[key]:] if isinstance(value, list) else value - snapshot[key] for key, value in self.statistics.items() if key in snapshot}
+
+    def merge_statistics(self, changes: dict):
+        for key, value in changes.items():
+            self.statistics[key] += value
+
+    def render_tile(self, display_list: fitz.DisplayList | None, tile: tuple[int, int, int, int], size: tuple[float, float],
+                    offset: tuple[float, float] = (0.0, 0.0)) -> Image.Image:
+        # Renders one region of a page stretched to size pixels, with the page moved by -offset pixels (which may be
+        # fractional), a missing page renders blank
+        import fitz
+        from PIL import Image
+        x0, y0, x1, y1 = tile
+        x, y = offset
+        mode = "L" if self.RENDER_GRAY is True else "RGB"
+        image = Image.new(mode, (x1 - x0, y1 - y0), "white")
+        if display_list is not None:
+            scale_x = size[0] / display_list.rect.width
+            scale_y = size[1] / display_list.rect.height
+            clip = fitz.Rect((x0 + x) / scale_x, (y0 + y) / scale_y, (x1 + x) / scale_x, (y1 + y) / scale_y) + (display_list.rect.x0, display_list.rect.y0, display_list.rect.x0, display_list.rect.y0)
+            matrix = fitz.Matrix(scale_x, scale_y).pretranslate(-display_list.rect.x0 - x / scale_x, -display_list.rect.y0 - y / scale_y)
+            pix = display_list.get_pixmap(matrix=matrix, clip=clip, alpha=False,
+                                          colorspace=fitz.csGRAY if mode == "L" else fitz.csRGB)
+            image.paste(Image.frombytes(mode, (pix.width, pix.height), pix.samples_mv), (pix.x - x0, pix.y - y0))
+            del pix
+        return image
+
+    def encode_tile(self, image: Image.Image) -> bytes:
+        # Same colour reduction and compression encode_image gets from Pillow's PDF writer
+        if self.OUTPUT_GS is True:
+            image = image.convert("L")
+        encoded = BytesIO()
+        if self.OUTPUT_BW is True:
+            image.convert("1").save(encoded, format="TIFF", compression="group4")
+        else:
+            image.convert("L" if image.mode == "L" else "RGB").save(encoded, format="JPEG", optimize=self.REDUCE_FILESIZE)
+        return encoded.getvalue()
+
+    def compare_page_tiled(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> list[bytes]:
+        # Renders, diffs and encodes the page one tile at a time so memory use is bounded by TILE_SIZE, not by the page
+        import fitz
+        from numpy import asarray, empty, full, uint8
+        from PIL import Image
+        size = self.target_size()
+        identical = page_num in self.identical_pages
+        page1, page2 = self.load_pages(page_num, doc1, doc2)
+        list1 = page1.get_displaylist() if page1 is not None else None
+        list2 = page2.get_displaylist() if page2 is not None and not identical else None
+        tiles = [(x, y, min(x + self.TILE_SIZE, size[0]), min(y + self.TILE_SIZE, size[1]))
+                 for y in range(0, size[1], self.TILE_SIZE) for x in range(0, size[0], self.TILE_SIZE)]
+        self.log(f"Comparing page in {len(tiles)} tiles...")
+
+        layer_names = [name for name in ["New Copy", "Old Copy", "Markup", "Difference", "Overlay"] if self.INCLUDE_IMAGES[name]]
+        layers = {name: fitz.open() for name in layer_names}
+        pages = {name: layers[name].new_page(width=self.PAGE_SIZE[0] * 72, height=self.PAGE_SIZE[1] * 72) for name in layer_names}
+        scale = 72 / self.DPI_LEVEL
+        main_tiles = {}
+        tile_regions = _TileRegions(size)
+        channels = self.layer_channels()
+
+        for tile in tiles:
+            x0, y0, x1, y1 = tile
+            rect = fitz.Rect(x0 * scale, y0 * scale, x1 * scale, y1 * scale)
+            with self.span("Render tiles"):
+                tile1 = self.render_tile(list1, tile, size)
+                tile2 = tile1 if identical else self.render_secondary(list2, tile, size)
+            if identical:
+                diff = full((y1 - y0, x1 - x0) + channels, 255, dtype=uint8) if self.INCLUDE_IMAGES["Difference"] else None
+                overlay = asarray(tile1)
+                mask = None
+            else:
+                overlay = empty((y1 - y0, x1 - x0) + channels, dtype=uint8) if self.INCLUDE_IMAGES["Overlay"] is True else None
+                diff = empty((y1 - y0, x1 - x0) + channels, dtype=uint8) if self.INCLUDE_IMAGES["Difference"] is True else None
+                mask = empty((y1 - y0, x1 - x0), dtype=uint8) if self.INCLUDE_IMAGES["Markup"] is True else None
+                with self.span("Difference kernel"):
+                    difference_kernel(asarray(tile1), asarray(tile2), self.THRESHOLD, diff=diff, overlay=overlay, mask=mask, strip_pixels=self.STRIP_PIXELS)
 
+            with self.span("Encode tiles"):
+                encoded1 = self.encode_tile(tile1)
+                encoded2 = encoded1 if identical else self.encode_tile(tile2)
+                if "New Copy" in pages:
+                    pages["New Copy"].insert_image(rect, stream=encoded1 if "new" in self.MAIN_PAGE.lower() else encoded2)
+                if "Old Copy" in pages:
+                    pages["Old Copy"].insert_image(rect, stream=encoded2 if "new" in self.MAIN_PAGE.lower() else encoded1)
+                if "Difference" in pages:
+                    pages["Difference"].insert_image(rect, stream=self.encode_tile(Image.fromarray(diff)))
+                if "Overlay" in pages:
+                    pages["Overlay"].insert_image(rect, stream=self.encode_tile(Image.fromarray(overlay)))
+            if "Markup" in pages:
+                main_tiles[tile] = encoded1
+            del tile1, tile2, diff, overlay
+
+            if mask is not None:
+                with self.span("Find regions"):
+                    tile_regions.add((x0, y0), mask)
+                del mask
+
+        if "Markup" in pages:
+            if identical:
+                boxes = []
+            else:
+                with self.span("Find regions"):
+                    regions = tile_regions.regions(self.REGION_METHOD == "COMPONENTS")
+                boxes = self.difference_boxes(*regions).tolist()
+            self.statistics["TOTAL_DIFFERENCES"] += len(boxes)
+            self.statistics["PAGES_WITH_DIFFERENCES"].append((page_num, len(boxes)))
+            with self.span("Draw markup"):
+                for tile in tiles:
+                    x0, y0, x1, y1 = tile
+                    encoded = main_tiles.pop(tile)
+                    if any(x < x1 and x + w > x0 and y < y1 and y + h > y0 for x, y, w, h in boxes):
+                        marked_tile = self.draw_difference_boxes(self.render_tile(list1, tile, size), boxes, (x0, y0), "RGB" if channels else None)
+                        encoded = self.encode_tile(marked_tile)
+                        del marked_tile
+                    pages["Markup"].insert_image(fitz.Rect(x0 * scale, y0 * scale, x1 * scale, y1 * scale), stream=encoded)
+
+        with self.span("Encode layers"):
+            encoded_pages = [layers[name].tobytes(deflate=True) for name in layer_names]
+        for layer in layers.values():
+            layer.close()
+        return encoded_pages
+
+    def compare_page(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> tuple[list[bytes], dict]:
+        # Encoded layers of the page, and the statistics recorded while comparing it
+        snapshot = self.statistics_snapshot()
+        self.import_modules()
+        self.current_page = page_num
+        try:
+            with self.span("Compare page"):
+                encoded_pages = self.page_layers(page_num, doc1, doc2)
+        finally:
+            self.current_page = None
+        return encoded_pages, self.statistics_since(snapshot)
+
+    def page_layers(self, page_num: int, doc1: fitz.Document, doc2: fitz.Document) -> list[bytes]:
+        self.alignment = (1.0, 0, 0)
+        list2 = None
+        number1, number2 = self.page_numbers(page_num, doc1, doc2)
+        if (self.ALIGN != "NONE" and self.COMPARE_MODE == "RASTER" and page_num not in self.identical_pages
+                and number1 is not None and number2 is not None):
+            _, list2 = self.align_page(page_num, doc1, doc2, self.target_size() if self.TILE_SIZE else self.page_pixel_size(page_num, doc1, doc2))
+        if self.COMPARE_MODE == "RASTER" and self.TILE_SIZE:
+            return self.compare_page_tiled(page_num, doc1, doc2)
+        if self.COMPARE_MODE == "TEXT" and (page_num not in self.identical_pages or page_num in self.text_changes):
+            markups = self.mark_differences_text(page_num, doc1, doc2)
+        elif (self.COMPARE_MODE == "VECTOR" or self.PREVIEW_DPI) and page_num not in self.identical_pages:
+            if self.COMPARE_MODE == "VECTOR":
+                self.log(f"Matching vector content...")
+                markups = self.mark_differences_vector(page_num, doc1, doc2)
+            else:
+                markups = self.mark_differences_pyramid(page_num, doc1, doc2)
+        else:
+            self.log(f"Converting main page...")
+            size = self.page_pixel_size(page_num, doc1, doc2)
+            with self.span("Render main page"):
+                image1 = self.pdf_to_image(number1, doc1, size)
+            if page_num in self.identical_pages:
+                self.log(f"Page is identical in both files, skipping comparison...")
+                markups = self.identical_layers(page_num, image1)
+            else:
+                self.log(f"Converting secondary page...")
+                with self.span("Render secondary page"):
+                    image2 = self.pdf_to_image(number2, doc2, size) if list2 is None else self.render_secondary(list2, (0, 0) + image1.size, image1.size)
+                self.log(f"Marking differences...")
+                with self.span("Mark differences"):
+                    markups = self.mark_differences(page_num, image1, image2)
+                del image2
+            del image1
+
+        self.log(f"Encoding output pages...")
+        with self.span("Encode layers"):
+            encoded_pages = [self.encode_image(image) for image in markups]
+        del markups
+        return encoded_pages
+
+    def identical_layers(self, page_num: int, image: Image.Image) -> list[Image.Image]:
+        # Matches what mark_differences produces for two identical renders without computing them
+        from PIL import Image
+        if self.INCLUDE_IMAGES["Markup"] is True:
+            self.statistics["PAGES_WITH_DIFFERENCES"].append((page_num, 0))
+        diff_image = Image.new(image.mode, image.size, "white") if self.INCLUDE_IMAGES["Difference"] else None
+        return self.output_layers(image, image, image, diff_image, image)
+
+    def find_identical_pages(self, doc1: fitz.Document, doc2: fitz.Document) -> list[int]:
+        fingerprints1 = {}
+        fingerprints2 = {}
+        return [page_num for page_num, (number1, number2) in enumerate(self.page_pairs) if number1 is not None and number2 is not None
+                and page_fingerprint(doc1, number1, fingerprints1) == page_fingerprint(doc2, number2, fingerprints2)]
+
+    def compare_pages(self, files: list[str], doc1: fitz.Document, doc2: fitz.Document, total_operations: int):
+        # Pages are yielded in order regardless of how they are computed
+        if self.pool is not None:
+            yield from self.merged_pages(pool_results(self.pool, _compare_page_worker, self.page_tasks(files, total_operations), 2 * max(self.WORKERS, 1)))
+            return
+        if self.WORKERS <= 1:
+            for i in range(total_operations):
+                yield self.compare_page(i, doc1, doc2)[0]
+            return
+
+        workers = min(self.WORKERS, total_operations)
+        self.log(f"Starting {workers} comparison workers...")
+        with get_context("spawn").Pool(workers) as pool:
+            yield from self.merged_pages(pool.imap(_compare_page_worker, self.page_tasks(files, total_operations)))
+
+    def page_tasks(self, files: list[str], total_operations: int) -> list[tuple]:
+        # Tasks for _compare_page_worker, one per output page
+        return [(tuple(files), tuple(self.options or []), self.PAGE_SIZE, (self.TILE_SIZE, self.STRIP_PIXELS), tuple(self.page_pairs),
+                 tuple(self.identical_pages), i, self.text_changes.get(i)) for i in range(total_operations)]
+
+    def merged_pages(self, results):
+        # Encoded pages of worker results, statistics recorded by the worker are merged here so they stay in page order
+        for encoded_pages, page_statistics in results:
+            if encoded_pages is None:
+                raise RuntimeError(page_statistics)
+            self.merge_statistics(page_statistics)
+            yield encoded_pages
+
+    def layer_names(self) -> list[str]:
+        # ToC names of the layers compare_page produces, in order
+        names = []
+        if self.INCLUDE_IMAGES["New Copy"]:
+            names.append("New Copy" if "new" in self.MAIN_PAGE.lower() else "Old Copy")
+        if self.INCLUDE_IMAGES["Old Copy"]:
+            names.append("Old Copy" if "new" in self.MAIN_PAGE.lower() else "New Copy")
+        return names + [name for name in ["Markup", "Difference", "Overlay"] if self.INCLUDE_IMAGES[name]]
+
+    def statistics_document(self, files: list[str], total_operations: int) -> fitz.Document:
+        import fitz
+        text = f"Document Comparison Report\n\nTotal Pages: {total_operations}\nFiles Compared:\n    {files[0]}\n    {files[1]}\nMain Page: {self.statistics['MAIN_PAGE']}\nTotal Differences: {self.statistics['TOTAL_DIFFERENCES']}\nPages with differences:\n"
+        for page_info in self.statistics["PAGES_WITH_DIFFERENCES"]:
+            text += f"    Page {page_info[0]+1} Changes: {page_info[1]}\n"
+        if self.statistics["VECTOR_CHANGES"]:
+            text += "Vector changes:\n"
+            for page_num, added, removed, moved in self.statistics["VECTOR_CHANGES"]:
+                text += f"    Page {page_num+1} Added: {added} Removed: {removed} Moved: {moved}\n"
+        if self.statistics["TEXT_CHANGES"]:
+            text += "Word changes:\n"
+            for page_num, added, removed in self.statistics["TEXT_CHANGES"]:
+                if added or removed:
+                    text += f"    Page {page_num+1} Added: {added} Removed: {removed}\n"
+        if self.statistics["ALIGNMENTS"]:
+            text += "Aligned pages (secondary page offset and scale):\n"
+            for page_num, x, y, scale in self.statistics["ALIGNMENTS"]:
+                text += f"    Page {page_num+1} Offset: {x:.2f}, {y:.2f} pt Scale: {scale:.4f}\n"
+        if self.statistics["INSERTED_PAGES"]:
+            text += "Inserted pages (only in the new file):\n"
+            for page_num, number in self.statistics["INSERTED_PAGES"]:
+                text += f"    Page {page_num+1} (new page {number+1})\n"
+        if self.statistics["REMOVED_PAGES"]:
+            text += "Removed pages (only in the old file):\n"
+            for page_num, number in self.statistics["REMOVED_PAGES"]:
+                text += f"    Page {page_num+1} (old page {number+1})\n"
+        if self.statistics["IDENTICAL_PAGES"]:
+            text += f"Unchanged pages (identical content, not compared):\n    {', '.join(str(page_num + 1) for page_num in self.statistics['IDENTICAL_PAGES'])}\n"
+
+        # Create statistics page and handle text overflow
+        stats_doc = fitz.open()
+        stats_page = stats_doc.new_page()
+        text_blocks = text.split('\n')
+        y_position = 72
+        for line in text_blocks:
+            if y_position > fitz.paper_size('letter')[1] - 72:
+                stats_page = stats_doc.new_page()  # Create a new page if needed
+                y_position = 72  # Reset y position for the new page
+            stats_page.insert_text((72, y_position), line, fontsize=11, fontname="helv")
+            y_position += 12  # Adjust y_position by the line height
+        return stats_doc
+
+    def summary(self) -> dict:
+        # Counts of the last comparison, in the order of the batch index columns
+        return {
+            "pages": len(self.page_pairs or []),
+            "pages_with_differences": sum(1 for _, count in self.statistics["PAGES_WITH_DIFFERENCES"] if count),
+            "total_differences": self.statistics["TOTAL_DIFFERENCES"],
+            "inserted_pages": len(self.statistics["INSERTED_PAGES"]),
+            "removed_pages": len(self.statistics["REMOVED_PAGES"]),
+            "identical_pages": len(self.statistics["IDENTICAL_PAGES"])
+            }
+
+    def prepare(self, files: list[str], doc1: fitz.Document, doc2: fitz.Document) -> int:
+        # Page size, page pairs, identical pages and word changes of a comparison, returns the number of output pages
+        self.import_modules()
+        self.PAGE_SIZE = tuple(self.compare_settings.get("PAGE_SIZES").get(self.compare_settings.get("PAGE_SIZE")))
+        size = doc1.load_page(0).rect
+        # If page size is auto, self.PAGESIZE will be none
+        if self.PAGE_SIZE[0] is None:
+            # Assume 72 DPI for original document resolution
+            self.PAGE_SIZE = (size.width / 72, size.height / 72)
+        self.statistics["MAIN_PAGE"] = files[0 if "new" in self.MAIN_PAGE.lower() else 1]
+
+        if self.MATCH_PAGES is True and max(doc1.page_count, doc2.page_count) > 1:
+            self.log("Matching pages...")
+            with self.span("Match pages"):
+                self.page_pairs = self.match_pages(doc1, doc2)
+            self.log(f"{len(self.statistics['INSERTED_PAGES'])} pages inserted and {len(self.statistics['REMOVED_PAGES'])} removed.")
+        else:
+            self.page_pairs = [self.page_numbers(page_num, doc1, doc2) for page_num in range(max(doc1.page_count, doc2.page_count))]
+        total_operations = len(self.page_pairs)
+        self.log(f"Total pages {total_operations}.")
+        if self.MAX_MEMORY:
+            self.plan_memory(doc1, doc2)
+
+        if self.SKIP_IDENTICAL is True:
+            self.log("Fingerprinting pages...")
+            with self.span("Fingerprint pages"):
+                self.identical_pages = set(self.find_identical_pages(doc1, doc2))
+            self.statistics["IDENTICAL_PAGES"] = sorted(self.identical_pages)
+            self.log(f"{len(self.identical_pages)} of {total_operations} pages are identical and will not be compared.")
+
+        if self.COMPARE_MODE == "TEXT":
+            self.log("Comparing words...")
+            # Found per page of the main document, kept per output page
+            with self.span("Compare words"):
+                text_changes = self.find_text_changes(doc1, doc2)
+            self.text_changes = {page_num: text_changes[number1] for page_num, (number1, _) in enumerate(self.page_pairs) if number1 in text_changes}
+            self.log(f"{len(self.text_changes)} pages have changed words.")
+        return total_operations
+
+    def page_memory(self, pixels: int, strip_pixels: int, tiled_pixels: int = 0) -> float:
+        # Estimated peak megabytes of comparing pixels at once, a whole page or a tile of a page of tiled_pixels
+        render_channels = 1 if self.RENDER_GRAY is True else 3
+        layer_channels = 3 if self.layer_channels() else 1
+        layers = sum(1 for name in ("Markup", "Difference", "Overlay") if self.INCLUDE_IMAGES[name])
+        copies = sum(1 for name in ("New Copy", "Old Copy") if self.INCLUDE_IMAGES[name])
+        per_pixel = MEMORY_RENDER_BYTES * render_channels + layer_channels * (MEMORY_ENCODE_BYTES + MEMORY_LAYER_BYTES * layers + MEMORY_COPY_BYTES * copies)
+        tiled = MEMORY_TILED_MB + tiled_pixels * MEMORY_TILED_BYTES / (1 << 20) if tiled_pixels else 0
+        return MEMORY_PAGE_MB + tiled + (pixels * per_pixel + min(pixels, strip_pixels) * MEMORY_STRIP_BYTES) / (1 << 20)
+
+    def plan_memory(self, doc1: fitz.Document, doc2: fitz.Document):
+        # Picks the most workers (up to WORKERS), then whole pages or the largest tiles, then the largest difference
+        # kernel strips whose estimated peak memory fits in MAX_MEMORY megabytes. Tiles are only used when whole pages
+        # don't fit, and a pool passed in keeps its workers
+        width, height = self.target_size()
+        pixels = width * height
+        if self.SCALE_OUTPUT is not True:
+            pixels = max([pixels] + [w * h for w, h in (self.page_pixel_size(page_num, doc1, doc2) for page_num in range(len(self.page_pairs)))])
+        tile_size = self.compare_settings.get("TILE_SIZE")
+        tile_sizes = [tile_size] if tile_size else [0]
+        if self.COMPARE_MODE == "RASTER":
+            tile_sizes += [size for size in MEMORY_TILE_SIZES if size < tile_size or not tile_size]
+        workers = self.compare_settings.get("WORKERS")
+        worker_counts = [workers] if self.pool is not None else range(max(1, min(workers, len(self.page_pairs))), 0, -1)
+
+        plans = ((workers, tile, strip) for workers in worker_counts for tile in tile_sizes for strip in MEMORY_STRIP_SIZES)
+        for workers, tile, strip in plans:
+            page = self.page_memory(min(tile * tile, pixels), strip, pixels) if tile else self.page_memory(pixels, strip)
+            estimate = (workers + 1 if workers > 1 else 1) * MEMORY_PROCESS_MB + workers * page
+            if estimate <= self.MAX_MEMORY:
+                break
+        self.WORKERS, self.TILE_SIZE, self.STRIP_PIXELS = workers, tile, strip
+        self.memory_estimate = estimate
+        self.log(f"Memory plan: {workers} worker{'s' if workers > 1 else ''}, {f'tiles of {tile} pixels' if tile else 'whole pages'}, "
+                 f"difference strips of {strip} pixels, about {estimate:.0f} MB of {self.MAX_MEMORY} MB for {width}x{height} pixel pages.")
+        if estimate > self.MAX_MEMORY:
+            self.log(f"Warning: the smallest plan is estimated to need {estimate:.0f} MB, over the {self.MAX_MEMORY} MB budget.")
+        if tile and not tile_size and self.PREVIEW_DPI and self.COMPARE_MODE == "RASTER":
+            # Tiles and the preview pass don't combine, and the preview pass still renders whole pages for the layers
+            self.log(f"Warning: the preview pass (-pd) is off, whole pages don't fit in the {self.MAX_MEMORY} MB budget so pages are compared in tiles.")
+
+    def output_file(self, files: list[str]) -> str:
+        # Comparison file path next to the main file (or in OUTPUT_PATH) that doesn't exist yet
+        filename = files[0 if "new" in self.MAIN_PAGE.lower() else 1].split("/")[-1]
+        output_folder = self.OUTPUT_PATH if self.OUTPUT_PATH is not None else files[0].replace(filename, "")
+        output_path = f"{output_folder}{filename.split('.')[0]} Comparison.pdf"
+        output_iterator = 0
+
+        # Checks if a version already exists and increments revision if necessary
+        while path.exists(output_path):
+            output_iterator += 1
+            output_path = f"{output_folder}{filename.split('.')[0]} Comparison Rev {output_iterator}.pdf"
+        return output_path
+
+    def write_comparison(self, output_path: str, files: list[str], page_groups, total_operations: int):
+        # Writes the encoded page groups of every output page, in order, and the statistics page to output_path
+        self.log(f"Writing comparison file: {output_path}")
+        current_progress = 0
+        progress_per_operation = 100.0 / total_operations
+        layer_names = self.layer_names()
+        try:
+            with ComparisonAssembler(output_path, self.CHECKPOINT_INTERVAL) as assembler:
                 # Process each page in the documents
-                for i in range(total_operations):
-                    self.logMessage.emit(f"Processing page {i+1} of {total_operations}...")
-                    self.logMessage.emit(f"Converting main page...")
-                    image1 = self.pdf_to_image(i, doc1)
-                    self.logMessage.emit(f"Converting secondary page...")
-                    image2 = self.pdf_to_image(i, doc2)
-                    self.logMessage.emit(f"Marking differences...")
-                    markups = self.mark_differences(i, image1, image2)
-                    del image1, image2
-
-                    # Save marked images and create ToC entries
-                    self.logMessage.emit(f"Saving output files...")
-                    for j, image in enumerate(markups):
-                        if self.OUTPUT_GS is True:
-                            image = image.convert("L")
-                        if self.OUTPUT_BW is True:
-                            image = image.convert("1")
-                        else:
-                            image = image.convert("RGB")
-                        image_file = path.join(temp_dir, f"{i}_{j}.pdf")
-                        image.save(image_file, resolution=self.DPI_LEVEL, optimize=self.REDUCE_FILESIZE)
-                        del image
-                        image_files.append(image_file)
-
-                        # Determine the type of the page and add it to the ToC
-                        page_type = ""
-                        if j == 0:
-                            page_type = "New Copy" if "new" in self.MAIN_PAGE.lower() else "Old Copy"
-                        elif j == 1:
-                            page_type = "Old Copy" if "new" in self.MAIN_PAGE.lower() else "New Copy"
-                        elif j == 2:
-                            page_type = "Markup"
-                        elif j == 3:
-                            page_type = "Difference"
-                        elif j == 4:
-                            page_type = "Overlay"
-                        
-                        toc.append([1, f"{page_type} - Page {i + 1}", output_page_number])
-                        output_page_number += 1
-                    
+                for i, encoded_pages in enumerate(page_groups):
+                    self.log(f"Processed page {i+1} of {total_operations}.")
+                    with self.span("Assemble page", i):
+                        assembler.add_page_group(i, encoded_pages, layer_names)
                     current_progress += progress_per_operation
-                    self.progressUpdated.emit(int(current_progress))
+                    self.progress(int(current_progress))
+                    self.pages(i + 1, total_operations)
+                    if self.cancelled and i + 1 < total_operations:
+                        raise ComparisonCancelled(f"Comparison cancelled after page {i+1} of {total_operations}")
 
                 # Create statistics page
-                self.logMessage.emit("Creating statistics page...")
-                text = f"Document Comparison Report\n\nTotal Pages: {total_operations}\nFiles Compared:\n    {files[0]}\n    {files[1]}\nMain Page: {self.statistics['MAIN_PAGE']}\nTotal Differences: {self.statistics['TOTAL_DIFFERENCES']}\nPages with differences:\n"
-                for page_info in self.statistics["PAGES_WITH_DIFFERENCES"]:
-                    text += f"    Page {page_info[0]+1} Changes: {page_info[1]}\n"
-
-                # Create statistics page and handle text overflow
-                stats_doc = fitz.open()
-                stats_page = stats_doc.new_page()
-                text_blocks = text.split('\n')
-                y_position = 72
-                for line in text_blocks:
-                    if y_position > fitz.paper_size('letter')[1] - 72:
-                        stats_page = stats_doc.new_page()  # Create a new page if needed
-                        y_position = 72  # Reset y position for the new page
-                    stats_page.insert_text((72, y_position), line, fontsize=11, fontname="helv")
-                    y_position += 12  # Adjust y_position by the line height
-
-                # Save and close the stats document
-                stats_filename = path.join(temp_dir, "stats.pdf")
-                stats_doc.save(stats_filename)
-                stats_doc.close()
-                image_files.insert(0, stats_filename)  # Insert statistics page at the beginning
-
-                # Add statistics page to the ToC
-                toc.insert(0, [1, "Statistics", 1])
-
-                # Build final PDF from each PDF image page
-                self.logMessage.emit("Compiling PDF from output folder...")
-                compiled_pdf = fitz.open()
-
-                for img_path in image_files:
-                    img = fitz.open(img_path)
-                    compiled_pdf.insert_pdf(img, links=False)
-                    img.close()
+                self.log("Creating statistics page...")
+                with self.span("Statistics page"):
+                    assembler.add_statistics(self.statistics_document(files, total_operations))
 
                 # Save Final PDF File
-                self.logMessage.emit(f"Saving final PDF...")
-                output_path = f"{self.OUTPUT_PATH}{filename.split('.')[0]} Comparison.pdf"
-                output_iterator = 0
-                
-                # Checks if a version already exists and increments revision if necessary
-                while path.exists(output_path):
-                    output_iterator += 1
-                    output_path = f"{self.OUTPUT_PATH}{filename.split('.')[0]} Comparison Rev {output_iterator}.pdf"
-                
-                # Set the Table of Contents (ToC)
-                compiled_pdf.set_toc(toc)
-                compiled_pdf.save(output_path)
-                compiled_pdf.close()
-
-                self.logMessage.emit(f"Comparison file created: {output_path}")
-                if source_path:
-                    self.OUTPUT_PATH = None
-
-        self.compareComplete.emit(5)
-        
-        
+                self.log(f"Saving final PDF...")
+                with self.span("Save PDF"):
+                    assembler.close()
+        except ComparisonCancelled:
+            # A cancelled comparison leaves no partial file behind
+            if path.exists(output_path):
+                remove(output_path)
+            raise
+
+        if self.render_cache is not None:
+            self.log(f"Render cache: {self.statistics['CACHE_HITS']} hits, {self.statistics['CACHE_MISSES']} misses.")
+        self.log(f"Comparison file created: {output_path}")
+
+    def compare(self, files: list[str]) -> str:
+        self.reset_statistics()
+        with self.span("Comparison"):
+            self.log(f"""Processing files:
+        {files[0]}
+        {files[1]}""")
+            with self.span("Open documents"):
+                doc1, doc2 = self.open_documents(files)
+            with doc1, doc2:
+                total_operations = self.prepare(files, doc1, doc2)
+                output_path = self.output_file(files)
+                self.write_comparison(output_path, files, self.compare_pages(files, doc1, doc2, total_operations), total_operations)
+        if self.PROFILE is True:
+            self.write_profile(profile_path(output_path))
+        return output_path
+
+    def write_profile(self, trace_path: str):
+        # Writes the spans of the last comparison as a Chrome trace and logs the time spent in every stage
+        write_trace(trace_path, self.statistics["PROFILE"])
+        for line in profile_summary(self.statistics["PROFILE"]):
+            self.log(line)
+        self.log(f"Profile written: {trace_path}")
+
+    def compare_batch(self, pairs: list[tuple[str, str]], index_path: str, unpaired: list[tuple[str, str]] = ()) -> str:
+        # Compares every (new, old) pair of files and writes a CSV index of the results to index_path. With workers,
+        # all pairs are prepared on one pool and the pages of every pair go through it as one stream, so workers
+        # never wait for a document to finish. A pair that fails is recorded in the index and the rest carry on.
+        # unpaired (new, old) files, one of them None, are listed in the index without being compared
+        from collections import deque
+        from itertools import islice
+        rows = []
+        results = {}
+        self.log(f"Comparing {len(pairs)} pairs of files...")
+        workers = min(self.WORKERS, len(pairs))
+        with self.span("Batch"):
+            pool = get_context("spawn").Pool(workers) if workers > 1 else None
+            try:
+                if pool is None:
+                    for i, files in enumerate(pairs):
+                        comparer = Comparer(options=self.options, log=self.log)
+                        try:
+                            results[i] = (comparer.compare(list(files)), comparer)
+                        except Exception as e:
+                            results[i] = (f"Failed: {type(e).__name__}: {e}", None)
+                            self.log(f"Comparison of {files[0]} failed: {e}")
+                        self.statistics["PROFILE"] += comparer.statistics["PROFILE"]
+                        self.progress(int(100 * (i + 1) / len(pairs)))
+                else:
+                    self.log(f"Starting {workers} comparison workers...")
+                    documents = []
+                    # Every pair is prepared up front so its pages can be queued behind the pages of the pair before it
+                    tasks = [(tuple(files), tuple(self.options or [])) for files in pairs]
+                    for i, (files, prepared) in enumerate(zip(pairs, pool.imap(_prepare_worker, tasks))):
+                        if isinstance(prepared, str):
+                            results[i] = (f"Failed: {prepared}", None)
+                            self.log(f"Preparing {files[0]} failed: {prepared}")
+                            continue
+                        comparer = Comparer(options=self.options, log=self.log)
+                        comparer.PAGE_SIZE, (comparer.TILE_SIZE, comparer.STRIP_PIXELS), page_pairs, identical_pages, comparer.text_changes, comparer.statistics = prepared
+                        comparer.page_pairs = list(page_pairs)
+                        comparer.identical_pages = set(identical_pages)
+                        documents.append((i, list(files), comparer))
+                    tasks = (task for _, files, comparer in documents for task in comparer.page_tasks(files, len(comparer.page_pairs)))
+                    page_results = pool.imap(_batch_page_worker, tasks)
+                    for done, (i, files, comparer) in enumerate(documents):
+                        total_operations = len(comparer.page_pairs)
+                        self.log(f"Processing files:\n        {files[0]}\n        {files[1]}")
+                        pages = islice(page_results, total_operations)
+                        try:
+                            output_path = comparer.output_file(files)
+                            comparer.write_comparison(output_path, files, comparer.merged_pages(pages), total_operations)
+                            results[i] = (output_path, comparer)
+                            if comparer.PROFILE is True:
+                                comparer.write_profile(profile_path(output_path))
+                        except Exception as e:
+                            results[i] = (f"Failed: {type(e).__name__}: {e}", None)
+                            self.log(f"Comparison of {files[0]} failed: {e}")
+                        self.statistics["PROFILE"] += comparer.statistics["PROFILE"]
+                        # Pages of a failed pair that were never written still have to come off the stream
+                        deque(pages, maxlen=0)
+                        self.progress(int(100 * (done + 1) / len(documents)))
+            finally:
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+
+        for i, files in enumerate(pairs):
+            output_path, comparer = results.get(i, ("Failed", None))
+            if comparer is None:
+                rows.append([files[0], files[1], "", "", "", "", "", "", "", output_path])
+                continue
+            rows.append([files[0], files[1], output_path, *comparer.summary().values(), "Compared"])
+        for new_file, old_file in unpaired:
+            rows.append([new_file or "", old_file or "", "", "", "", "", "", "", "", "Only in old files" if new_file is None else "Only in new files"])
+        write_index(index_path, rows)
+        failed = sum(1 for row in rows if row[-1].startswith("Failed"))
+        self.log(f"Compared {len(pairs) - failed} of {len(pairs)} pairs, index written: {index_path}")
+        if self.PROFILE is True:
+            self.write_profile(profile_path(index_path))
+        return index_path
+
+
+_difference_lut = None
+
+def _get_difference_lut():
+    # Rows 0-255 map a "removed" luminance to the red ramp, rows 256-511 an "added" luminance to the blue ramp.
+    # Built with ImageOps.colorize on an inverted gradient so it matches the PIL chain it replaced exactly.
+    global _difference_lut
+    if _difference_lut is None:
+        from numpy import arange, asarray, concatenate, uint8
+        from PIL import Image, ImageOps
+        gradient = Image.fromarray((255 - arange(256, dtype=uint8)).reshape(1, 256), "L")
+        red = asarray(ImageOps.colorize(gradient, black="red", white="white").convert("RGB"))[0]
+        blue = asarray(ImageOps.colorize(gradient, black="blue", white="white").convert("RGB"))[0]
+        _difference_lut = concatenate([red, blue])
+    return _difference_lut
+
+def _luminance(rgb):
+    # Same fixed point weights PIL uses for RGB -> L, a single channel is already luminance
+    from numpy import int32
+    rgb = rgb.astype(int32)
+    if rgb.shape[-1] == 1:
+        return rgb[..., 0]
+    return (rgb[..., 0] * 19595 + rgb[..., 1] * 38470 + rgb[..., 2] * 7471 + 0x8000) >> 16
+
+def difference_kernel(array1, array2, threshold: int, diff=None, overlay=None, mask=None, strip_pixels: int = 1 << 22):
+    """
+    Compares two equally sized RGB (H, W, 3) or grayscale (H, W) uint8 rasters in one pass, writing into
+    preallocated outputs:
+        diff     (H, W, 3) uint8  Content removed from array1 in red, content added in array2 in blue
+        overlay  (H, W, 3) uint8  array1 with content only found in array2 shown in red
+        mask     (H, W)    uint8  255 where the luminance of |array2 - array1| is above threshold
+    diff and overlay may also be (H, W), getting the luminance of those colours instead. Outputs left as
+    None are skipped. Rows are processed in strips so temporaries stay small, and only pixels that differ
+    between the two rasters go through the arithmetic.
+    """
+    from numpy import empty, flatnonzero, int16, maximum, not_equal, uint8
+    height, width = array1.shape[:2]
+    channels = 1 if array1.ndim == 2 else 3
+    diff_channels = 1 if diff is not None and diff.ndim == 2 else 3
+    overlay_channels = 1 if overlay is not None and overlay.ndim == 2 else 3
+    strip_rows = max(1, min(height, strip_pixels // max(1, width)))
+    lut = _get_difference_lut() if diff is not None else None
+    if lut is not None and diff_channels == 1:
+        lut = _luminance(lut).astype(uint8)[:, None]
+    red_value = (255, 0, 0) if overlay_channels == 3 else _luminance(uint8([[255, 0, 0]]))
+    unequal = empty((strip_rows, width, channels), dtype=bool)
+    changed = empty((strip_rows, width), dtype=bool)
+    luminance = _luminance
+
+    for top in range(0, height, strip_rows):
+        bottom = min(height, top + strip_rows)
+        rows = bottom - top
+        strip1 = array1[top:bottom].reshape(rows, width, channels)
+        strip2 = array2[top:bottom].reshape(rows, width, channels)
+        not_equal(strip1, strip2, out=unequal[:rows])
+        unequal[:rows].any(axis=-1, out=changed[:rows])
+        index = flatnonzero(changed[:rows])
+        pixels1 = strip1.reshape(-1, channels)[index]
+        pixels2 = strip2.reshape(-1, channels)[index]
+
+        if diff is not None or mask is not None:
+            difference = pixels2.astype(int16) - pixels1
+
+        if mask is not None:
+            mask[top:bottom] = 0
+            mask[top:bottom].reshape(-1)[index] = (luminance(abs(difference)) > threshold) * 255
+
+        if diff is not None:
+            # Added content takes precedence, otherwise fall back to the removed (or white) ramp
+            added = luminance(maximum(difference, 0))
+            removed = luminance(maximum(-difference, 0))
+            diff[top:bottom] = 255
+            diff[top:bottom].reshape(-1, diff_channels)[index] = lut[(added != 0) * (added + 256) + (added == 0) * removed]
+
+        if overlay is not None:
+            overlay[top:bottom].reshape(rows, width, overlay_channels)[:] = strip1
+            # A white pixel in array1 that has ink in array2 is always a changed pixel
+            red = (pixels1 == 255).all(axis=-1) & (pixels2 != 255).any(axis=-1)
+            overlay[top:bottom].reshape(-1, overlay_channels)[index[red]] = red_value
+
+def grid_labels(points, eps: float):
+    """
+    Groups (N, 2) points into clusters of points within eps of each other, directly or through other points of
+    the cluster, the same clusters as DBSCAN(eps=eps, min_samples=1). Points are binned into a grid of
+    eps / sqrt(2) cells so only points in neighbouring cells are ever compared, and cells are merged with a
+    vectorised union-find. Returns the cluster label of every point, with clusters numbered in the order of
+    their first point like the DBSCAN labels.
+    """
+    from math import sqrt
+    from numpy import (arange, argsort, concatenate, cumsum, empty, flatnonzero, floor, int64, lexsort, logical_or, maximum,
+                       minimum, repeat, searchsorted, stack, unique, zeros)
+    # Any two points in the same cell are within eps of each other
+    size = eps / sqrt(2)
+    cells = floor(points / size).astype(int64)
+    cells -= cells.min(axis=0)
+    # Cell keys leave room for the neighbour offsets on both sides of every row
+    rows = int(cells[:, 1].max()) + 5
+    keys = (cells[:, 0] + 2) * rows + cells[:, 1] + 2
+    order = argsort(keys, kind="stable")
+    cell_keys, starts, counts = unique(keys[order], return_index=True, return_counts=True)
+    cell_of = empty(len(points), dtype=int64)
+    cell_of[order] = repeat(arange(len(cell_keys)), counts)
+
+    # Neighbouring cells that can hold points within eps, each pair of cells is looked at once
+    offsets = [(dx, dy) for dx in range(0, 3) for dy in range(-2, 3)
+               if (dx > 0 or dy > 0) and (max(0, dx - 1) ** 2 + max(0, abs(dy) - 1) ** 2) * size * size <= eps * eps]
+    sources, targets = [], []
+    for dx, dy in offsets:
+        neighbours = cell_keys + dx * rows + dy
+        found = searchsorted(cell_keys, neighbours).clip(max=len(cell_keys) - 1)
+        present = cell_keys[found] == neighbours
+        sources.append(flatnonzero(present))
+        targets.append(found[present])
+    sources, targets = concatenate(sources), concatenate(targets)
+
+    # The points with the lowest and highest x and y of every cell
+    limit = eps * eps
+    ends = starts + counts - 1
+    extremes = []
+    for axis in (0, 1):
+        by_value = lexsort((points[:, axis], cell_of))
+        extremes += [by_value[starts], by_value[ends]]
+    extremes = stack(extremes, axis=1)
+
+    # Cells whose bounding boxes are too far apart can't hold a close pair. Between crowded cells, a close
+    # pair among the extreme points settles most of the rest. Only what is left is tested point by point.
+    corners = points[extremes]
+    low, high = corners.min(axis=1), corners.max(axis=1)
+    gaps = maximum(0, maximum(low[targets] - high[sources], low[sources] - high[targets]))
+    reachable = (gaps * gaps).sum(axis=-1) <= limit
+    close = zeros(len(sources), dtype=bool)
+    crowded = flatnonzero(reachable & (counts[sources] * counts[targets] > 16))
+    step = 1 << 16
+    for block in range(0, len(crowded), step):
+        pairs = crowded[block:block + step]
+        differences = corners[sources[pairs]][:, :, None, :] - corners[targets[pairs]][:, None, :, :]
+        close[pairs] = ((differences * differences).sum(axis=-1) <= limit).any(axis=(1, 2))
+    undecided = flatnonzero(reachable & ~close)
+
+    # Undecided cell pairs with few point pairs are tested all at once, crowded ones block by block
+    pairs = counts[sources[undecided]] * counts[targets[undecided]]
+    small = undecided[pairs <= 64]
+    pairs = counts[sources[small]] * counts[targets[small]]
+    if len(small):
+        pair_of = repeat(small, pairs)
+        boundaries = cumsum(pairs) - pairs
+        rank = arange(len(pair_of)) - repeat(boundaries, pairs)
+        first = order[starts[sources[pair_of]] + rank // counts[targets[pair_of]]]
+        second = order[starts[targets[pair_of]] + rank % counts[targets[pair_of]]]
+        differences = points[first] - points[second]
+        close[small] = logical_or.reduceat((differences * differences).sum(axis=-1) <= limit, boundaries)
+    for pair in undecided[counts[sources[undecided]] * counts[targets[undecided]] > 64].tolist():
+        members = order[starts[sources[pair]]:ends[sources[pair]] + 1]
+        others = order[starts[targets[pair]]:ends[targets[pair]] + 1]
+        close[pair] = _any_within(points[members], points[others], limit)
+    sources, targets = sources[close], targets[close]
+
+    # Union-find over the cells: the roots of both ends of every pair are hooked onto the lower one, then
+    # every cell jumps to its root, until no pair joins two roots
+    labels = arange(len(cell_keys))
+    while len(sources):
+        lowest = minimum(labels[sources], labels[targets])
+        merged = labels.copy()
+        minimum.at(merged, labels[sources], lowest)
+        minimum.at(merged, labels[targets], lowest)
+        while True:
+            jumped = merged[merged]
+            if (jumped == merged).all():
+                break
+            merged = jumped
+        if (merged == labels).all():
+            break
+        labels = merged
+
+    _, first_points, point_labels = unique(labels[cell_of], return_index=True, return_inverse=True)
+    numbers = empty(len(first_points), dtype=int64)
+    numbers[argsort(first_points)] = arange(len(first_points))
+    return numbers[point_labels]
+
+def contour_boxes(contours):
+    # The cv2.boundingRect of every contour as an (N, 4) array of x, y, w, h
+    from numpy import concatenate, cumsum, empty, int64, maximum, minimum, zeros
+    if not len(contours):
+        return empty((0, 4), dtype=int64)
+    points = concatenate(contours).reshape(-1, 2).astype(int64)
+    starts = zeros(len(contours), dtype=int64)
+    cumsum([len(contour) for contour in contours[:-1]], out=starts[1:])
+    low = minimum.reduceat(points, starts)
+    return concatenate([low, maximum.reduceat(points, starts) - low + 1], axis=1)
+
+def contour_areas(contours):
+    # The cv2.contourArea of every contour as an (N,) array, from the shoelace formula over all points at once
+    from numpy import add, arange, concatenate, cumsum, empty, float64, int64, zeros
+    if not len(contours):
+        return empty(0, dtype=float64)
+    points = concatenate(contours).reshape(-1, 2).astype(float64)
+    lengths = [len(contour) for contour in contours]
+    starts = zeros(len(contours), dtype=int64)
+    cumsum(lengths[:-1], out=starts[1:])
+    following = arange(1, len(points) + 1)
+    following[starts + lengths - 1] = starts
+    cross = points[:, 0] * points[following, 1] - points[following, 0] * points[:, 1]
+    return abs(add.reduceat(cross, starts)) / 2
+
+def _any_within(points1, points2, limit: float, block: int = 1 << 20) -> bool:
+    # Whether any pair of points from the two sets has a squared distance of at most limit, in blocks of pairs
+    rows = max(1, block // len(points2))
+    for start in range(0, len(points1), rows):
+        differences = points1[start:start + rows, None, :] - points2[None, :, :]
+        if ((differences * differences).sum(axis=-1) <= limit).any():
+            return True
+    return False
+
+class _TileRegions:
+    """
+    Collects the change mask of a page tile by tile and gives back the boxes and areas of the regions findContours
+    with RETR_EXTERNAL would find on the whole mask, or of its connected components. Changed pixels are labelled 8-connected (positive labels)
+    and unchanged pixels 4-connected (negative labels); labels touching across a seam are joined, and only
+    regions bordering the page edge or the background connected to it are kept, as regions sitting in a hole
+    of another region are not external.
+    """
+    def __init__(self, size: tuple[int, int]):
+        self.size = size
+        self.parents = {}
+        self.next_label = 1
+        self.pieces = []
+        self.edges = {}
+        self.pixels = {}
+        self.boxes = {}
+        self.adjacent = {}
+        self.border = {}
+
+    def find(self, label: int) -> int:
+        while self.parents.get(label, label) != label:
+            label = self.parents[label]
+        return label
+
+    def union(self, label1: int, label2: int):
+        root1, root2 = self.find(label1), self.find(label2)
+        if root1 != root2:
+            self.parents[max(root1, root2, key=abs)] = min(root1, root2, key=abs)
+
+    def count_adjacent(self, side1, side2):
+        # Counts neighbouring pixel pairs where one is changed and the other is not, by (changed, unchanged) label
+        from numpy import maximum, minimum, stack, unique
+        bordering = (side1 > 0) != (side2 > 0)
+        pairs, counts = unique(stack([maximum(side1[bordering], side2[bordering]), minimum(side1[bordering], side2[bordering])], axis=1), axis=0, return_counts=True)
+        for pair, count in zip(map(tuple, pairs.tolist()), counts.tolist()):
+            self.adjacent[pair] = self.adjacent.get(pair, 0) + count
+
+    def add(self, origin: tuple[int, int], mask):
+        from numpy import uint8, unique, where
+        from cv2 import findContours, contourArea, connectedComponentsWithStats, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE, CC_STAT_AREA
+        x0, y0 = origin
+        offset = self.next_label - 1
+        count, labels, stats, _ = connectedComponentsWithStats(mask, connectivity=8)
+        background_count, background, background_stats, _ = connectedComponentsWithStats((mask == 0).astype(uint8), connectivity=4)
+        labels = where(mask > 0, labels + offset, -(background + offset))
+        self.next_label += max(count, background_count)
+        for label in range(1, count):
+            self.pixels[label + offset] = int(stats[label, CC_STAT_AREA])
+            x, y, w, h = stats[label, :CC_STAT_AREA].tolist()
+            self.boxes[label + offset] = (x0 + x, y0 + y, x0 + x + w, y0 + y + h)
+        for label in range(1, background_count):
+            self.pixels[-(label + offset)] = int(background_stats[label, CC_STAT_AREA])
+        del background, stats, background_stats
+
+        contours, _ = findContours(mask, RETR_EXTERNAL, CHAIN_APPROX_SIMPLE)
+        for contour in contours:
+            self.pieces.append((int(labels[contour[0, 0, 1], contour[0, 0, 0]]), contour + (x0, y0), contourArea(contour)))
+        self.count_adjacent(labels[:, :-1], labels[:, 1:])
+        self.count_adjacent(labels[:-1], labels[1:])
+
+        top, bottom, left, right = labels[0].copy(), labels[-1].copy(), labels[:, 0].copy(), labels[:, -1].copy()
+        for side, on_border in ((top, y0 == 0), (bottom, y0 + len(left) == self.size[1]), (left, x0 == 0), (right, x0 + len(top) == self.size[0])):
+            if on_border:
+                for label, count in zip(*[values.tolist() for values in unique(side, return_counts=True)]):
+                    self.border[label] = self.border.get(label, 0) + count
+        self.edges[(x0, y0)] = (top, bottom, left, right)
+
+    def join(self, side1, side2):
+        from numpy import stack, unique
+        # Changed pixels are 8-connected to their neighbour across the seam and its two diagonals,
+        # unchanged pixels only to their direct neighbour
+        for shift in (-1, 0, 1):
+            a = side1[max(0, -shift):len(side1) - max(0, shift)]
+            b = side2[max(0, shift):len(side2) - max(0, -shift)]
+            touching = ((a > 0) & (b > 0)) | ((a < 0) & (b < 0) & (shift == 0))
+            for label1, label2 in unique(stack([a[touching], b[touching]], axis=1), axis=0).tolist():
+                self.union(label1, label2)
+            if shift == 0:
+                self.count_adjacent(a, b)
+
+    def regions(self, components: bool = False) -> tuple:
+        from numpy import array, concatenate, float64, int64
+        for (x, y), (top, bottom, left, right) in self.edges.items():
+            right_edges = self.edges.get((x + len(top), y))
+            below_edges = self.edges.get((x, y + len(left)))
+            if right_edges is not None:
+                self.join(right, right_edges[2])
+            if below_edges is not None:
+                self.join(bottom, below_edges[0])
+            # Tiles only meeting at a corner touch through a single diagonal pixel pair
+            below_right_edges = self.edges.get((x + len(top), y + len(left)))
+            if below_right_edges is not None:
+                self.join(bottom[-1:], below_right_edges[0][:1])
+            if right_edges is not None and below_edges is not None:
+                self.join(right_edges[1][:1], below_edges[0][-1:])
+
+        if components:
+            boxes, areas = {}, {}
+            for label, (x0, y0, x1, y1) in self.boxes.items():
+                root = self.find(label)
+                box = boxes.get(root, (x0, y0, x1, y1))
+                boxes[root] = (min(box[0], x0), min(box[1], y0), max(box[2], x1), max(box[3], y1))
+                areas[root] = areas.get(root, 0) + self.pixels[label]
+            return (array([(x0, y0, x1 - x0, y1 - y0) for x0, y0, x1, y1 in boxes.values()], dtype=int64).reshape(-1, 4),
+                    array(list(areas.values()), dtype=float64))
+
+        outside = {self.find(label) for label in self.border if label < 0}
+        pixels = {}
+        for label, count in self.pixels.items():
+            pixels[self.find(label)] = pixels.get(self.find(label), 0) + count
+        neighbours = {}
+        boundary = {self.find(label): count for label, count in self.border.items() if label > 0}
+        for (label1, label2), count in self.adjacent.items():
+            root1, root2 = self.find(label1), self.find(label2)
+            neighbours.setdefault(root1, set()).add(root2)
+            neighbours.setdefault(root2, set()).add(root1)
+            if root2 in outside:
+                boundary[root1] = boundary.get(root1, 0) + count
+        external = set(boundary)
+
+        pieces = {}
+        areas = {}
+        for label, points, area in self.pieces:
+            root = self.find(label)
+            if root in external:
+                pieces.setdefault(root, []).append(points)
+                areas[root] = areas.get(root, 0) + area
+
+        for root in pieces:
+            if len(pieces[root]) > 1:
+                # Regions cut by a seam get the area their outer contour would enclose from Pick's theorem,
+                # the pixels of the region and everything nested in its holes less half its outer boundary
+                filled = 0
+                visited = {root}
+                queue = [root]
+                while queue:
+                    label = queue.pop()
+                    filled += pixels.get(label, 0)
+                    for neighbour in neighbours.get(label, ()):
+                        if neighbour not in visited and neighbour not in outside and neighbour not in external:
+                            visited.add(neighbour)
+                            queue.append(neighbour)
+                areas[root] = max(0, filled - boundary[root] / 2 - 1)
+        return (contour_boxes([concatenate(pieces[root]) if len(pieces[root]) > 1 else pieces[root][0] for root in pieces]),
+                array([areas[root] for root in pieces], dtype=float64))
+
+class ComparisonAssembler:
+    """
+    Streams the comparison PDF to output_path. The first page is reserved for the statistics and encoded layer
+    pages are appended with their ToC entries as they arrive. At least every checkpoint_interval seconds the file
+    is brought up to date with an incremental save and reopened, so pages already written are dropped from memory
+    and an interrupted run still leaves a readable PDF of every page done up to the last checkpoint.
+    """
+    def __init__(self, output_path: str, checkpoint_interval: float = 10):
+        import fitz
+        self.output_path = output_path
+        self.checkpoint_interval = checkpoint_interval
+        self.toc = [[1, "Statistics", 1]]
+        document = fitz.open()
+        document.new_page().insert_text((72, 72), "Comparison in progress, statistics are added here once it finishes.", fontsize=11, fontname="helv")
+        document.save(output_path)
+        document.close()
+        self.document = fitz.open(output_path)
+        self.last_checkpoint = perf_counter()
+
+    def __enter__(self) -> ComparisonAssembler:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_page_group(self, page_num: int, encoded_pages: list[bytes], layer_names: list[str]):
+        import fitz
+        for encoded_page, layer_name in zip(encoded_pages, layer_names):
+            with fitz.open("pdf", encoded_page) as layer:
+                self.document.insert_pdf(layer, links=False)
+            self.toc.append([1, f"{layer_name} - Page {page_num + 1}", self.document.page_count])
+        # Fonts and images MuPDF cached for pages already done would otherwise build up to its store limit
+        fitz.TOOLS.store_shrink(100)
+        if perf_counter() - self.last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # MuPDF reads the whole file back on every incremental save, which is why this is rate limited
+        import fitz
+        self.document.set_toc(self.toc)
+        self.document.saveIncr()
+        self.document.close()
+        self.document = fitz.open(self.output_path)
+        self.last_checkpoint = perf_counter()
+
+    def add_statistics(self, stats_doc: fitz.Document):
+        # The statistics take the place of the reserved first page, pushing the layers back if they need more than one
+        with stats_doc:
+            self.document.delete_page(0)
+            self.document.insert_pdf(stats_doc, start_at=0, links=False)
+            self.toc = self.toc[:1] + [[level, title, page + stats_doc.page_count - 1] for level, title, page in self.toc[1:]]
+
+    def close(self):
+        if self.document is not None:
+            self.checkpoint()
+            self.document.close()
+            self.document = None
+
+class RenderCache:
+    """
+    Content addressed store of rendered pages, shared by every run (and worker) pointed at the same directory.
+    Entries are LZW compressed TIFFs; reading one refreshes its modification time, and the least recently
+    used entries are evicted once the directory grows past max_bytes.
+    """
+    VERSION = 2
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        makedirs(directory, exist_ok=True)
+        self.size = sum(entry[2] for entry in self._entries())
+
+    def key(self, doc_hash: str, page_number: int, dpi: int, colorspace: str, target_size: tuple[int, int] | None) -> str:
+        return sha256(f"{self.VERSION}|{doc_hash}|{page_number}|{dpi}|{colorspace}|{target_size}".encode()).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return path.join(self.directory, key[:2], f"{key}.tiff")
+
+    def _entries(self) -> list[tuple[float, str, int]]:
+        entries = []
+        for root, _, filenames in walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".tiff"):
+                    file_path = path.join(root, filename)
+                    try:
+                        stat_result = stat(file_path)
+                    except OSError:
+                        continue
+                    entries.append((stat_result.st_mtime, file_path, stat_result.st_size))
+        return entries
+
+    def get(self, key: str) -> Image.Image | None:
+        from PIL import Image
+        file_path = self._path(key)
+        try:
+            with Image.open(file_path) as cached:
+                image = cached.copy()
+            utime(file_path)
+        except (OSError, SyntaxError):
+            return None
+        return image
+
+    def put(self, key: str, image: Image.Image):
+        file_path = self._path(key)
+        makedirs(path.dirname(file_path), exist_ok=True)
+        # Write then rename so concurrent workers never read a partial entry
+        temp_path = f"{file_path}.{getpid()}.tmp"
+        image.save(temp_path, format="TIFF", compression="tiff_lzw")
+        replace(temp_path, file_path)
+        self.size += path.getsize(file_path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries())
+        self.size = sum(entry[2] for entry in entries)
+        for _, file_path, file_size in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                remove(file_path)
+            except OSError:
+                continue
+            self.size -= file_size
+
+_document_hashes = {}
+
+def document_hash(file_path: str) -> str:
+    # Hashes the file contents once per (path, size, modification time)
+    file_stat = stat(file_path)
+    identity = (path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns)
+    if identity not in _document_hashes:
+        digest = sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        _document_hashes[identity] = digest.hexdigest()
+    return _document_hashes[identity]
+
+_OBJECT_REFERENCE = re.compile(r"(\d+)\s+(\d+)\s+R\b")
+_BACK_REFERENCE = re.compile(r"/(?:Parent|P)\s+\d+\s+\d+\s+R\b")
+
+def _object_fingerprint(doc: fitz.Document, xref: int, fingerprints: dict) -> str:
+    # Hashes an object with every indirect reference replaced by the hash of its target, so identical
+    # content hashes the same even when the two files number their objects differently. References to other
+    # pages (link destinations in /Annots, /Dest, /A or /D) hash as a placeholder rather than as the page, so an
+    # edit on one page doesn't change every page that links to it. Objects are walked with a stack, as a
+    # chain of references can be as long as the document.
+    if xref in fingerprints:
+        return fingerprints[xref]
+    if "pages" not in fingerprints:
+        fingerprints["pages"] = {doc.page_xref(number) for number in range(doc.page_count)}
+    pages = fingerprints["pages"]
+    sources = {}
+    stack = [xref]
+    while stack:
+        current = stack[-1]
+        if current in sources:
+            stack.pop()
+            source = _OBJECT_REFERENCE.sub(lambda match: "page" if int(match.group(1)) in pages else fingerprints[int(match.group(1))],
+                                           sources.pop(current))
+            digest = sha256(source.encode())
+            if doc.xref_is_stream(current):
+                digest.update(doc.xref_stream_raw(current) or b"")
+            fingerprints[current] = digest.hexdigest()
+        elif current in fingerprints:
+            # Reached again through another reference after it was hashed
+            stack.pop()
+        else:
+            # Objects still on the stack hash as "cycle" when referenced again
+            fingerprints[current] = "cycle"
+            sources[current] = _BACK_REFERENCE.sub("", doc.xref_object(current, compressed=True))
+            targets = [int(match.group(1)) for match in _OBJECT_REFERENCE.finditer(sources[current])]
+            stack.extend(target for target in reversed(targets) if target not in fingerprints and target not in pages)
+    return fingerprints[xref]
+
+def page_fingerprint(doc: fitz.Document, page_number: int, fingerprints: dict) -> str:
+    """
+    Fingerprints a page from its content streams and every resource it references, without rendering it.
+    fingerprints caches object hashes and should be shared between pages of the same document.
+    """
+    page = doc.load_page(page_number)
+    digest = sha256(f"{tuple(page.rect)} {page.rotation}".encode())
+    digest.update(_object_fingerprint(doc, page.xref, fingerprints).encode())
+    # Resources can be inherited from the page tree
+    xref = page.xref
+    while doc.xref_get_key(xref, "Resources")[0] == "null":
+        kind, parent = doc.xref_get_key(xref, "Parent")
+        if kind != "xref":
+            break
+        xref = int(parent.split()[0])
+        kind, resources = doc.xref_get_key(xref, "Resources")
+        if kind == "xref":
+            digest.update(_object_fingerprint(doc, int(resources.split()[0]), fingerprints).encode())
+        elif kind == "dict":
+            digest.update(_OBJECT_REFERENCE.sub(lambda match: _object_fingerprint(doc, int(match.group(1)), fingerprints), resources).encode())
+    return digest.hexdigest()
+
+def perceptual_hash(page: fitz.Page) -> list[bool]:
+    """
+    Hashes what a page looks like: the lowest PAGE_HASH_SIZE x PAGE_HASH_SIZE DCT frequencies of a small grayscale
+    thumbnail, each compared with their median. Pages that look alike differ in few bits, unrelated pages in about half.
+    """
+    import fitz
+    from numpy import asarray, float32, median
+    from PIL import Image
+    from cv2 import dct
+    size = PAGE_HASH_SIZE * 4
+    pix = page.get_pixmap(matrix=fitz.Matrix(size / page.rect.width, size / page.rect.height), colorspace=fitz.csGRAY, alpha=False)
+    thumbnail = Image.frombytes("L", (pix.width, pix.height), pix.samples_mv)
+    if thumbnail.size != (size, size):
+        thumbnail = thumbnail.resize((size, size), Image.Resampling.BOX)
+    frequencies = dct(asarray(thumbnail, dtype=float32))[:PAGE_HASH_SIZE, :PAGE_HASH_SIZE].flatten()
+    # The first frequency is the average brightness, which would skew the median
+    return (frequencies > median(frequencies[1:])).tolist()
+
+def match_sequences(distances: list[list[float]], gap: float) -> list[tuple[int | None, int | None]]:
+    """
+    Aligns two sequences from the distances between each of their items (Needleman-Wunsch), leaving an item without
+    a partner costs gap. Returns the (index1, index2) pairs in order, None on the side of an item left without a
+    partner. At equal cost items are paired rather than left out.
+    """
+    rows, columns = len(distances), len(distances[0]) if distances else 0
+    costs = [[column * gap for column in range(columns + 1)]]
+    for row in range(1, rows + 1):
+        previous, current = costs[-1], [row * gap]
+        for column in range(1, columns + 1):
+            current.append(min(previous[column - 1] + distances[row - 1][column - 1], previous[column] + gap, current[column - 1] + gap))
+        costs.append(current)
+
+    pairs = []
+    row, column = rows, columns
+    while row or column:
+        if row and column and costs[row][column] == costs[row - 1][column - 1] + distances[row - 1][column - 1]:
+            row, column = row - 1, column - 1
+            pairs.append((row, column))
+        elif row and costs[row][column] == costs[row - 1][column] + gap:
+            row -= 1
+            pairs.append((row, None))
+        else:
+            column -= 1
+            pairs.append((None, column))
+    return pairs[::-1]
+
+def _rounded(values, tolerance: float) -> tuple:
+    return tuple(round(value / tolerance) for value in values)
+
+def _rounded_color(color) -> tuple | None:
+    return tuple(round(value, 3) for value in color) if color is not None else None
+
+def page_primitives(page: fitz.Page, tolerance: float) -> list[tuple[tuple, fitz.Rect]]:
+    """
+    Lists the drawing paths, text spans and images of a page as (shape, rect) pairs, rect being the bounding
+    box in PDF coordinates. shape describes everything but the position, relative to the top left of rect and
+    rounded to tolerance points, so two primitives with the same shape only differ by where they sit on the page.
+    """
+    import fitz
+    primitives = []
+    for drawing in page.get_drawings():
+        rect = drawing["rect"]
+        coordinates = []
+        for item in drawing["items"]:
+            for value in item[1:]:
+                if isinstance(value, fitz.Quad):
+                    coordinates.extend(tuple(value.ul) + tuple(value.ur) + tuple(value.ll) + tuple(value.lr))
+                elif isinstance(value, (fitz.Point, fitz.Rect)):
+                    coordinates.extend(value)
+        # Coordinates alternate x, y
+        relative = [value - (rect.x0 if index % 2 == 0 else rect.y0) for index, value in enumerate(coordinates)]
+        style = (drawing["type"], _rounded_color(drawing.get("color")), _rounded_color(drawing.get("fill")), round(drawing.get("width") or 0, 2),
+                 drawing.get("dashes"), drawing.get("closePath"), drawing.get("even_odd"), drawing.get("fill_opacity"), drawing.get("stroke_opacity"))
+        primitives.append((("path", style, tuple(item[0] for item in drawing["items"]), _rounded(relative, tolerance)), rect))
+
+    # Image blocks carry the image data, images are listed from get_image_info instead
+    for block in page.get_text("rawdict", flags=fitz.TEXTFLAGS_RAWDICT & ~fitz.TEXT_PRESERVE_IMAGES)["blocks"]:
+        for line in block.get("lines", []):
+            for span in line["spans"]:
+                text = "".join(char["c"] for char in span["chars"])
+                if not text.strip():
+                    continue
+                rect = fitz.Rect(span["bbox"])
+                primitives.append((("text", text, span["font"], round(span["size"], 2), span["color"], span["flags"],
+                                    _rounded((rect.width, rect.height), tolerance)), rect))
+
+    for image in page.get_image_info(hashes=True):
+        rect = fitz.Rect(image["bbox"])
+        primitives.append((("image", image["digest"], _rounded((rect.width, rect.height), tolerance)), rect))
+    return primitives
+
+class _SpatialIndex:
+    """
+    Grid of the items of each shape by position, for finding the nearest item of a shape to a point
+    without looking at every item of that shape.
+    """
+    def __init__(self, cell_size: float):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.bounds = {}
+
+    def insert(self, shape: tuple, x: float, y: float, item):
+        cell = (int(x // self.cell_size), int(y // self.cell_size))
+        self.cells.setdefault(shape, {}).setdefault(cell, []).append((x, y, item))
+        bounds = self.bounds.setdefault(shape, [cell[0], cell[1], cell[0], cell[1]])
+        bounds[:] = min(bounds[0], cell[0]), min(bounds[1], cell[1]), max(bounds[2], cell[0]), max(bounds[3], cell[1])
+
+    def pop_nearest(self, shape: tuple, x: float, y: float, max_distance: float | None = None):
+        # Removes and returns the item of shape closest to (x, y), None if there is none within max_distance
+        cells = self.cells.get(shape)
+        if not cells:
+            return None
+        column, row = int(x // self.cell_size), int(y // self.cell_size)
+        bounds = self.bounds[shape]
+        rings = max(column - bounds[0], bounds[2] - column, row - bounds[1], bounds[3] - row)
+        best = None
+        for ring in range(rings + 1):
+            # Nothing in this ring or beyond can be closer than the best match or within max_distance
+            reach = (ring - 1) * self.cell_size
+            if (best is not None and reach * reach > best[0]) or (max_distance is not None and reach > max_distance):
+                break
+            if 8 * ring > len(cells):
+                candidates = list(cells)
+            elif ring == 0:
+                candidates = [(column, row)]
+            else:
+                candidates = [(column + dx, row + dy) for dx in range(-ring, ring + 1) for dy in (-ring, ring)]
+                candidates += [(column + dx, row + dy) for dx in (-ring, ring) for dy in range(-ring + 1, ring)]
+            for cell in candidates:
+                for index, (item_x, item_y, _) in enumerate(cells.get(cell, ())):
+                    distance = (item_x - x) ** 2 + (item_y - y) ** 2
+                    if (max_distance is None or distance <= max_distance * max_distance) and (best is None or distance < best[0]):
+                        best = (distance, cell, index)
+            if 8 * ring > len(cells):
+                break
+        if best is None:
+            return None
+        _, cell, index = best
+        _, _, item = cells[cell].pop(index)
+        if not cells[cell]:
+            del cells[cell]
+        return item
+
+    def items(self) -> list:
+        return [item for cells in self.cells.values() for entries in cells.values() for _, _, item in entries]
+
+def vector_changes(old_page: fitz.Page | None, new_page: fitz.Page | None, tolerance: float) -> tuple[list, list, list]:
+    """
+    Matches the primitives of two revisions of a page without rendering them. Returns (added, removed, moved):
+    bounding boxes on new_page of primitives only found there, bounding boxes on old_page of primitives only
+    found there, and (old box, new box) pairs of primitives that only changed position. Primitives of the same
+    shape within tolerance points of each other are unchanged, a missing page has no primitives.
+    """
+    old = page_primitives(old_page, tolerance) if old_page is not None else []
+    new = page_primitives(new_page, tolerance) if new_page is not None else []
+    index = _SpatialIndex(max(16.0, tolerance))
+    for number, (shape, rect) in enumerate(new):
+        index.insert(shape, rect.x0, rect.y0, number)
+
+    unmatched = [(shape, rect) for shape, rect in old if index.pop_nearest(shape, rect.x0, rect.y0, tolerance) is None]
+    removed = []
+    moved = []
+    for shape, rect in unmatched:
+        number = index.pop_nearest(shape, rect.x0, rect.y0)
+        if number is None:
+            removed.append(rect)
+        else:
+            moved.append((rect, new[number][1]))
+    added = [new[number][1] for number in sorted(index.items())]
+    return added, removed, moved
+
+def document_words(doc: fitz.Document) -> list[tuple]:
+    # Every word of the document in reading order as (page_num, x0, y0, x1, y1, text, (block, line))
+    words = []
+    for page_num in range(doc.page_count):
+        for x0, y0, x1, y1, text, block, line, _ in doc.load_page(page_num).get_text("words", sort=True):
+            words.append((page_num, x0, y0, x1, y1, text, (block, line)))
+    return words
+
+def _middle_snake(a, a_start: int, a_end: int, b, b_start: int, b_end: int) -> tuple[int, int] | None:
+    # Myers' forward and reverse searches run until they overlap, which happens on an optimal edit path.
+    # Only the furthest reaching x of every diagonal is kept, so memory is linear in the length of the ranges.
+    n, m = a_end - a_start, b_end - b_start
+    max_d = (n + m + 1) // 2
+    offset = max_d + 1
+    forward = [-1] * (2 * offset + 1)
+    reverse = [-1] * (2 * offset + 1)
+    forward[offset + 1] = 0
+    reverse[offset + 1] = 0
+    delta = n - m
+    odd = delta % 2 != 0
+    # Diagonals trimmed off either end once they run past the ranges
+    forward_start = forward_end = reverse_start = reverse_end = 0
+    for d in range(max_d):
+        for k in range(-d + forward_start, d + 1 - forward_end, 2):
+            if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                x = forward[offset + k + 1]
+            else:
+                x = forward[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_start + x] == b[b_start + y]:
+                x += 1
+                y += 1
+            forward[offset + k] = x
+            if x > n:
+                forward_end += 2
+            elif y > m:
+                forward_start += 2
+            elif odd:
+                # The reverse search counts from the ends, its diagonal delta - k is this one
+                reverse_x = reverse[offset + delta - k] if 0 <= offset + delta - k < len(reverse) else -1
+                if reverse_x != -1 and x >= n - reverse_x:
+                    return a_start + x, b_start + y
+        for k in range(-d + reverse_start, d + 1 - reverse_end, 2):
+            if k == -d or (k != d and reverse[offset + k - 1] < reverse[offset + k + 1]):
+                x = reverse[offset + k + 1]
+            else:
+                x = reverse[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_end - x - 1] == b[b_end - y - 1]:
+                x += 1
+                y += 1
+            reverse[offset + k] = x
+            if x > n:
+                reverse_end += 2
+            elif y > m:
+                reverse_start += 2
+            elif not odd:
+                forward_x = forward[offset + delta - k] if 0 <= offset + delta - k < len(forward) else -1
+                if forward_x != -1 and forward_x >= n - x:
+                    return a_start + forward_x, b_start + forward_x - (delta - k)
+    return None
+
+def _unique_anchors(a, a_start: int, a_end: int, b, b_start: int, b_end: int) -> list[tuple[int, int]]:
+    # Items found exactly once in both ranges, keeping the longest run of them that is in the same order in
+    # both (patience sorting), these always line up and split a long diff into short independent ones
+    from bisect import bisect_left
+    counts = {}
+    for index in range(a_start, a_end):
+        count = counts.get(a[index])
+        counts[a[index]] = [index, None, 1] if count is None else [count[0], None, count[2] + 1]
+    for index in range(b_start, b_end):
+        count = counts.get(b[index])
+        if count is not None:
+            count[1] = index if count[1] is None else -1
+    pairs = sorted((i, j) for i, j, total in counts.values() if total == 1 and j is not None and j >= 0)
+    tails = []
+    tail_pairs = []
+    previous = {}
+    for pair in pairs:
+        position = bisect_left(tails, pair[1])
+        previous[pair] = tail_pairs[position - 1] if position else None
+        if position == len(tails):
+            tails.append(pair[1])
+            tail_pairs.append(pair)
+        else:
+            tails[position] = pair[1]
+            tail_pairs[position] = pair
+    anchors = []
+    pair = tail_pairs[-1] if tail_pairs else None
+    while pair is not None:
+        anchors.append(pair)
+        pair = previous[pair]
+    return anchors[::-1]
+
+def sequence_changes(a: list, b: list) -> list[tuple[int, int, int, int]]:
+    """
+    Diffs two sequences of hashable items. Returns the (a_start, a_end, b_start, b_end) ranges, in order, where
+    a[a_start:a_end] was replaced by b[b_start:b_end], either range may be empty. Long inputs are first split on
+    items that are unique in both, what is left is diffed with Myers' linear space algorithm.
+    """
+    # Compare small integers instead of the items themselves
+    ids = {}
+    a = [ids.setdefault(item, len(ids)) for item in a]
+    b = [ids.setdefault(item, len(ids)) for item in b]
+    changes = []
+    stack = [(0, len(a), 0, len(b), True)]
+    while stack:
+        a_start, a_end, b_start, b_end, anchor = stack.pop()
+        # Common prefix and suffix
+        while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+            a_start += 1
+            b_start += 1
+        while a_start < a_end and b_start < b_end and a[a_end - 1] == b[b_end - 1]:
+            a_end -= 1
+            b_end -= 1
+        if a_start == a_end or b_start == b_end:
+            if a_start != a_end or b_start != b_end:
+                changes.append((a_start, a_end, b_start, b_end))
+            continue
+
+        anchors = _unique_anchors(a, a_start, a_end, b, b_start, b_end) if anchor else []
+        if anchors:
+            # Stacked in reverse so ranges come off in order
+            bounds = [(a_start - 1, b_start - 1)] + anchors + [(a_end, b_end)]
+            for (i1, j1), (i2, j2) in reversed(list(zip(bounds, bounds[1:]))):
+                stack.append((i1 + 1, i2, j1 + 1, j2, True))
+            continue
+
+        split = _middle_snake(a, a_start, a_end, b, b_start, b_end)
+        if split is None or split == (a_start, b_start) or split == (a_end, b_end):
+            changes.append((a_start, a_end, b_start, b_end))
+            continue
+        stack.append((split[0], a_end, split[1], b_end, False))
+        stack.append((a_start, split[0], b_start, split[1], False))
+
+    # Neighbouring ranges are reported as one change
+    merged = []
+    for change in sorted(changes):
+        if merged and merged[-1][1] == change[0] and merged[-1][3] == change[2]:
+            merged[-1] = (merged[-1][0], change[1], merged[-1][2], change[3])
+        else:
+            merged.append(change)
+    return merged
+
+def pool_results(pool, function, tasks, window: int):
+    """
+    Yields function(task) for every task in order, computed on pool with at most window tasks submitted at a time,
+    so a comparison that stops early only leaves those behind on a pool that is kept running.
+    """
+    from collections import deque
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.apply_async(function, (task,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# Each worker process keeps its comparison state and open documents between tasks
+_worker_jobs = {}
+
+def _compare_page_worker(task: tuple) -> tuple[list[bytes], dict]:
+    import fitz
+    files, options, page_size, plan, page_pairs, identical_pages, page_num, text_changes = task
+    job = (files, options, page_size, plan, page_pairs, identical_pages)
+    if job not in _worker_jobs:
+        for comparer, doc1, doc2 in _worker_jobs.values():
+            doc1.close()
+            doc2.close()
+        _worker_jobs.clear()
+        comparer = Comparer(options=list(options))
+        comparer.PAGE_SIZE = page_size
+        comparer.TILE_SIZE, comparer.STRIP_PIXELS = plan
+        comparer.page_pairs = list(page_pairs)
+        comparer.identical_pages = set(identical_pages)
+        _worker_jobs[job] = (comparer, *comparer.open_documents(list(files)))
+    comparer, doc1, doc2 = _worker_jobs[job]
+    # Text changes are found across the whole document up front, workers only get the ones for their page
+    comparer.text_changes = {page_num: text_changes} if text_changes is not None else {}
+    result = comparer.compare_page(page_num, doc1, doc2)
+    fitz.TOOLS.store_shrink(100)
+    return result
+
+def _prepare_worker(task: tuple) -> tuple | str:
+    # Prepares one pair of a batch (see Comparer.prepare), returns the error message instead if it can't be
+    files, options = task
+    comparer = Comparer(options=list(options))
+    try:
+        doc1, doc2 = comparer.open_documents(list(files))
+        with doc1, doc2:
+            comparer.prepare(list(files), doc1, doc2)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return comparer.PAGE_SIZE, (comparer.TILE_SIZE, comparer.STRIP_PIXELS), comparer.page_pairs, sorted(comparer.identical_pages), comparer.text_changes, comparer.statistics
+
+def _batch_page_worker(task: tuple) -> tuple[list[bytes] | None, dict | str]:
+    # A page that fails only fails its own pair, not the whole batch, see Comparer.merged_pages
+    try:
+        return _compare_page_worker(task)
+    except Exception as e:
+        return None, f"Page {task[6]+1}: {type(e).__name__}: {e}"
+
+BATCH_INDEX_COLUMNS = ["New file", "Old file", "Comparison file", "Pages", "Pages with differences", "Total differences",
+                       "Inserted pages", "Removed pages", "Identical pages", "Status"]
+
+def _is_comparison_file(file_path: str) -> bool:
+    return re.search(r" Comparison( Rev \d+)?\.pdf$", file_path, re.IGNORECASE) is not None
+
+def folder_pairs(folder1: str, folder2: str) -> tuple[list[tuple[str, str]], list[tuple[str | None, str | None]]]:
+    """
+    Pairs the PDFs of two folders (and their subfolders) by their path relative to the folder, ignoring case.
+    Comparison files written by an earlier run are left out.
+    Returns the (new, old) pairs and the (new, None) or (None, old) files only one folder has.
+    """
+    def pdfs(folder: str) -> dict[str, str]:
+        found = {}
+        for root, _, names in walk(folder):
+            for name in names:
+                file_path = path.join(root, name)
+                if name.lower().endswith(".pdf") and not _is_comparison_file(file_path):
+                    found[path.relpath(file_path, folder).replace("\\", "/").lower()] = file_path.replace("\\", "/")
+        return found
+
+    files1 = pdfs(folder1)
+    files2 = pdfs(folder2)
+    pairs = [(files1[key], files2[key]) for key in sorted(files1) if key in files2]
+    unpaired = [(files1[key], None) for key in sorted(files1) if key not in files2]
+    unpaired += [(None, files2[key]) for key in sorted(files2) if key not in files1]
+    return pairs, unpaired
+
+def manifest_pairs(manifest: str) -> list[tuple[str, str]]:
+    """
+    Reads (new, old) pairs from a CSV file with one pair per row. Relative paths are relative to the manifest's folder,
+    empty rows and rows starting with # are skipped.
+    """
+    import csv
+    folder = path.dirname(path.abspath(manifest))
+    pairs = []
+    with open(manifest, newline="", encoding="utf-8-sig") as file:
+        for row in csv.reader(file):
+            row = [value.strip() for value in row]
+            if not any(row) or row[0].startswith("#"):
+                continue
+            if len(row) < 2:
+                raise ValueError(f"Manifest row needs a new and an old file: {row}")
+            pairs.append(tuple(path.join(folder, value).replace("\\", "/") for value in row[:2]))
+    return pairs
+
+def write_index(index_path: str, rows: list[list]):
+    """
+    Writes the rows of a batch comparison as a CSV file with BATCH_INDEX_COLUMNS.
+    """
+    import csv
+    with open(index_path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(BATCH_INDEX_COLUMNS)
+        writer.writerows(rows)
+
+def _peak_memory() -> float | None:
+    # Peak resident memory of this process in MB, None where there is no resource module (Windows)
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+@contextmanager
+def profile_span(events: list, name: str, page_num: int | None = None):
+    """
+    Appends a Chrome trace event for the code it wraps to events, with its start and duration in microseconds, its
+    process and thread, the worker process and page (if any), and how many MB it raised the peak memory of the
+    process by. Spans nest by time, so a stage's time includes the stages inside it.
+    """
+    peak = _peak_memory()
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        end = perf_counter()
+        args = {"worker": current_process().name}
+        if page_num is not None:
+            args["page"] = page_num + 1
+        if peak is not None:
+            args["peak_mb"] = round(_peak_memory() - peak, 1)
+        events.append({"name": name, "cat": "stage", "ph": "X", "ts": round(start * 1e6, 1), "dur": round((end - start) * 1e6, 1),
+                       "pid": getpid(), "tid": get_native_id(), "args": args})
+
+def profile_path(output_path: str) -> str:
+    """
+    Path of the trace file written next to a comparison file (or batch index) when profiling.
+    """
+    return f"{path.splitext(output_path)[0]} Profile.json"
+
+def write_trace(trace_path: str, events: list[dict]):
+    """
+    Writes events as a Chrome trace file (chrome://tracing, or ui.perfetto.dev), with every process named after its
+    worker.
+    """
+    import json
+    names = {event["pid"]: event["args"]["worker"] for event in events}
+    metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}} for pid, name in names.items()]
+    with open(trace_path, "w", encoding="utf-8") as file:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, file)
+
+def profile_summary(events: list[dict]) -> list[str]:
+    """
+    Lines of a table of the calls, total, mean and longest time and the peak memory added (summed over calls) of
+    every stage in events, slowest first. Shares are of the time from the first span to the last, stages in workers
+    running side by side can add up to more.
+    """
+    if not events:
+        return ["Profile: no stages recorded."]
+    stages = {}
+    for event in events:
+        stage = stages.setdefault(event["name"], [0, 0.0, 0.0, 0.0])
+        stage[0] += 1
+        stage[1] += event["dur"] / 1e6
+        stage[2] = max(stage[2], event["dur"] / 1e6)
+        stage[3] += event["args"].get("peak_mb", float("nan"))
+    run_time = (max(event["ts"] + event["dur"] for event in events) - min(event["ts"] for event in events)) / 1e6
+    lines = ["Profile (seconds, the time of a stage includes the stages inside it):",
+             f"    {'Stage':<24}{'Calls':>6}{'Total':>9}{'Share':>8}{'Mean':>9}{'Max':>9}{'Peak MB':>9}"]
+    for name, (calls, total, longest, peak) in sorted(stages.items(), key=lambda item: item[1][1], reverse=True):
+        peak = f"{peak:+9.0f}" if peak == peak else f"{'-':>9}"
+        lines.append(f"    {name:<24}{calls:>6}{total:9.3f}{100 * total / max(run_time, 1e-9):7.0f}%{total / calls:9.3f}{longest:9.3f}{peak}")
+    lines.append(f"Run time: {run_time:.3f}")
+    return lines
+
+class _ImportProfiler(MetaPathFinder):
+    # Times top level imports (including everything they import in turn) for --startup-profile
+    def __init__(self):
+        self.start_time = perf_counter()
+        self.import_times = {}
+        self.total_import_time = 0.0
+        self.active_imports = 0
+
+    @classmethod
+    def install(cls) -> _ImportProfiler:
+        profiler = cls()
+        sys.meta_path.insert(0, profiler)
+        return profiler
+
+    def find_spec(self, fullname, path=None, target=None):
+        if "." in fullname:
+            return None
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+            spec.loader = _TimedLoader(spec.loader, fullname, self)
+        return spec
+
+    def report(self):
+        sys.meta_path.remove(self)
+        print("Import profile (cumulative seconds, imports under 1 ms omitted):")
+        for name, seconds in sorted(self.import_times.items(), key=lambda item: item[1], reverse=True):
+            if seconds >= 0.001:
+                print(f"    {name:<24}{seconds:8.3f}")
+        print(f"Total import time: {self.total_import_time:.3f}")
+        print(f"Total run time: {perf_counter() - self.start_time:.3f}")
+
+class _TimedLoader:
+    def __init__(self, loader, name: str, profiler: _ImportProfiler):
+        self.loader = loader
+        self.name = name
+        self.profiler = profiler
+
+    def __getattr__(self, attribute):
+        return getattr(self.loader, attribute)
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        start = perf_counter()
+        self.profiler.active_imports += 1
+        try:
+            self.loader.exec_module(module)
+        finally:
+            self.profiler.active_imports -= 1
+            elapsed = perf_counter() - start
+            self.profiler.import_times[self.name] = elapsed
+            if self.profiler.active_imports == 0:
+                self.profiler.total_import_time += elapsed
+
+COMPARE_MODES = ("RASTER", "VECTOR", "TEXT")
+
+REGION_METHODS = ("CONTOURS", "COMPONENTS")
+
+# Pages are matched on perceptual hashes of PAGE_HASH_SIZE squared bits. Leaving a page unmatched costs
+# PAGE_MATCH_GAP, so two pages stay paired unless more than twice that fraction of their bits differ (revisions of
+# a page differ in 5-20% of them, unrelated pages in about half)
+PAGE_HASH_SIZE = 16
+PAGE_MATCH_GAP = 0.25
+
+ALIGN_MODES = ("NONE", "SHIFT", "SCALE")
+# Alignment is estimated on renders this many pixels across and refined on windows this size at full resolution,
+# fitting the squared differences at these steps. It is only trusted above this phase correlation response, and
+# only for scales within these log ratios (about 0.1% to 5%, smaller scales are below what the estimate resolves).
+# Pages that are off by less than the smallest scale and shift (in pixels, below the noise of the estimate) are left
+# as they are, and so are pages where the alignment doesn't bring the squared differences of the refined window
+# under ALIGN_MIN_GAIN of those of the pages as they are.
+ALIGN_PREVIEW_SIZE = 1024
+ALIGN_WINDOW = 1024
+ALIGN_STEPS = (0.5, 0.15)
+ALIGN_MIN_RESPONSE = 0.05
+ALIGN_MIN_SCALE = 0.001
+ALIGN_MIN_SHIFT = 0.5
+ALIGN_MIN_GAIN = 0.8
+ALIGN_MAX_SCALE = 0.05
+# Peak memory of comparing a page (or tile) is estimated as MEMORY_PAGE_MB plus, per pixel, MEMORY_RENDER_BYTES per
+# rendered channel and, per layer channel, MEMORY_ENCODE_BYTES plus MEMORY_LAYER_BYTES per markup, difference or
+# overlay layer and MEMORY_COPY_BYTES per copy layer. The difference kernel adds up to MEMORY_STRIP_BYTES per strip
+# pixel when every pixel changed. A tiled page takes MEMORY_TILED_MB more, and holds its encoded layers at about
+# MEMORY_TILED_BYTES per page pixel. Every process takes MEMORY_PROCESS_MB once its imports are loaded. Measured from
+# 150 to 1200 DPI
+MEMORY_PROCESS_MB = 100
+MEMORY_PAGE_MB = 35
+MEMORY_RENDER_BYTES = 1.05
+MEMORY_ENCODE_BYTES = 4.15
+MEMORY_LAYER_BYTES = 0.65
+MEMORY_COPY_BYTES = 1.0
+MEMORY_STRIP_BYTES = 56
+MEMORY_TILED_MB = 40
+MEMORY_TILED_BYTES = 0.2
+# Tile sizes and difference kernel strips the planner tries, largest first
+MEMORY_TILE_SIZES = (4096, 2048, 1024, 512, 256)
+MEMORY_STRIP_SIZES = (1 << 22, 1 << 20, 1 << 18)
+DIFFERENCE_STRIP_PIXELS = 1 << 22
+# Modules imported up front when profiling, see Comparer.import_modules
+PROFILE_IMPORTS = ("fitz", "numpy", "PIL.Image", "cv2")
+# Names of PIL.Image.Resampling members, kept here so parsing options does not import Pillow
+RESAMPLE_FILTERS = ("NEAREST", "BOX", "BILINEAR", "HAMMING", "BICUBIC", "LANCZOS")
+
 def load_settings(options: list[str]) -> dict:
     settings = _load_default_settings()
     if options:
         for option in options:
-            option, value = option.split(":")
+            option, value = option.split(":", 1)
             if (option == "-ps" or option == "--page_size") and value in settings["PAGE_SIZES"]:  
                 settings["PAGE_SIZE"] = value
 
@@ -389,6 +2433,48 @@ def load_settings(options: list[str]) -> dict:
                     settings["MAIN_PAGE"] = "NEW"
                 else:
                     settings["MAIN_PAGE"] = "OLD"
+            elif (option == "-w" or option == "--workers") and value.isdigit() and int(value) > 0:
+                settings["WORKERS"] = int(value)
+            elif (option == "-ci" or option == "--checkpoint_interval") and value.replace(".", "", 1).isdigit():
+                settings["CHECKPOINT_INTERVAL"] = float(value)
+            elif (option == "-c" or option == "--cache") and value:
+                settings["CACHE_PATH"] = value
+            elif (option == "-cs" or option == "--cache_size") and value.isdigit():
+                settings["CACHE_SIZE"] = int(value)
+            elif (option == "-rg" or option == "--render_gray") and (value == "True" or value == "False"):
+                if value == "True":
+                    settings["RENDER_GRAY"] = True
+                else:
+                    settings["RENDER_GRAY"] = False
+            elif (option == "-rf" or option == "--resample") and value.upper() in RESAMPLE_FILTERS:
+                settings["RESAMPLE"] = value.upper()
+            elif (option == "-t" or option == "--tile_size") and value.isdigit():
+                settings["TILE_SIZE"] = int(value)
+            elif (option == "-m" or option == "--mode") and value.upper() in COMPARE_MODES:
+                settings["COMPARE_MODE"] = value.upper()
+            elif (option == "-vt" or option == "--vector_tolerance") and value.replace(".", "", 1).isdigit() and float(value) > 0:
+                settings["VECTOR_TOLERANCE"] = float(value)
+            elif (option == "-pd" or option == "--preview_dpi") and value.isdigit():
+                settings["PREVIEW_DPI"] = int(value)
+            elif (option == "-pm" or option == "--preview_margin") and value.isdigit():
+                settings["PREVIEW_MARGIN"] = int(value)
+            elif (option == "-rm" or option == "--region_method") and value.upper() in REGION_METHODS:
+                settings["REGION_METHOD"] = value.upper()
+            elif (option == "-cg" or option == "--close_gap") and value.isdigit():
+                settings["CLOSE_GAP"] = int(value)
+            elif (option == "-al" or option == "--align") and value.upper() in ALIGN_MODES:
+                settings["ALIGN"] = value.upper()
+            elif (option == "-mt" or option == "--match_pages") and (value == "True" or value == "False"):
+                settings["MATCH_PAGES"] = value == "True"
+            elif (option == "-mm" or option == "--max_memory") and value.isdigit():
+                settings["MAX_MEMORY"] = int(value)
+            elif (option == "-pf" or option == "--profile") and (value == "True" or value == "False"):
+                settings["PROFILE"] = value == "True"
+            elif (option == "-si" or option == "--skip_identical") and (value == "True" or value == "False"):
+                if value == "True":
+                    settings["SKIP_IDENTICAL"] = True
+                else:
+                    settings["SKIP_IDENTICAL"] = False
     return settings
 
 def _load_default_settings() -> dict:
@@ -422,10 +2508,52 @@ def _load_default_settings() -> dict:
             "OUTPUT_BW": False,
             "OUTPUT_GS": False,
             "REDUCE_FILESIZE": True,
-            "MAIN_PAGE": "NEW"
+            "MAIN_PAGE": "NEW",
+            "WORKERS": 1,
+            "SKIP_IDENTICAL": True,
+            "TILE_SIZE": 0,
+            "RENDER_GRAY": False,
+            "RESAMPLE": "BICUBIC",
+            "CHECKPOINT_INTERVAL": 10,
+            "CACHE_PATH": None,
+            "CACHE_SIZE": 2048,
+            "PREVIEW_DPI": 0,
+            "PREVIEW_MARGIN": 16,
+            "COMPARE_MODE": "RASTER",
+            "VECTOR_TOLERANCE": 0.1,
+            "REGION_METHOD": "CONTOURS",
+            "CLOSE_GAP": 0,
+            "ALIGN": "NONE",
+            "MATCH_PAGES": True,
+            "MAX_MEMORY": 0,
+            "PROFILE": False
     }
     return default_settings
 
+def run_batch(args: list[str]):
+    """
+    Runs a --batch comparison of args, the options followed by two folders or a manifest.
+    """
+    if len(args) >= 2 and path.isdir(args[-1]) and path.isdir(args[-2]):
+        options = args[:-2]
+        pairs, unpaired = folder_pairs(args[-2], args[-1])
+        index_folder = args[-2]
+    elif len(args) >= 1 and path.isfile(args[-1]):
+        options = args[:-1]
+        pairs, unpaired = manifest_pairs(args[-1]), []
+        index_folder = path.dirname(path.abspath(args[-1]))
+    else:
+        print("Batch arguments must be 2 folders or a manifest file.")
+        sys.exit(1)
+    comparer = Comparer(options=options, log=print, progress=lambda value: print(f"Progress: {value}%"))
+    index_folder = comparer.OUTPUT_PATH if comparer.OUTPUT_PATH is not None else index_folder.rstrip("/\\") + "/"
+    index_path = f"{index_folder}Comparison Index.csv"
+    index_iterator = 0
+    while path.exists(index_path):
+        index_iterator += 1
+        index_path = f"{index_folder}Comparison Index Rev {index_iterator}.csv"
+    comparer.compare_batch(pairs, index_path, unpaired)
+
 def main():
     """
     python PyPDFCompare.py [options] FilePath1 FilePath2
@@ -471,20 +2599,151 @@ def main():
         Options:
             NEW
             OLD
+    
+    -w:count, --workers:count  Ex: -w:4
+        Compares pages in parallel using the given number of worker processes
+        Default: 1
+    
+    -si:bool, --skip_identical:bool  Ex: -si:True
+        Skips rendering and diffing pages whose content streams and resources are identical in both files
+        Default: True
+    
+    -rg:bool, --render_gray:bool  Ex: -rg:True
+        Renders pages in grayscale and finds differences on a single channel, which uses a third of the memory.
+        Changes only in colour are not detected. Only the markup, difference and overlay layers get colour,
+        and only when the output is not grayscale or black and white
+        Default: False
+    
+    -rf:filter, --resample:filter  Ex: -rf:LANCZOS
+        Resampling filter used when a page has to be resized, which is when scaling is off (each output layer
+        is resized once) or the pages being compared differ in size
+        Options: NEAREST, BOX, BILINEAR, HAMMING, BICUBIC, LANCZOS
+        Default: BICUBIC
+    
+    -t:pixels, --tile_size:pixels  Ex: -t:2048
+        Renders and compares pages in square tiles of this many pixels so memory use is bounded by the tile
+        size instead of the page size. Pages are rendered straight at the output page size. 0 compares whole pages
+        Default: 0
+    
+    -ci:seconds, --checkpoint_interval:seconds  Ex: -ci:30
+        The comparison file is written as pages finish and saved at most this often, so an interrupted run keeps
+        every page up to the last save. 0 saves after every page
+        Default: 10
+    
+    -c:path, --cache:path  Ex: -c:"~/.cache/PyPDFCompare"
+        Caches rendered pages in the given directory so unchanged documents are not rendered again
+        Default: None (No cache)
+    
+    -cs:megabytes, --cache_size:megabytes  Ex: -cs:2048
+        Maximum size of the render cache, the least recently used pages are removed first
+        Default: 2048
+    
+    -pd:dpi, --preview_dpi:dpi  Ex: -pd:75
+        Finds changed regions on renders at this DPI first, then only renders and compares those regions at full
+        DPI. Whole pages are only rendered for the layers that show them. Changes too small to show up at the
+        preview DPI are missed. Ignored when tiling (-t, or when -mm plans tiles, which is logged). 0 compares whole pages
+        Default: 0
+    
+    -pm:pixels, --preview_margin:pixels  Ex: -pm:32
+        Pixels (at full DPI) added around every changed preview region (or vector change) before it is compared at full DPI
+        Default: 16
+    
+    -m:mode, --mode:mode  Ex: -m:VECTOR
+        RASTER compares rendered pages pixel by pixel. VECTOR matches the drawing paths, text spans and images of
+        both pages and marks what was added, removed or moved, pages are only rendered to draw the output layers.
+        TEXT aligns the words of both documents and only marks added and removed words, so reflowed text is not
+        marked. Tiling (-t) and preview DPI (-pd) only apply to RASTER
+        Options: RASTER, VECTOR, TEXT
+        Default: RASTER
+    
+    -vt:points, --vector_tolerance:points  Ex: -vt:0.5
+        In VECTOR mode, content that moved less than this many points (1/72 inch) counts as unchanged
+        Default: 0.1
+    
+    -rm:method, --region_method:method  Ex: -rm:COMPONENTS
+        How changed pixels are grouped into regions before they are clustered into markup boxes. CONTOURS uses the
+        outer contours of the changes, COMPONENTS their 8-connected components
+        Options: CONTOURS, COMPONENTS
+        Default: CONTOURS
+    
+    -cg:pixels, --close_gap:pixels  Ex: -cg:4
+        Joins changes up to this many pixels apart (morphological closing) before finding regions. Ignored when
+        tiling (-t). 0 keeps the changes as they are
+        Default: 0
+    
+    -al:mode, --align:mode  Ex: -al:SHIFT
+        Measures how far the secondary page is shifted (SHIFT), and scaled (SCALE), from the main page with FFT
+        phase correlation and renders it aligned before diffing, so a sheet that moved as a whole isn't marked as
+        changed everywhere. The offset is logged and listed on the statistics page. Pages off by less than half a
+        pixel are left as they are. RASTER mode only
+        Options: NONE, SHIFT, SCALE
+        Default: NONE
+    
+    -mt:bool, --match_pages:bool  Ex: -mt:False
+        Matches the pages of both files on perceptual hashes of thumbnails before comparing, so inserted and
+        removed pages are compared against nothing instead of shifting every later page onto the wrong partner.
+        They are listed on the statistics page. False pairs pages by number
+        Default: True
+    
+    -mm:megabytes, --max_memory:megabytes  Ex: -mm:2048
+        Plans the run to stay under this much memory, from the page size and a per-pixel model of every stage.
+        Takes the most workers (up to -w) it can, then the largest tile size (RASTER only), then smaller difference
+        strips. The plan and its estimate are logged, with a warning if even the smallest plan doesn't fit, or if
+        tiles turn off the preview pass (-pd).
+        0 uses -w and -t as given
+        Default: 0
+    
+    -pf:bool, --profile:bool  Ex: -pf:True
+        Times every stage (rendering, the difference kernel, finding regions, clustering, encoding, assembling)
+        of every page and worker, writes them as a Chrome trace next to the comparison file ("... Profile.json",
+        open in chrome://tracing or ui.perfetto.dev) and logs a table of the time spent in each stage
+        Default: False
+    
+    --batch FolderPath1 FolderPath2, --batch ManifestPath
+        Compares every PDF in FolderPath1 (new files) with the PDF at the same relative path in FolderPath2 (old
+        files), or every pair of a CSV manifest with a new and an old file path per row (relative to the manifest).
+        All pairs share one set of workers (-w). Each comparison file is written as usual, and "Comparison Index.csv"
+        with the difference counts of every pair (and the files without a partner) is written to the output path,
+        FolderPath1 or the manifest's folder. Always runs headless.
+    
+    --headless
+        Runs without the progress window, printing progress to the console. PySide6 is never imported.
+    
+    --startup-profile
+        Prints how long each imported module took to load once the comparison finishes.
     """
     args = sys.argv[1:]
+    headless = "--headless" in args
+    import_profiler = _ImportProfiler.install() if "--startup-profile" in args else None
+    batch = "--batch" in args
+    args = [arg for arg in args if arg not in ("--headless", "--startup-profile", "--batch")]
+    if batch:
+        run_batch(args)
+        if import_profiler is not None:
+            import_profiler.report()
+        return
     paths = args[len(args)-2:]
     options = args[:len(args)-2]
     if path.exists(paths[0]) and path.exists(paths[1]) and len(paths) == 2:
         _, ext1 = path.splitext(paths[0])
         _, ext2 = path.splitext(paths[1])
         if ext1 == ".pdf" or ext2 == ".pdf":
-            app = QApplication()
-            progress_window = ProgressWindow()
-            progress_window.show()
-            compare_thread = CompareThread(paths, progress_window, options=options)
-            compare_thread.start()
-            app.exec()
+            if headless:
+                comparer = Comparer(options=options, log=print, progress=lambda value: print(f"Progress: {value}%"))
+                output_path = comparer.run(paths)
+            else:
+                from PySide6.QtWidgets import QApplication
+                from PyPDFCompare_gui import ProgressWindow, ComparisonThread
+                app = QApplication()
+                progress_window = ProgressWindow()
+                progress_window.show()
+                compare_thread = ComparisonThread(paths, progress_window, options=options)
+                compare_thread.start()
+                app.exec()
+            if import_profiler is not None:
+                import_profiler.report()
+            if headless and output_path is None:
+                sys.exit(1)
         else:
             print("Arguments must contain pdf paths.")
             return
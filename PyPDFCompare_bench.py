@@ -0,0 +1,1038 @@
+import subprocess
+import sys
+from os import listdir, makedirs, path
+from statistics import median
+from time import perf_counter
+
+SCRIPT_DIR = path.dirname(path.abspath(__file__))
+HEAVY_MODULES = ["fitz", "pymupdf", "numpy", "PIL", "cv2", "sklearn", "PySide6"]
+
+def startup_time(runs: int) -> float:
+    # Arguments that fail validation, so only interpreter startup and module import are measured
+    command = [sys.executable, path.join(SCRIPT_DIR, "PyPDFCompare.py"), "--headless", "missing_1.pdf", "missing_2.pdf"]
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+        times.append(perf_counter() - start)
+    return median(times)
+
+def startup_imports() -> list[str]:
+    script = (
+        "import sys\n"
+        "sys.argv = ['PyPDFCompare.py', '--headless', 'missing_1.pdf', 'missing_2.pdf']\n"
+        "import PyPDFCompare\n"
+        "PyPDFCompare.main()\n"
+        f"print('LOADED:' + ','.join(module for module in {HEAVY_MODULES!r} if module in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, "-c", script], cwd=SCRIPT_DIR, capture_output=True, text=True, check=True)
+    loaded = result.stdout.strip().splitlines()[-1].removeprefix("LOADED:")
+    return loaded.split(",") if loaded else []
+
+def check_startup(budget: float, runs: int) -> bool:
+    passed = True
+    loaded = startup_imports()
+    if loaded:
+        print(f"FAIL: heavy modules imported at startup: {', '.join(loaded)}")
+        passed = False
+    else:
+        print("OK: no heavy modules imported at startup")
+
+    elapsed = startup_time(runs)
+    if elapsed > budget:
+        print(f"FAIL: cold start took {elapsed:.3f}s (budget {budget:.3f}s)")
+        passed = False
+    else:
+        print(f"OK: cold start took {elapsed:.3f}s (budget {budget:.3f}s)")
+    return passed
+
+# Renders every page of a file to the output page size, either the way it used to be done or through a matrix,
+# then prints the time taken and how far peak memory rose above the imports
+RENDER_SCRIPT = """
+import resource, sys
+from time import perf_counter
+import fitz
+from PIL import Image
+method, file, dpi, width, height = sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5])
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = perf_counter()
+with fitz.open(file) as doc:
+    for page in doc:
+        if method == "resize":
+            pix = page.get_pixmap(dpi=dpi)
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            del pix
+            image = image.resize((width, height))
+        else:
+            pix = page.get_pixmap(matrix=fitz.Matrix(width / page.rect.width, height / page.rect.height))
+            image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples_mv)
+            del pix
+        del image
+print(perf_counter() - start, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline) / 1024)
+"""
+
+def render_time(method: str, file: str, dpi: int, size: tuple[int, int], runs: int) -> tuple[float, float]:
+    results = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", RENDER_SCRIPT, method, file, str(dpi), str(size[0]), str(size[1])],
+                                capture_output=True, text=True, check=True)
+        results.append(tuple(float(value) for value in result.stdout.split()[-2:]))
+    return median([seconds for seconds, _ in results]), max([megabytes for _, megabytes in results])
+
+def check_render(file: str, dpi: int, page_size: str, runs: int) -> bool:
+    from PyPDFCompare import _load_default_settings
+    width, height = _load_default_settings()["PAGE_SIZES"][page_size]
+    size = (int(width * dpi), int(height * dpi))
+    print(f"Rendering {path.basename(file)} to {page_size} ({size[0]}x{size[1]}) at {dpi} DPI")
+    old_seconds, old_megabytes = render_time("resize", file, dpi, size, runs)
+    new_seconds, new_megabytes = render_time("matrix", file, dpi, size, runs)
+    print(f"render then resize: {old_seconds:.3f}s, peak +{old_megabytes:.0f} MB")
+    print(f"render to size:     {new_seconds:.3f}s, peak +{new_megabytes:.0f} MB")
+    print(f"saved:              {old_seconds - new_seconds:.3f}s, {old_megabytes - new_megabytes:.0f} MB")
+    return new_seconds <= old_seconds and new_megabytes <= old_megabytes
+
+def compare_time(files: list[str], options: list[str], runs: int) -> tuple[float, int]:
+    from tempfile import TemporaryDirectory
+    from PyPDFCompare import Comparer
+    times = []
+    for _ in range(runs):
+        with TemporaryDirectory() as output:
+            comparer = Comparer(options=options + [f"-o:{output}/"])
+            start = perf_counter()
+            comparer.compare(files)
+            times.append(perf_counter() - start)
+    return median(times), comparer.statistics["TOTAL_DIFFERENCES"]
+
+def check_pyramid(files: list[str], dpi: int, preview_dpi: int, page_size: str, runs: int) -> bool:
+    options = [f"-dpi:{dpi}", f"-ps:{page_size}"]
+    print(f"Comparing {path.basename(files[0])} with {path.basename(files[1])} on {page_size} at {dpi} DPI")
+    # Warm up imports and the font cache so neither side pays for them
+    compare_time(files, options + [f"-dpi:{preview_dpi}"], 1)
+    full_seconds, full_differences = compare_time(files, options, runs)
+    pyramid_seconds, pyramid_differences = compare_time(files, options + [f"-pd:{preview_dpi}"], runs)
+    print(f"whole pages:          {full_seconds:.3f}s, {full_differences} differences")
+    print(f"preview at {preview_dpi} DPI:   {pyramid_seconds:.3f}s, {pyramid_differences} differences")
+    print(f"speedup:              {full_seconds / pyramid_seconds:.2f}x")
+    return pyramid_seconds <= full_seconds and pyramid_differences == full_differences
+
+def random_contours(count: int, width: int, height: int, seed: int) -> list:
+    # Small random polygons scattered over a page, clumped around a few hot spots like noisy scans
+    from numpy import clip, int32
+    from numpy.random import default_rng
+    rng = default_rng(seed)
+    spots = rng.uniform((0, 0), (width, height), size=(max(1, count // 500), 2))
+    centres = spots[rng.integers(len(spots), size=count)] + rng.normal(scale=min(width, height) / 20, size=(count, 2))
+    contours = []
+    for centre, corners in zip(centres, rng.integers(1, 8, size=count)):
+        points = clip(centre + rng.integers(-6, 7, size=(corners, 2)), 0, (width - 1, height - 1))
+        contours.append(points.astype(int32).reshape(-1, 1, 2))
+    return contours
+
+def dbscan_labels(contours: list, eps: float) -> list:
+    # The clustering difference_boxes used to do
+    from cv2 import boundingRect
+    from sklearn.cluster import DBSCAN
+    centroids = []
+    for contour in contours:
+        x, y, w, h = boundingRect(contour)
+        centroids.append([x + w / 2, y + h / 2])
+    return DBSCAN(eps=eps, min_samples=1).fit(centroids).labels_.tolist()
+
+def check_cluster(count: int, runs: int) -> bool:
+    from PyPDFCompare import Comparer, contour_areas, contour_boxes, grid_labels
+    comparer = Comparer()
+    passed = True
+    try:
+        import sklearn
+    except ImportError:
+        sklearn = None
+        print("SKIP: scikit-learn is not installed, clusters are not checked against DBSCAN")
+    if sklearn is not None:
+        mismatches = 0
+        for seed in range(runs * 20):
+            contours = random_contours(1 + seed * 37 % 2000, 1000 + seed % 7 * 300, 800 + seed % 5 * 200, seed)
+            boxes = contour_boxes(contours)
+            for eps in (1, 7.5, 50):
+                mismatches += grid_labels(boxes[:, :2] + boxes[:, 2:] / 2, eps).tolist() != dbscan_labels(contours, eps)
+        if mismatches:
+            print(f"FAIL: {mismatches} of {runs * 60} random pages clustered differently from DBSCAN")
+            passed = False
+        else:
+            print(f"OK: {runs * 60} random pages clustered the same as DBSCAN")
+
+    contours = random_contours(count, 10200, 6600, 0)
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        comparer.difference_boxes(contour_boxes(contours), contour_areas(contours))
+        times.append(perf_counter() - start)
+    print(f"grid clustering of {count} contours: {median(times):.3f}s")
+    if sklearn is not None:
+        start = perf_counter()
+        dbscan_labels(contours, 50)
+        print(f"DBSCAN clustering of {count} contours: {perf_counter() - start:.3f}s")
+    return passed
+
+def paste_boxes(comparer, image, boxes: list):
+    # The markup draw_difference_boxes replaced: a new box image per box, pasted onto an RGBA copy of the page
+    from PIL import Image, ImageDraw
+    marked_image = Image.new("RGBA", image.size, (255, 0, 0, 255))
+    marked_image.paste(image, (0, 0))
+    thickness = max(1, int(comparer.DPI_LEVEL / 100))
+    for x, y, w, h in boxes:
+        left, top = max(x, 0), max(y, 0)
+        right, bottom = min(x + w, image.width), min(y + h, image.height)
+        if right <= left or bottom <= top:
+            continue
+        diff_box = Image.new("RGBA", (right - left, bottom - top), (0, 255, 0, 64))
+        ImageDraw.Draw(diff_box).rectangle([(x - left, y - top), (x + w - 1 - left, y + h - 1 - top)], outline=(255, 0, 0, 255), width=thickness)
+        marked_image.paste(diff_box, (left, top), mask=diff_box)
+    return marked_image
+
+def random_boxes(count: int, width: int, height: int, seed: int, size: int) -> list:
+    # Boxes of up to size pixels scattered over a page, some crossing its edges
+    from numpy.random import default_rng
+    rng = default_rng(seed)
+    return [(x, y, w, h) for x, y, w, h in zip(rng.integers(-size, width, count).tolist(), rng.integers(-size, height, count).tolist(),
+                                               rng.integers(1, size, count).tolist(), rng.integers(1, size, count).tolist())]
+
+def check_markup(count: int, dpi: int, page_size: str, runs: int) -> bool:
+    from numpy import array_equal, asarray
+    from numpy.random import default_rng
+    from PIL import Image
+    from PyPDFCompare import Comparer
+    comparer = Comparer([f"-dpi:{dpi}"])
+    mismatches = 0
+    for seed in range(runs * 20):
+        rng = default_rng(seed)
+        width, height = rng.integers(50, 400, 2).tolist()
+        image = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype="uint8"))
+        boxes = random_boxes(1 + seed % 40, width, height, seed, max(width, height) // 4)
+        mismatches += not array_equal(asarray(paste_boxes(comparer, image, boxes)), asarray(comparer.draw_difference_boxes(image, boxes, mode="RGBA")))
+    if mismatches:
+        print(f"FAIL: {mismatches} of {runs * 20} random pages marked up differently from pasting box images")
+    else:
+        print(f"OK: {runs * 20} random pages marked up the same as pasting box images")
+
+    width, height = comparer.PAGE_SIZE
+    image = Image.new("RGB", (int(width * dpi), int(height * dpi)), "white")
+    boxes = random_boxes(count, image.width, image.height, 0, dpi)
+    old_times, new_times = [], []
+    for _ in range(runs):
+        start = perf_counter()
+        paste_boxes(comparer, image, boxes)
+        old_times.append(perf_counter() - start)
+        start = perf_counter()
+        comparer.draw_difference_boxes(image, boxes)
+        new_times.append(perf_counter() - start)
+    print(f"{count} boxes on {page_size} at {dpi} DPI")
+    print(f"box images: {median(old_times):.3f}s")
+    print(f"one copy:   {median(new_times):.3f}s")
+    return not mismatches and median(new_times) <= median(old_times)
+
+def pil_difference(image1, image2, threshold: int):
+    # The difference, overlay and change mask difference_kernel replaced: ImageChops.subtract both ways, inverted
+    # and colourised in red and blue, the overlay from whole page masks and the mask thresholded by OpenCV
+    from cv2 import threshold as cv2_threshold, THRESH_BINARY
+    from numpy import all, array, where
+    from PIL import Image, ImageChops, ImageOps
+    added = array(ImageOps.colorize(ImageOps.invert(ImageChops.subtract(image2, image1).convert("L")), black="blue", white="white").convert("RGB"))
+    removed = array(ImageOps.colorize(ImageOps.invert(ImageChops.subtract(image1, image2).convert("L")), black="red", white="white").convert("RGB"))
+    diff = where(all(added == [255, 255, 255], axis=-1)[:, :, None], removed, added)
+    mask = cv2_threshold(array(ImageChops.difference(image2, image1).convert("L")), threshold, 255, THRESH_BINARY)[1]
+    if image1.mode != "RGB":
+        return diff, None, mask
+    image1array, image2array = array(image1), array(image2)
+    image2array[~all(image2array == [255, 255, 255], axis=-1)] = [255, 0, 0]
+    overlay = where(all(image1array == [255, 255, 255], axis=-1, keepdims=True), image2array, image1array)
+    return diff, overlay, mask
+
+def random_raster(rng, width: int, height: int, channels: int, ink: float):
+    # A white page with a fraction ink of its pixels set to random colours, or a fully random page when ink is 1
+    from numpy import full, uint8
+    raster = full((height, width, channels), 255, dtype=uint8)
+    inked = rng.random((height, width)) < ink
+    raster[inked] = rng.integers(0, 256, (int(inked.sum()), channels), dtype=uint8)
+    return raster[:, :, 0] if channels == 1 else raster
+
+def check_kernel(dpi: int, page_size: str, runs: int) -> bool:
+    from numpy import array_equal, empty, uint8
+    from numpy.random import default_rng
+    from PIL import Image
+    from PyPDFCompare import Comparer, difference_kernel
+    mismatches = 0
+    for seed in range(runs * 20):
+        rng = default_rng(seed)
+        width, height = rng.integers(1, 300, 2).tolist()
+        channels = 1 if seed % 4 == 3 else 3
+        ink = (0.02, 0.3, 1.0)[seed % 3]
+        array1, array2 = random_raster(rng, width, height, channels, ink), random_raster(rng, width, height, channels, ink)
+        # Pages are mostly the same in practice, so half of them share the ink of the first
+        if seed % 2:
+            keep = rng.random((height, width)) < 0.8
+            array2[keep] = array1[keep]
+        threshold = int(rng.integers(0, 256))
+        diff, overlay, mask = pil_difference(Image.fromarray(array1), Image.fromarray(array2), threshold)
+        kernel_diff, kernel_mask = empty((height, width, 3), dtype=uint8), empty((height, width), dtype=uint8)
+        kernel_overlay = empty((height, width, 3), dtype=uint8) if overlay is not None else None
+        # Small strips so most rasters are split into several
+        difference_kernel(array1, array2, threshold, kernel_diff, kernel_overlay, kernel_mask, strip_pixels=int(rng.integers(1, 4096)))
+        mismatches += not (array_equal(diff, kernel_diff) and array_equal(mask, kernel_mask) and (overlay is None or array_equal(overlay, kernel_overlay)))
+    if mismatches:
+        print(f"FAIL: {mismatches} of {runs * 20} random rasters differ from the PIL difference chain")
+    else:
+        print(f"OK: {runs * 20} random rasters give the same difference, overlay and mask as the PIL difference chain")
+
+    width, height = Comparer([f"-ps:{page_size}"]).PAGE_SIZE
+    rng = default_rng(0)
+    array1 = random_raster(rng, int(width * dpi), int(height * dpi), 3, 0.05)
+    array2 = array1.copy()
+    changed = rng.random(array1.shape[:2]) < 0.01
+    array2[changed] = rng.integers(0, 256, (int(changed.sum()), 3), dtype=uint8)
+    image1, image2 = Image.fromarray(array1), Image.fromarray(array2)
+    diff, overlay, mask = empty(array1.shape, dtype=uint8), empty(array1.shape, dtype=uint8), empty(array1.shape[:2], dtype=uint8)
+    old_times, new_times = [], []
+    for _ in range(runs):
+        start = perf_counter()
+        pil_difference(image1, image2, 0)
+        old_times.append(perf_counter() - start)
+        start = perf_counter()
+        difference_kernel(array1, array2, 0, diff, overlay, mask)
+        new_times.append(perf_counter() - start)
+    print(f"{page_size} at {dpi} DPI, 5% ink with 1% of the pixels changed")
+    print(f"PIL chain:         {median(old_times):.3f}s")
+    print(f"difference kernel: {median(new_times):.3f}s")
+    return not mismatches and median(new_times) <= median(old_times)
+
+def moved_copy(file: str, output: str, x: float, y: float, scale: float):
+    # Copy of file with the content of every page scaled about its top left corner and moved by x, y points,
+    # the way a sheet comes back from a plot or scan that isn't quite registered
+    import fitz
+    with fitz.open(file) as doc, fitz.open() as moved:
+        for page in doc:
+            rect = page.rect
+            moved.new_page(width=rect.width, height=rect.height).show_pdf_page(
+                fitz.Rect(x, y, x + rect.width * scale, y + rect.height * scale), doc, page.number, keep_proportion=False)
+        moved.save(output)
+
+def page_regions(comparer, file1: str, file2: str) -> tuple[int, int]:
+    # Change regions and markup boxes of the first pages of both files, compared whole at the comparer's settings
+    import fitz
+    from numpy import asarray, empty, uint8
+    from PyPDFCompare import difference_kernel
+    with fitz.open(file1) as doc1, fitz.open(file2) as doc2:
+        size = comparer.page_pixel_size(0, doc1, doc2)
+        comparer.alignment = (1.0, 0, 0)
+        list1, list2 = doc1.load_page(0).get_displaylist(), doc2.load_page(0).get_displaylist()
+        if comparer.ALIGN != "NONE":
+            list1, list2 = comparer.align_page(0, doc1, doc2, size)
+        mask = empty(size[::-1], dtype=uint8)
+        difference_kernel(asarray(comparer.render_tile(list1, (0, 0) + size, size)), asarray(comparer.render_secondary(list2, (0, 0) + size, size)),
+                          comparer.THRESHOLD, mask=mask)
+    boxes, areas = comparer.change_regions(mask)
+    return len(boxes), len(comparer.difference_boxes(boxes, areas))
+
+def check_align(file: str, dpi: int, page_size: str) -> bool:
+    from tempfile import TemporaryDirectory
+    from PyPDFCompare import Comparer
+    passed = True
+    with TemporaryDirectory() as directory:
+        for name, x, y, scale, mode in (("shifted", 3.3, -2.1, 1.0, "SHIFT"), ("scaled", 2.0, 1.5, 1.01, "SCALE")):
+            moved = path.join(directory, f"{name}.pdf")
+            moved_copy(file, moved, x, y, scale)
+            options = [f"-dpi:{dpi}", f"-ps:{page_size}"]
+            contours, boxes = page_regions(Comparer(options), file, moved)
+            comparer = Comparer(options + [f"-al:{mode}"])
+            aligned_contours, aligned_boxes = page_regions(comparer, file, moved)
+            measured = comparer.alignment
+            print(f"{name} by {x}, {y} pt and {scale}: measured {measured[1]:.2f}, {measured[2]:.2f} pt and {measured[0]:.4f}")
+            print(f"    contours {contours} -> {aligned_contours}, markup boxes {boxes} -> {aligned_boxes}")
+            passed = passed and aligned_contours < contours
+    # A revision drawn on the same sheet is already aligned, moving it by the noise of the estimate would only
+    # change its layers
+    demo = path.join(SCRIPT_DIR, "Demo")
+    for mode in ("SHIFT", "SCALE"):
+        comparer = Comparer([f"-dpi:{dpi}", f"-ps:{page_size}", f"-al:{mode}"])
+        page_regions(comparer, path.join(demo, "DWG1.pdf"), path.join(demo, "DWG0.pdf"))
+        print(f"revision with -al:{mode}: {'left as it is' if comparer.alignment == (1.0, 0, 0) else f'FAIL: aligned by {comparer.alignment}'}")
+        passed = passed and comparer.alignment == (1.0, 0, 0)
+    return passed
+
+def sheet_set(files: list[str], output: str, insert_at: int | None = None):
+    # Concatenates the pages of files, with a sheet of notes that looks like none of them inserted before page insert_at
+    import fitz
+    with fitz.open() as sheets:
+        for number, file in enumerate(files):
+            if number == insert_at:
+                page = sheets.new_page(width=792, height=612)
+                page.insert_text((72, 120), "GENERAL NOTES", fontsize=36)
+                for line in range(20):
+                    page.insert_text((72, 180 + line * 18), f"{line + 1}. Inserted sheet note number {line + 1}.", fontsize=12)
+                page.draw_rect(fitz.Rect(36, 36, 756, 576), width=2)
+            with fitz.open(file) as doc:
+                sheets.insert_pdf(doc)
+        sheets.save(output)
+
+def linked_pages(output: str, count: int, edited: int | None = None):
+    # A document of count pages where each page has a link to the next one, like a hyperlinked drawing set, with
+    # one more line of text on page edited
+    import fitz
+    with fitz.open() as doc:
+        for number in range(count):
+            page = doc.new_page(width=612, height=792)
+            page.insert_text((72, 72), f"Sheet {number + 1}", fontsize=24)
+            if number == edited:
+                page.insert_text((72, 144), "Revised", fontsize=24)
+        # Links can only point at pages that already exist
+        for number in range(count - 1):
+            doc[number].insert_link({"kind": fitz.LINK_GOTO, "page": number + 1, "from": fitz.Rect(72, 700, 200, 730)})
+        doc.save(output)
+
+def check_links(pages: int) -> bool:
+    from tempfile import TemporaryDirectory
+    import fitz
+    from PyPDFCompare import Comparer
+    edited = pages // 2
+    with TemporaryDirectory() as directory:
+        original, revised = path.join(directory, "original.pdf"), path.join(directory, "revised.pdf")
+        linked_pages(original, pages)
+        linked_pages(revised, pages, edited)
+        comparer = Comparer()
+        comparer.page_pairs = [(number, number) for number in range(pages)]
+        with fitz.open(original) as doc1, fitz.open(revised) as doc2:
+            start = perf_counter()
+            try:
+                identical = comparer.find_identical_pages(doc1, doc2)
+            except RecursionError:
+                print(f"FAIL: fingerprinting {pages} linked pages ran out of recursion")
+                return False
+            seconds = perf_counter() - start
+    expected = [number for number in range(pages) if number != edited]
+    print(f"{pages} pages each linking to the next, page {edited + 1} edited: {len(identical)} identical pages in {seconds:.3f}s")
+    if identical != expected:
+        print(f"FAIL: expected every page but page {edited + 1} to be identical")
+    return identical == expected
+
+def check_pages(dpi: int, page_size: str, runs: int) -> bool:
+    from tempfile import TemporaryDirectory
+    import fitz
+    from PyPDFCompare import Comparer
+    demo = path.join(SCRIPT_DIR, "Demo")
+    with TemporaryDirectory() as directory:
+        old, new = path.join(directory, "old.pdf"), path.join(directory, "new.pdf")
+        sheet_set([path.join(demo, name) for name in ("DWG0.pdf", "BCKDCK_A-R0.pdf", "Text_Document1.pdf", "DWG0.pdf")], old)
+        sheet_set([path.join(demo, name) for name in ("DWG1.pdf", "BCKDCK_A-R1.pdf", "Text_Document2.pdf", "DWG1.pdf")], new, insert_at=1)
+        options = [f"-dpi:{dpi}", f"-ps:{page_size}"]
+        by_number_seconds, by_number_differences = compare_time([new, old], options + ["-mt:False"], runs)
+        matched_seconds, matched_differences = compare_time([new, old], options + ["-mt:True"], runs)
+        comparer = Comparer(options)
+        with fitz.open(new) as doc1, fitz.open(old) as doc2:
+            start = perf_counter()
+            pairs = comparer.match_pages(doc1, doc2)
+            match_seconds = perf_counter() - start
+    print(f"Sheet set with a sheet inserted as page 2, {page_size} at {dpi} DPI")
+    print(f"pairs: {pairs} (matched in {match_seconds:.3f}s)")
+    print(f"by number: {by_number_seconds:.3f}s, {by_number_differences} differences")
+    print(f"matched:   {matched_seconds:.3f}s, {matched_differences} differences")
+    return pairs == [(0, 0), (1, None), (2, 1), (3, 2), (4, 3)] and matched_differences < by_number_differences
+
+def revision_folders(directory: str, copies: int) -> tuple[str, str]:
+    # New and old folders holding copies of every pair of demo files under the same names
+    import shutil
+    demo = path.join(SCRIPT_DIR, "Demo")
+    new, old = path.join(directory, "new"), path.join(directory, "old")
+    for folder in (new, old):
+        makedirs(folder)
+    for copy in range(copies):
+        for name, new_file, old_file in (("dwg", "DWG1.pdf", "DWG0.pdf"), ("deck", "BCKDCK_A-R1.pdf", "BCKDCK_A-R0.pdf"),
+                                         ("text", "Text_Document2.pdf", "Text_Document1.pdf")):
+            shutil.copy(path.join(demo, new_file), path.join(new, f"{name}_{copy}.pdf"))
+            shutil.copy(path.join(demo, old_file), path.join(old, f"{name}_{copy}.pdf"))
+    return new, old
+
+def comparison_differences(file: str) -> int:
+    import fitz
+    with fitz.open(file) as doc:
+        text = doc[0].get_text()
+    return int(text.split("Total Differences:")[1].split()[0])
+
+def check_batch(dpi: int, page_size: str, workers: int, copies: int) -> bool:
+    import csv
+    from tempfile import TemporaryDirectory
+    script = path.join(SCRIPT_DIR, "PyPDFCompare.py")
+    options = [f"-dpi:{dpi}", f"-ps:{page_size}", f"-w:{workers}"]
+    with TemporaryDirectory() as directory:
+        new, old = revision_folders(path.join(directory, "single"), copies)
+        names = sorted(listdir(new))
+        start = perf_counter()
+        for name in names:
+            subprocess.run([sys.executable, script, "--headless", *options, path.join(new, name), path.join(old, name)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        single_seconds = perf_counter() - start
+        single = {name: comparison_differences(path.join(new, f"{name.split('.')[0]} Comparison.pdf")) for name in names}
+
+        new, old = revision_folders(path.join(directory, "batch"), copies)
+        start = perf_counter()
+        subprocess.run([sys.executable, script, *options, "--batch", new, old], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        batch_seconds = perf_counter() - start
+        with open(path.join(new, "Comparison Index.csv"), newline="") as file:
+            batch = {path.basename(row["New file"]): int(row["Total differences"]) for row in csv.DictReader(file) if row["Status"] == "Compared"}
+    print(f"{len(names)} pairs of demo files, {page_size} at {dpi} DPI, {workers} workers")
+    print(f"one process per pair: {single_seconds:.3f}s")
+    print(f"batch:                {batch_seconds:.3f}s")
+    if batch != single:
+        print(f"FAIL: differences don't match, {batch} against {single}")
+    return batch == single and batch_seconds < single_seconds
+
+def free_port() -> int:
+    import socket
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def check_server(dpi: int, page_size: str, workers: int, copies: int) -> bool:
+    from concurrent.futures import ThreadPoolExecutor
+    from tempfile import TemporaryDirectory
+    from time import sleep
+    from PyPDFCompare_server import request, submit
+    script = path.join(SCRIPT_DIR, "PyPDFCompare.py")
+    options = [f"-dpi:{dpi}", f"-ps:{page_size}"]
+    with TemporaryDirectory() as directory:
+        new, old = revision_folders(path.join(directory, "single"), copies)
+        names = sorted(listdir(new))
+        start = perf_counter()
+        for name in names:
+            subprocess.run([sys.executable, script, "--headless", *options, path.join(new, name), path.join(old, name)],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        single_seconds = perf_counter() - start
+        single = {name: comparison_differences(path.join(new, f"{name.split('.')[0]} Comparison.pdf")) for name in names}
+
+        new, old = revision_folders(path.join(directory, "server"), copies)
+        port = free_port()
+        server = subprocess.Popen([sys.executable, path.join(SCRIPT_DIR, "PyPDFCompare_server.py"), f"-p:{port}", f"-w:{workers}", "serve"],
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            # Only jobs are timed, the server is started once and kept running
+            while True:
+                try:
+                    if request(port, "GET", "/health")[1]["warm"] == workers:
+                        break
+                except OSError:
+                    pass
+                sleep(0.1)
+            start = perf_counter()
+            # Each file is submitted by its own client, like separate users of the server
+            with ThreadPoolExecutor(len(names)) as executor:
+                statuses = list(executor.map(lambda name: submit(port, [path.join(new, name), path.join(old, name)], options, name, log=lambda message: None), names))
+            server_seconds = perf_counter() - start
+            recovered = check_server_crash(port, workers, [path.join(new, names[0]), path.join(old, names[0])], options)
+        finally:
+            server.terminate()
+            server.wait()
+    served = {name: status["statistics"]["total_differences"] if status["state"] == "done" else None for name, status in zip(names, statuses)}
+    print(f"{len(names)} pairs of demo files, {page_size} at {dpi} DPI, server with {workers} workers")
+    print(f"one process per pair: {single_seconds:.3f}s")
+    print(f"server:               {server_seconds:.3f}s")
+    if served != single:
+        print(f"FAIL: differences don't match, {served} against {single}")
+    return served == single and server_seconds < single_seconds and recovered
+
+def check_server_crash(port: int, workers: int, files: list[str], options: list[str]) -> bool:
+    # Starts a slow job on every worker and kills the workers while they run. The jobs have to fail and the queue
+    # has to free their workers, so a job submitted after them still runs
+    import signal
+    from os import kill
+    from time import sleep
+    from PyPDFCompare_server import request, submit
+    slow = ["-dpi:600", "-ps:ANSI D", "-t:512"]
+    jobs = [request(port, "POST", "/jobs", {"files": files, "options": slow, "client": "crash"})[1]["id"] for _ in range(workers)]
+    deadline = perf_counter() + 60
+    while perf_counter() < deadline:
+        statuses = [request(port, "GET", f"/jobs/{job}")[1] for job in jobs]
+        if all(status["worker"] for status in statuses):
+            break
+        sleep(0.1)
+    for status in statuses:
+        if status["worker"]:
+            kill(status["worker"], signal.SIGKILL)
+    while perf_counter() < deadline:
+        statuses = [request(port, "GET", f"/jobs/{job}")[1] for job in jobs]
+        if all(status["state"] != "running" for status in statuses):
+            break
+        sleep(0.1)
+    start = perf_counter()
+    status = submit(port, files, options, "after crash", log=lambda message: None)
+    health = request(port, "GET", "/health")[1]
+    states = [status["state"] for status in statuses]
+    print(f"killed workers of {len(jobs)} running jobs: {', '.join(states)}, next job {status['state']} in {perf_counter() - start:.3f}s, {health['running']} running")
+    if any(state != "failed" for state in states) or status["state"] != "done" or health["running"]:
+        print("FAIL: the queue didn't recover from workers that died during a job")
+        return False
+    return True
+
+# Compares two files with the given options in a fresh process, then prints the plan the memory planner picked and
+# the peak memory of the process and its workers (each worker is counted at the peak of the largest)
+MEMORY_SCRIPT = """
+import json, resource, sys
+from PyPDFCompare import Comparer
+options, files = json.loads(sys.argv[1]), sys.argv[2:4]
+comparer = Comparer(options)
+comparer.compare(files)
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+if comparer.WORKERS > 1:
+    peak += comparer.WORKERS * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+print(json.dumps({"workers": comparer.WORKERS, "tile": comparer.TILE_SIZE, "strip": comparer.STRIP_PIXELS,
+                  "estimate": comparer.memory_estimate, "peak": peak}))
+"""
+
+def check_memory(dpi: int, page_size: str, workers: int, budgets: list[int]) -> bool:
+    import json
+    from tempfile import TemporaryDirectory
+    import fitz
+    demo = path.join(SCRIPT_DIR, "Demo")
+    passed = True
+    print(f"Demo drawing against its revision and against a page where every pixel changed, {page_size} at {dpi} DPI, up to {workers} workers")
+    print("budget  files      plan                                  estimate      peak")
+    with TemporaryDirectory() as directory:
+        changed = path.join(directory, "changed.pdf")
+        with fitz.open(path.join(demo, "DWG0.pdf")) as doc:
+            page = doc[0]
+            page.draw_rect(page.rect, color=None, fill=(0.2, 0.5, 0.7), overlay=True)
+            doc.save(changed)
+        for budget in budgets:
+            for name, files in (("revision", [path.join(demo, "DWG1.pdf"), path.join(demo, "DWG0.pdf")]), ("changed", [path.join(demo, "DWG1.pdf"), changed])):
+                options = [f"-dpi:{dpi}", f"-ps:{page_size}", f"-w:{workers}", f"-mm:{budget}", f"-o:{directory}/"]
+                result = subprocess.run([sys.executable, "-c", MEMORY_SCRIPT, json.dumps(options), *files],
+                                        cwd=SCRIPT_DIR, capture_output=True, text=True, check=True)
+                plan = json.loads(result.stdout.strip().splitlines()[-1])
+                layout = f"tiles of {plan['tile']}" if plan["tile"] else "whole pages"
+                print(f"{budget:6d}  {name:9s}  {plan['workers']} workers, {layout:14s}, strips {plan['strip']:7d}  {plan['estimate']:6.0f} MB  {plan['peak']:6.0f} MB")
+                # A plan has to keep within its budget and its estimate has to stay an upper bound that isn't far off
+                if plan["estimate"] <= budget and plan["peak"] > budget:
+                    print(f"FAIL: peak memory is over the {budget} MB budget")
+                    passed = False
+                if not plan["estimate"] * 0.5 <= plan["peak"] <= plan["estimate"] * 1.1:
+                    print(f"FAIL: peak memory is more than 10% over or 50% under the estimate")
+                    passed = False
+    return passed
+
+def synthetic_sheets(directory: str, size: tuple[float, float], density: float, changes: int, seed: int = 0) -> tuple[str, str]:
+    # New and old revision of a vector drawing of size inches with a border and title block, density lines, boxes,
+    # circles and labels per square inch, and changes of them moved, added or removed in the new revision
+    import fitz
+    from numpy.random import default_rng
+    rng = default_rng(seed)
+    width, height = size[0] * 72, size[1] * 72
+    elements = []
+    for _ in range(int(density * size[0] * size[1])):
+        kind = rng.choice(["line", "rect", "circle", "text"], p=[0.4, 0.3, 0.15, 0.15])
+        x, y = rng.uniform(54, width - 54), rng.uniform(54, height - 144)
+        elements.append((kind, x, y, *rng.uniform(4, 72, 2).tolist()))
+    revised = list(elements)
+    for change in range(min(changes, len(elements))):
+        index = int(rng.integers(len(revised)))
+        kind, x, y, w, h = revised[index]
+        if change % 3 == 0:
+            revised[index] = (kind, x + rng.uniform(-18, 18), y + rng.uniform(-18, 18), w, h)
+        elif change % 3 == 1:
+            revised.append((kind, rng.uniform(54, width - 54), rng.uniform(54, height - 144), w, h))
+        else:
+            revised.pop(index)
+
+    files = []
+    for name, sheet in (("new", revised), ("old", elements)):
+        file = path.join(directory, f"{name}.pdf")
+        with fitz.open() as doc:
+            page = doc.new_page(width=width, height=height)
+            shape = page.new_shape()
+            shape.draw_rect(fitz.Rect(36, 36, width - 36, height - 36))
+            shape.draw_rect(fitz.Rect(width - 360, height - 126, width - 36, height - 36))
+            shape.finish(width=2)
+            for number, (kind, x, y, w, h) in enumerate(sheet):
+                if kind == "line":
+                    shape.draw_line((x, y), (min(x + w, width - 36), min(y + h, height - 36)))
+                elif kind == "rect":
+                    shape.draw_rect(fitz.Rect(x, y, min(x + w, width - 36), min(y + h, height - 36)))
+                elif kind == "circle":
+                    shape.draw_circle((x, y), min(w, h) / 4)
+                else:
+                    continue
+                shape.finish(width=2)
+            shape.commit()
+            for kind, x, y, w, h in sheet:
+                if kind == "text":
+                    page.insert_text((x, y), f"NOTE {int(w * h) % 1000:03d}", fontsize=10)
+            page.insert_text((width - 350, height - 80), f"SYNTHETIC SHEET {size[0]:g}x{size[1]:g} REV {name.upper()}", fontsize=14)
+            doc.save(file)
+        files.append(file)
+    return files[0], files[1]
+
+# Compares two files with the given options runs times in a fresh process with profiling on, then prints the median
+# time, the median time of each stage, the pages, differences and peak memory of the process and its workers
+SUITE_SCRIPT = """
+import json, resource, sys
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import fitz, numpy, cv2, PIL.Image
+from PyPDFCompare import Comparer
+options, runs, files = json.loads(sys.argv[1]), int(sys.argv[2]), sys.argv[3:5]
+times, stages = [], {}
+for run in range(runs):
+    with TemporaryDirectory() as output:
+        comparer = Comparer(options + ["-pf:True", f"-o:{output}/"])
+        start = perf_counter()
+        comparer.compare(files)
+        times.append(perf_counter() - start)
+    for event in comparer.statistics["PROFILE"]:
+        stages.setdefault(event["name"], [0.0] * runs)[run] += event["dur"] / 1e6
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+if comparer.WORKERS > 1:
+    peak += comparer.WORKERS * resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+print(json.dumps({"seconds": median(times), "pages": len(comparer.page_pairs), "differences": comparer.statistics["TOTAL_DIFFERENCES"],
+                  "peak_mb": peak, "stages": {name: median(values) for name, values in stages.items()}}))
+"""
+
+# Stages the suite reports, and the profile spans (see PyPDFCompare.profile_span) each one adds up
+SUITE_STAGES = {
+    "render": ("Render main page", "Render secondary page", "Render tiles", "Render regions"),
+    "diff": ("Difference kernel",),
+    "contour": ("Find regions",),
+    "cluster": ("Cluster boxes",),
+    "markup": ("Draw markup",),
+    "encode": ("Encode layers", "Encode tiles"),
+    "assemble": ("Assemble page", "Statistics page", "Save PDF")
+}
+# Changes smaller than these are never counted as regressions, whatever the tolerance, so timer noise on short
+# stages doesn't fail the suite
+SUITE_MIN_SECONDS = 0.05
+SUITE_MIN_MB = 20
+
+def suite_regressions(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    # Every time and peak memory of a case in both results that grew past tolerance (a fraction) of its baseline
+    regressions = []
+    for case, result in results["cases"].items():
+        base = baseline["cases"].get(case)
+        if base is None:
+            continue
+        measures = [("time", result["seconds"], base["seconds"], SUITE_MIN_SECONDS, "s"), ("peak memory", result["peak_mb"], base["peak_mb"], SUITE_MIN_MB, " MB")]
+        measures += [(stage, result["stages"][stage], base["stages"].get(stage, 0), SUITE_MIN_SECONDS, "s") for stage in result["stages"]]
+        for name, value, base_value, minimum, unit in measures:
+            if value > base_value * (1 + tolerance) and value - base_value > minimum:
+                regressions.append(f"{case} {name}: {value:.3f}{unit} against {base_value:.3f}{unit} in the baseline")
+        if result["differences"] != base["differences"]:
+            regressions.append(f"{case} differences: {result['differences']} against {base['differences']} in the baseline")
+    return regressions
+
+def run_suite(dpi_levels: list[int], page_sizes: list[str], sheet: tuple[float, float], density: float, changes: int, options: list[str],
+              runs: int, results_path: str | None, baseline_path: str | None, tolerance: float) -> bool:
+    import json
+    import platform
+    from tempfile import TemporaryDirectory
+    demo = path.join(SCRIPT_DIR, "Demo")
+    results = {"python": platform.python_version(), "machine": platform.machine(), "options": options, "runs": runs, "cases": {}}
+    print(f"{'case':<34}{'pages':>6}{'seconds':>9}{'pages/s':>9}{'peak MB':>9}" + "".join(f"{stage:>9}" for stage in SUITE_STAGES))
+    with TemporaryDirectory() as directory:
+        pairs = {"dwg": (path.join(demo, "DWG1.pdf"), path.join(demo, "DWG0.pdf")),
+                 "deck": (path.join(demo, "BCKDCK_A-R1.pdf"), path.join(demo, "BCKDCK_A-R0.pdf")),
+                 "text": (path.join(demo, "Text_Document2.pdf"), path.join(demo, "Text_Document1.pdf")),
+                 "synthetic": synthetic_sheets(directory, sheet, density, changes)}
+        for dpi in dpi_levels:
+            for page_size in page_sizes:
+                for name, files in pairs.items():
+                    case = f"{name}/{page_size}/{dpi}"
+                    result = subprocess.run([sys.executable, "-c", SUITE_SCRIPT, json.dumps([f"-dpi:{dpi}", f"-ps:{page_size}"] + options), str(runs), *files],
+                                            cwd=SCRIPT_DIR, capture_output=True, text=True)
+                    if result.returncode != 0:
+                        print(f"{case:<34}FAILED: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode}")
+                        results["cases"][case] = None
+                        continue
+                    measured = json.loads(result.stdout.strip().splitlines()[-1])
+                    measured["pages_per_second"] = measured["pages"] / measured["seconds"]
+                    measured["stages"] = {stage: sum(measured["stages"].get(span, 0) for span in spans) for stage, spans in SUITE_STAGES.items()}
+                    results["cases"][case] = measured
+                    print(f"{case:<34}{measured['pages']:>6}{measured['seconds']:9.3f}{measured['pages_per_second']:9.2f}{measured['peak_mb']:9.0f}"
+                          + "".join(f"{measured['stages'][stage]:9.3f}" for stage in SUITE_STAGES))
+    failed = [case for case, measured in results["cases"].items() if measured is None]
+    results["cases"] = {case: measured for case, measured in results["cases"].items() if measured is not None}
+    if results_path:
+        with open(results_path, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+        print(f"Results written: {results_path}")
+    passed = not failed
+    if failed:
+        print(f"FAIL: {len(failed)} cases failed to run")
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = suite_regressions(results, baseline, tolerance)
+        for regression in regressions:
+            print(f"FAIL: {regression}")
+        compared = len(set(results["cases"]) & set(baseline["cases"]))
+        if not regressions:
+            print(f"OK: {compared} cases within {tolerance:.0%} of the baseline")
+        passed = passed and not regressions
+    return passed
+
+def main():
+    """
+    python PyPDFCompare_bench.py [options] command [file]
+    commands:
+    startup
+        Fails if starting PyPDFCompare.py imports a heavy dependency or if the median cold start
+        (interpreter plus module import, up to argument validation) is over budget.
+
+    render [file]
+        Times rendering every page of file (Default: Demo/DWG1.pdf) to the output page size by rendering at DPI
+        and resizing, against rendering straight to size with a matrix, and reports the peak memory of each.
+        Fails if rendering to size is slower or uses more memory. Use a page size larger than the file's
+        pages (-ps) to see the cost of upscaling in vectors instead of pixels.
+
+    pyramid [file1 file2]
+        Times comparing file1 with file2 (Default: Demo/DWG1.pdf and Demo/DWG0.pdf) on whole pages against
+        finding changes at a preview DPI first (-pd) and comparing only those regions at full DPI. Fails if the
+        preview pass is slower or finds a different number of differences.
+
+    cluster
+        Checks that clustering contours on a grid gives the same clusters as DBSCAN on random pages (when
+        scikit-learn is installed) and times clustering -c contours on an ANSI D page at 300 DPI.
+
+    markup
+        Checks that drawing the markup boxes straight onto one copy of the page gives the same pixels as pasting
+        a box image per box onto an RGBA copy, on random pages with overlapping boxes, and times both with -bx
+        boxes of up to an inch on a -ps page at -dpi. Fails on any difference or if drawing is slower.
+
+    kernel
+        Checks that the difference kernel gives the same difference, overlay and change mask as the PIL chain it
+        replaced (ImageChops.subtract, ImageOps.invert and ImageOps.colorize), on random RGB and grayscale rasters
+        with random thresholds and strip sizes, and times both on a -ps page at -dpi. Fails on any difference or if
+        the kernel is slower.
+
+    links
+        Fingerprints a document of -pg pages where each page links to the next against a copy with a page in the
+        middle edited, the way pages are skipped with -d. Fails if fingerprinting runs out of recursion or any page
+        but the edited one isn't found identical.
+
+    align [file]
+        Compares the first page of file (Default: Demo/DWG0.pdf) with a copy of it moved by a few points, and
+        with one also scaled by 1%, with and without alignment (-al), and prints the measured offset and scale
+        and how many contours and markup boxes are left. Then aligns the demo drawing's revision, which is on the
+        same sheet. Fails if alignment doesn't reduce the contour count, or if it moves the revision.
+
+    pages
+        Compares a set of demo sheets with the same set with a sheet inserted as page 2, pairing pages by number
+        (-mt:False) and by matching them, and prints the pairs found and the time and differences of both. Fails
+        if the inserted sheet isn't found or matching doesn't reduce the differences.
+
+    batch
+        Compares -k copies of each pair of demo files in two folders, once with a headless process per pair and once
+        with one --batch run, both with -w workers. Fails if the batch is slower or the difference totals in its
+        index don't match the comparison files of the single runs.
+
+    server
+        Starts PyPDFCompare_server.py with -w workers and submits -k copies of each pair of demo files to it at once,
+        then compares the time the jobs took with running a headless process per pair. Then kills the worker of a
+        slow job on each worker and submits one more job. Fails if the server is slower, its difference totals don't
+        match the comparison files of the single runs, or the killed jobs don't fail and the next job doesn't run.
+
+    memory
+        Compares a demo drawing with its revision, and with a copy where every pixel changed, in a fresh process with
+        each -mm budget, and prints the plan picked, its estimated and its measured peak memory. Fails if a plan that
+        fits its budget goes over it, or if the measured peak is more than 10% over or 50% under the estimate.
+
+    suite
+        Compares each pair of demo files and a generated pair of vector sheets (-sh, -de, -ch) at every -dl DPI on
+        every -pl page size, -n times each in a fresh process, and prints the median time, pages per second, peak
+        memory and the time of every stage (render, diff, contour, cluster, markup, encode, assemble, taken from
+        the -pf profile). Results are written as JSON to -j. Fails if a case fails to run, or if its time, the time
+        of a stage or its peak memory grew past -tol of the -bl baseline (a results file of an earlier run), or its
+        difference count changed.
+
+    options:
+    -b:seconds, --budget:seconds  Ex: -b:0.5
+        Cold start budget in seconds.
+        Default: 0.5
+
+    -n:runs, --runs:runs  Ex: -n:5
+        Number of cold starts (or renders) to take the median of.
+        Default: 5
+
+    -dpi:dpi  Ex: -dpi:300
+        DPI to render at.
+        Default: 300
+
+    -ps:page_size, --page_size:page_size  Ex: -ps:"ANSI D"
+        Output page size to render to.
+        Default: ANSI B
+
+    -pd:dpi, --preview_dpi:dpi  Ex: -pd:75
+        Preview DPI for the pyramid command.
+        Default: 75
+
+    -c:count, --contours:count  Ex: -c:50000
+        Number of contours for the cluster command.
+        Default: 50000
+
+    -bx:count, --boxes:count  Ex: -bx:500
+        Number of boxes for the markup command.
+        Default: 500
+
+    -w:count, --workers:count  Ex: -w:4
+        Number of workers for the batch and server commands, and the most the memory command's plans may use.
+        Default: 2
+
+    -pg:count, --pages:count  Ex: -pg:600
+        Number of pages for the links command.
+        Default: 600
+
+    -mm:megabytes, --max_memory:megabytes  Ex: -mm:1024,4096
+        Comma separated memory budgets for the memory command.
+        Default: 4096,1024,512
+
+    -k:copies, --copies:copies  Ex: -k:4
+        Copies of each pair of demo files for the batch and server commands.
+        Default: 2
+
+    -dl:levels, --dpi_levels:levels  Ex: -dl:75,150,300
+        Comma separated DPI levels for the suite command, ALL for every DPI level of the settings.
+        Default: 75,150
+
+    -pl:sizes, --page_sizes:sizes  Ex: -pl:"AUTO,ANSI D"
+        Comma separated page sizes for the suite command, ALL for every page size of the settings.
+        Default: ALL
+
+    -sh:size, --sheet:size  Ex: -sh:44x34
+        Width and height in inches of the generated sheets of the suite command.
+        Default: 34x22
+
+    -de:count, --density:count  Ex: -de:10
+        Lines, boxes, circles and labels per square inch of the generated sheets.
+        Default: 2
+
+    -ch:count, --changes:count  Ex: -ch:100
+        Elements moved, added or removed in the new generated sheet.
+        Default: 20
+
+    -x:options, --options:options  Ex: -x:"-t:2048 -w:2"
+        Space separated comparison options added to every run of the suite command, large page sizes at high DPI
+        need tiles (-t) or a memory budget (-mm) to fit in memory.
+        Default: None
+
+    -j:path, --json:path  Ex: -j:baseline.json
+        File the suite command writes its results to.
+        Default: None (Not written)
+
+    -bl:path, --baseline:path  Ex: -bl:baseline.json
+        Results of an earlier suite run to check this run against.
+        Default: None (Not checked)
+
+    -tol:percent, --tolerance:percent  Ex: -tol:10
+        How much slower or larger than the baseline a case may get before the suite fails.
+        Default: 25
+    """
+    args = sys.argv[1:]
+    budget = 0.5
+    runs = 5
+    dpi = 300
+    page_size = "ANSI B"
+    preview_dpi = 75
+    contours = 50000
+    boxes = 500
+    workers = 2
+    copies = 2
+    pages = 600
+    budgets = [4096, 1024, 512]
+    dpi_levels = [75, 150]
+    page_sizes = None
+    sheet = (34, 22)
+    density = 2
+    changes = 20
+    suite_options = []
+    results_path = None
+    baseline_path = None
+    tolerance = 25
+    positional = []
+    for arg in args:
+        option, _, value = arg.partition(":")
+        if option in ("-b", "--budget"):
+            budget = float(value)
+        elif option in ("-n", "--runs") and value.isdigit():
+            runs = int(value)
+        elif option == "-dpi" and value.isdigit():
+            dpi = int(value)
+        elif option in ("-ps", "--page_size"):
+            page_size = value
+        elif option in ("-pd", "--preview_dpi") and value.isdigit():
+            preview_dpi = int(value)
+        elif option in ("-c", "--contours") and value.isdigit():
+            contours = int(value)
+        elif option in ("-bx", "--boxes") and value.isdigit():
+            boxes = int(value)
+        elif option in ("-w", "--workers") and value.isdigit():
+            workers = int(value)
+        elif option in ("-k", "--copies") and value.isdigit():
+            copies = int(value)
+        elif option in ("-pg", "--pages") and value.isdigit():
+            pages = int(value)
+        elif option in ("-mm", "--max_memory") and all(budget.isdigit() for budget in value.split(",")):
+            budgets = [int(budget) for budget in value.split(",")]
+        elif option in ("-dl", "--dpi_levels") and (value == "ALL" or all(level.isdigit() for level in value.split(","))):
+            dpi_levels = None if value == "ALL" else [int(level) for level in value.split(",")]
+        elif option in ("-pl", "--page_sizes") and value:
+            page_sizes = None if value == "ALL" else value.split(",")
+        elif option in ("-sh", "--sheet") and all(side.replace(".", "", 1).isdigit() for side in value.split("x")) and value.count("x") == 1:
+            sheet = tuple(float(side) for side in value.split("x"))
+        elif option in ("-de", "--density") and value.replace(".", "", 1).isdigit():
+            density = float(value)
+        elif option in ("-ch", "--changes") and value.isdigit():
+            changes = int(value)
+        elif option in ("-x", "--options"):
+            suite_options = value.split()
+        elif option in ("-j", "--json") and value:
+            results_path = value
+        elif option in ("-bl", "--baseline") and value:
+            baseline_path = value
+        elif option in ("-tol", "--tolerance") and value.replace(".", "", 1).isdigit():
+            tolerance = float(value)
+        else:
+            positional.append(arg)
+    command = positional[0] if positional else None
+
+    if command == "startup":
+        sys.exit(0 if check_startup(budget, runs) else 1)
+    if command == "render":
+        file = positional[1] if len(positional) > 1 else path.join(SCRIPT_DIR, "Demo", "DWG1.pdf")
+        sys.exit(0 if check_render(file, dpi, page_size, runs) else 1)
+    if command == "cluster":
+        sys.exit(0 if check_cluster(contours, runs) else 1)
+    if command == "markup":
+        sys.exit(0 if check_markup(boxes, dpi, page_size, runs) else 1)
+    if command == "kernel":
+        sys.exit(0 if check_kernel(dpi, page_size, runs) else 1)
+    if command == "links":
+        sys.exit(0 if check_links(pages) else 1)
+    if command == "pages":
+        sys.exit(0 if check_pages(dpi, page_size, runs) else 1)
+    if command == "batch":
+        sys.exit(0 if check_batch(dpi, page_size, workers, copies) else 1)
+    if command == "memory":
+        sys.exit(0 if check_memory(dpi, page_size, workers, budgets) else 1)
+    if command == "server":
+        sys.exit(0 if check_server(dpi, page_size, workers, copies) else 1)
+    if command == "suite":
+        from PyPDFCompare import _load_default_settings
+        settings = _load_default_settings()
+        dpi_levels = dpi_levels if dpi_levels is not None else settings["DPI_LEVELS"]
+        page_sizes = page_sizes if page_sizes is not None else list(settings["PAGE_SIZES"])
+        sys.exit(0 if run_suite(dpi_levels, page_sizes, sheet, density, changes, suite_options, runs, results_path, baseline_path, tolerance / 100) else 1)
+    if command == "align":
+        file = positional[1] if len(positional) > 1 else path.join(SCRIPT_DIR, "Demo", "DWG0.pdf")
+        sys.exit(0 if check_align(file, dpi, page_size) else 1)
+    if command == "pyramid":
+        files = positional[1:3] if len(positional) > 2 else [path.join(SCRIPT_DIR, "Demo", "DWG1.pdf"), path.join(SCRIPT_DIR, "Demo", "DWG0.pdf")]
+        sys.exit(0 if check_pyramid(files, dpi, preview_dpi, page_size, runs) else 1)
+    print(main.__doc__)
+    sys.exit(2)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,19 @@
-from os import path
+from os import path, cpu_count
 from json import load, dump
-import subprocess, sys
+from time import sleep, perf_counter
+from itertools import count
+from queue import Empty, Queue
+from threading import Lock
 
 
-from PySide6.QtCore import QThread, Qt
+from PySide6.QtCore import QThread, Qt, Signal, Slot
 from PySide6.QtWidgets import QMainWindow, QApplication, QWidget, QVBoxLayout, QDialog, QFrame, QPushButton, QLabel, \
-QSpinBox, QDoubleSpinBox, QComboBox, QCheckBox, QLineEdit, QGroupBox, QTabWidget, QStyleFactory, QFormLayout, QHBoxLayout, QSpacerItem, QSizePolicy, QFileDialog
+QSpinBox, QDoubleSpinBox, QComboBox, QCheckBox, QLineEdit, QGroupBox, QTabWidget, QStyleFactory, QFormLayout, QHBoxLayout, QSpacerItem, QSizePolicy, QFileDialog, \
+QProgressBar, QTextBrowser, QTableWidget, QTableWidgetItem, QHeaderView
 from PySide6.QtGui import QIcon
 
+from PyPDFCompare import Comparer
+
 class AdvancedSettings(QWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -524,6 +530,8 @@ class MainWindow(QMainWindow):
         
         self.settings = load_settings()
         self.files = None
+        self.runner = None
+        self.queue_window = None
 
         layout = QVBoxLayout()
 
@@ -614,70 +622,309 @@ class MainWindow(QMainWindow):
         
     def compare(self):
         if self.files and len(self.files) == 2:
-            compare_thread = CompareThread(self.files, self)
-            compare_thread.start()
-
-class CompareThread(QThread):    
-    def __init__(self, files: list[str], parent=None):
-        super(CompareThread, self).__init__(parent)
-        self.settings = load_settings()
-        self.files = files
-
-    def run(self):
-        args = self._construct_cli_arguments()
-
-        process = subprocess.Popen(
-            [sys.executable, "PyPDFCompare.py"] + args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
-            shell=False
-        )
-        process.wait()
-            
-    def _construct_cli_arguments(self) -> list[str]:
-        """Constructs the CLI arguments based on the current settings."""
-        args = []
+            if self.runner is None:
+                self.runner = ComparisonRunner(self.settings.get("WORKERS", max(1, (cpu_count() or 2) - 1)), self)
+                self.queue_window = QueueWindow(self.runner)
+                # The runner only finishes once it was stopped by closing this window, which then closes for good
+                self.runner.finished.connect(self.close)
+                self.runner.start()
+            job_id = self.runner.submit(list(self.files), self.comparison_options())
+            self.queue_window.add_job(job_id, self.files)
+            self.queue_window.show()
+
+    def comparison_options(self) -> list[str]:
+        """Constructs the comparison options based on the current settings."""
+        options = []
 
         # Add DPI level
         dpi_level = self.settings.get("DPI_LEVEL", 600)
-        args.append(f"-dpi:{dpi_level}")
+        options.append(f"-dpi:{dpi_level}")
 
-        # Add page size
-        page_size = self.settings.get("PAGE_SIZE", "AUTO")
-        args.append(f"-ps:{page_size}")
+        # Add page size, PAGE_SIZE holds the size itself once a page size has been picked
+        page_size = self.settings.get("PAGE", self.settings.get("PAGE_SIZE", "AUTO"))
+        options.append(f"-ps:{page_size}")
 
         # Add output path
         output_path = self.settings.get("OUTPUT_PATH", None)
         if output_path:
-            args.append(f'-o:"{output_path}"')
+            options.append(f"-o:{output_path}")
 
         # Add scaling option
         scale_output = self.settings.get("SCALE_OUTPUT", True)
-        args.append(f"-s:{str(scale_output).capitalize()}")
+        options.append(f"-s:{str(scale_output).capitalize()}")
 
         # Add black-and-white and grayscale options
         output_bw = self.settings.get("OUTPUT_BW", False)
         output_gs = self.settings.get("OUTPUT_GS", False)
-        args.append(f"-bw:{str(output_bw).capitalize()}")
-        args.append(f"-gs:{str(output_gs).capitalize()}")
+        options.append(f"-bw:{str(output_bw).capitalize()}")
+        options.append(f"-gs:{str(output_gs).capitalize()}")
 
         # Add file size reduction
         reduce_filesize = self.settings.get("REDUCE_FILESIZE", True)
-        args.append(f"-r:{str(reduce_filesize).capitalize()}")
+        options.append(f"-r:{str(reduce_filesize).capitalize()}")
 
         # Add main page focus
         main_page = self.settings.get("MAIN_PAGE", "Main File")
         main_page_arg = "NEW" if main_page == "Main File" else "OLD"
-        args.append(f"-mp:{main_page_arg}")
-        
-        # Add input files
-        if len(self.files) == 2:
-            args.extend(self.files)
-        else:
-            raise ValueError("Exactly two input files are required.")
+        options.append(f"-mp:{main_page_arg}")
+
+        # Pages are compared on the runner's pool
+        options.append(f"-w:{self.runner.workers}")
+        return options
+
+    def closeEvent(self, event):
+        # Queued comparisons are dropped and the running one stops after its current page, the window closes when
+        # the runner has finished instead of blocking the event loop until then
+        if self.runner is not None and self.runner.isRunning():
+            self.runner.stop()
+            self.queue_window.close()
+            event.ignore()
+            return
+        event.accept()
+
+class ComparisonRunner(QThread):
+    # Runs queued comparisons one after another on a worker pool that is started with the first one and kept until
+    # the runner is stopped, so only the first comparison pays for starting the workers and their imports
+    jobStarted = Signal(int)
+    jobProgress = Signal(int, int, int, float)
+    jobLog = Signal(int, str)
+    jobFinished = Signal(int, str, str)
+
+    def __init__(self, workers: int, parent=None):
+        super(ComparisonRunner, self).__init__(parent)
+        self.workers = workers
+        self.jobs = Queue()
+        self.job_ids = count(1)
+        self.cancelled = set()
+        self.current = None
+        self.comparer = None
+        self.pool = None
+        # Guards current, comparer, cancelled and stopping between the GUI thread and the runner thread
+        self.lock = Lock()
+        self.stopping = False
+
+    def submit(self, files: list[str], options: list[str]) -> int:
+        job_id = next(self.job_ids)
+        self.jobs.put((job_id, files, options))
+        return job_id
+
+    def cancel(self, job_id: int):
+        # A queued job is skipped, the running one stops after the page it is on
+        with self.lock:
+            if job_id == self.current and self.comparer is not None:
+                self.comparer.cancel()
+            else:
+                self.cancelled.add(job_id)
+
+    def stop(self):
+        # Cancels every queued job and the running one without waiting for it, finished is emitted once the
+        # running comparison has stopped and the pool is shut down
+        with self.lock:
+            self.stopping = True
+            while True:
+                try:
+                    job = self.jobs.get_nowait()
+                except Empty:
+                    break
+                if job is not None:
+                    self.cancelled.add(job[0])
+                    self.jobFinished.emit(job[0], "Cancelled", "")
+            self.jobs.put(None)
+            if self.comparer is not None:
+                self.comparer.cancel()
 
-        return args
+    def run(self):
+        from multiprocessing import get_context
+        from PyPDFCompare import ComparisonCancelled
+        try:
+            while (job := self.jobs.get()) is not None:
+                job_id, files, options = job
+                with self.lock:
+                    skipped = self.stopping or job_id in self.cancelled
+                if skipped:
+                    self.jobFinished.emit(job_id, "Cancelled", "")
+                    continue
+                if self.pool is None and self.workers > 1:
+                    self.jobLog.emit(job_id, f"Starting {self.workers} comparison workers...")
+                    self.pool = get_context("spawn").Pool(self.workers)
+                started = perf_counter()
+                comparer = Comparer(options=options, log=lambda message, job_id=job_id: self.jobLog.emit(job_id, message),
+                                    pages=lambda done, total, job_id=job_id: self.jobProgress.emit(job_id, done, total, done / (perf_counter() - started)),
+                                    pool=self.pool)
+                # A stop or cancel that came in while the pool was starting is seen here, later ones reach the comparer
+                with self.lock:
+                    skipped = self.stopping or job_id in self.cancelled
+                    if not skipped:
+                        self.current = job_id
+                        self.comparer = comparer
+                if skipped:
+                    self.jobFinished.emit(job_id, "Cancelled", "")
+                    continue
+                self.jobStarted.emit(job_id)
+                try:
+                    self.jobFinished.emit(job_id, "Done", comparer.compare(files))
+                except ComparisonCancelled:
+                    self.jobFinished.emit(job_id, "Cancelled", "")
+                except Exception as e:
+                    self.jobLog.emit(job_id, f"Comparison failed: {e}")
+                    self.jobFinished.emit(job_id, "Failed", str(e))
+                with self.lock:
+                    self.current = None
+                    self.comparer = None
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+                self.pool = None
+
+class QueueWindow(QMainWindow):
+    # Queued, running and finished comparisons with their progress and log
+    def __init__(self, runner: ComparisonRunner):
+        super().__init__()
+        self.setWindowTitle("PyPDFCompare")
+        self.resize(700, 500)
+        self.runner = runner
+        self.rows = {}
+
+        self.centralWidget = QWidget()
+        self.setCentralWidget(self.centralWidget)
+        self.layout = QVBoxLayout()
+
+        self.jobTable = QTableWidget(0, 4)
+        self.jobTable.setHorizontalHeaderLabels(["Files", "Status", "Progress", "Pages/s"])
+        self.jobTable.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.jobTable.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.jobTable.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.cancelButton = QPushButton("Cancel Selected")
+        self.cancelButton.clicked.connect(self.cancel_selected)
+        self.logArea = QTextBrowser()
+        self.logArea.setReadOnly(True)
+
+        self.layout.addWidget(self.jobTable)
+        self.layout.addWidget(self.cancelButton)
+        self.layout.addWidget(self.logArea)
+        self.centralWidget.setLayout(self.layout)
+
+        runner.jobStarted.connect(self.job_started)
+        runner.jobProgress.connect(self.job_progress)
+        runner.jobLog.connect(self.job_log)
+        runner.jobFinished.connect(self.job_finished)
+
+    def add_job(self, job_id: int, files: list[str]):
+        row = self.jobTable.rowCount()
+        self.rows[job_id] = row
+        self.jobTable.insertRow(row)
+        self.jobTable.setItem(row, 0, QTableWidgetItem(" vs ".join(path.basename(file) for file in files)))
+        self.jobTable.setItem(row, 1, QTableWidgetItem("Queued"))
+        progressBar = QProgressBar()
+        progressBar.setRange(0, 100)
+        progressBar.setValue(0)
+        self.jobTable.setCellWidget(row, 2, progressBar)
+        self.jobTable.setItem(row, 3, QTableWidgetItem(""))
+
+    def cancel_selected(self):
+        for job_id, row in self.rows.items():
+            if self.jobTable.item(row, 0).isSelected() and self.jobTable.item(row, 1).text() in ("Queued", "Running"):
+                self.jobTable.item(row, 1).setText("Cancelling")
+                self.runner.cancel(job_id)
+
+    @Slot(int)
+    def job_started(self, job_id):
+        self.jobTable.item(self.rows[job_id], 1).setText("Running")
+
+    @Slot(int, int, int, float)
+    def job_progress(self, job_id, done, total, rate):
+        row = self.rows[job_id]
+        self.jobTable.cellWidget(row, 2).setValue(int(100 * done / total))
+        self.jobTable.cellWidget(row, 2).setFormat(f"{done} of {total} pages")
+        self.jobTable.item(row, 3).setText(f"{rate:.2f}")
+
+    @Slot(int, str)
+    def job_log(self, job_id, message):
+        self.logArea.append(f"[{job_id}] {message}")
+
+    @Slot(int, str, str)
+    def job_finished(self, job_id, state, result):
+        row = self.rows[job_id]
+        self.jobTable.item(row, 1).setText(state)
+        if state == "Done":
+            self.jobTable.cellWidget(row, 2).setValue(100)
+            self.jobTable.item(row, 0).setToolTip(result)
+
+    def closeEvent(self, event):
+        # Closing the window keeps the queue running, it opens again with the next comparison
+        event.accept()
+
+class ProgressWindow(QMainWindow):
+    def __init__(self):
+        super().__init__()
+        self.setWindowTitle("PyPDFCompare")
+        self.resize(600, 500)
+        
+        self.centralWidget = QWidget()
+        self.setCentralWidget(self.centralWidget)
+        self.layout = QVBoxLayout()
+        
+        self.progressBar = QProgressBar()
+        self.progressBar.setFixedHeight(32)
+        self.progressBar.setTextVisible(True)
+        self.progressBar.setMaximum(100)
+        self.progressBar.setMinimum(0)
+        self.progressBar.setValue(0)
+        self.logArea = QTextBrowser()
+        self.logArea.setReadOnly(True)
+        
+        self.layout.addWidget(self.progressBar)
+        self.layout.addWidget(self.logArea)
+        
+        self.centralWidget.setLayout(self.layout)
+        
+        self.setStyleSheet("""
+            QProgressBar {
+                border: 1px solid #004a88;
+                border-radius: 5px;
+                text-align: center;
+                color: #c8c8c8;
+                background-color: #202020;
+            }
+            QProgressBar::chunk {
+                background-color: #0075d5;
+                width: 1px;
+                border: 1px solid transparent;
+                border-radius: 5px;
+            }
+        """)
+        
+    @Slot(int)
+    def update_progress(self, progress):
+        self.progressBar.setValue(progress)
+        
+    @Slot(str)
+    def update_log(self, message):
+        self.logArea.append(message)
+    
+    @Slot(int)
+    def operation_complete(self, time):
+        sleep(time)
+        self.close()
+
+class ComparisonThread(QThread):
+    progressUpdated = Signal(int)
+    compareComplete = Signal(int)
+    logMessage = Signal(str)
+    
+    def __init__(self, files: list[str], progress_window: ProgressWindow, options: list[str] = None, parent=None):
+        super(ComparisonThread, self).__init__(parent)
+        self.files = files
+        self.comparer = Comparer(options=options, log=self.logMessage.emit, progress=self.progressUpdated.emit)
+        
+        self.progressUpdated.connect(progress_window.update_progress)
+        self.logMessage.connect(progress_window.update_log)
+        self.compareComplete.connect(progress_window.operation_complete)
+    
+    def run(self):
+        self.comparer.run(self.files)
+        self.compareComplete.emit(5)
 
 
 def save_settings(settings: dict) -> None:
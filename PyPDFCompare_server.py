@@ -0,0 +1,517 @@
+import http.client
+import json
+import socket
+import socketserver
+import sys
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from multiprocessing import get_context
+from os import getpid, path, remove
+from queue import Empty
+from time import time
+
+DEFAULT_PORT = 8765
+# Imported by every worker when it starts, so the first job on it doesn't pay for them
+WARM_MODULES = ["fitz", "numpy", "cv2", "PIL.Image", "PyPDFCompare"]
+# Finished jobs kept (with their events) for status requests, older ones are dropped
+DEFAULT_KEEP = 1000
+# Seconds between checks for workers that died during a job
+WORKER_CHECK_INTERVAL = 1.0
+
+# Queue the worker reports log messages, progress and results of its jobs on, set by _warm_worker
+_events = None
+
+def _warm_worker(events):
+    global _events
+    from importlib import import_module
+    _events = events
+    for module in WARM_MODULES:
+        # A module that can't be imported fails the jobs that need it instead of every worker as it starts
+        try:
+            import_module(module)
+        except ImportError:
+            pass
+    events.put((None, "ready", None))
+
+def _run_job(job_id: int, files: list[str], options: list[str]):
+    # Results go through the event queue after the job's log messages, so they arrive in order. The process id is
+    # sent first, so the server can fail the job if this process dies anywhere in it, imports included
+    _events.put((job_id, "worker", getpid()))
+    import fitz
+    from PyPDFCompare import Comparer
+    comparer = Comparer(options=options, log=lambda message: _events.put((job_id, "log", message)),
+                        progress=lambda value: _events.put((job_id, "progress", value)))
+    try:
+        output_path = comparer.compare(files)
+        _events.put((job_id, "done", {"output": output_path, "statistics": comparer.summary()}))
+    except Exception as e:
+        _events.put((job_id, "failed", f"{type(e).__name__}: {e}"))
+    finally:
+        fitz.TOOLS.store_shrink(100)
+
+class Job:
+    # A comparison submitted to the server and every event it has reported so far
+    def __init__(self, job_id: int, files: list[str], options: list[str], client: str):
+        self.id = job_id
+        self.files = files
+        self.options = options
+        self.client = client
+        self.state = "queued"
+        self.progress = 0
+        self.output = None
+        self.statistics = None
+        self.error = None
+        self.submitted = time()
+        self.started = None
+        self.finished = None
+        self.events = []
+        # Process id of the worker running the job, once it has reported it
+        self.worker = None
+
+    @property
+    def done(self) -> bool:
+        return self.state in ("done", "failed", "cancelled")
+
+    def status(self) -> dict:
+        return {"id": self.id, "client": self.client, "files": self.files, "options": self.options, "state": self.state,
+                "progress": self.progress, "output": self.output, "statistics": self.statistics, "error": self.error,
+                "submitted": self.submitted, "started": self.started, "finished": self.finished, "worker": self.worker}
+
+class JobQueue:
+    # Runs comparison jobs on a pool of warm worker processes, one job per worker at a time. Queued jobs are started
+    # in turns per client, so a client that submits many jobs doesn't hold up the others. Only the last keep finished
+    # jobs are kept
+    def __init__(self, workers: int, keep: int = DEFAULT_KEEP):
+        context = get_context("spawn")
+        self.workers = workers
+        self.keep = keep
+        self.events = context.Queue()
+        self.pool = context.Pool(workers, initializer=_warm_worker, initargs=(self.events,))
+        self.changed = threading.Condition()
+        self.jobs = {}
+        self.queues = {}
+        self.turns = deque()
+        self.active = {}
+        self.finished = deque()
+        self.last_check = time()
+        self.running = 0
+        self.warm = 0
+        self.ids = count(1)
+        self.listener = threading.Thread(target=self.listen, daemon=True)
+        self.listener.start()
+
+    def submit(self, files: list[str], options: list[str], client: str) -> Job:
+        with self.changed:
+            job = Job(next(self.ids), files, options, client)
+            self.jobs[job.id] = job
+            if not self.queues.get(client):
+                self.queues[client] = deque()
+                self.turns.append(client)
+            self.queues[client].append(job)
+            self.record(job, {"type": "queued", "position": sum(len(queue) for queue in self.queues.values())})
+            self.dispatch()
+        return job
+
+    def cancel(self, job: Job) -> bool:
+        # Only queued jobs can be cancelled, a running job has its worker to itself until it finishes
+        with self.changed:
+            if job.state != "queued":
+                return False
+            self.queues[job.client].remove(job)
+            if not self.queues[job.client]:
+                self.turns.remove(job.client)
+            self.finish(job, "cancelled", {"type": "cancelled"})
+        return True
+
+    def dispatch(self):
+        # Called with self.changed held
+        while self.running < self.workers and self.turns:
+            client = self.turns.popleft()
+            job = self.queues[client].popleft()
+            if self.queues[client]:
+                self.turns.append(client)
+            job.state = "running"
+            job.started = time()
+            self.active[job.id] = job
+            self.running += 1
+            self.record(job, {"type": "started"})
+            # Jobs report through the event queue, the callback only catches jobs that could not be run at all
+            self.pool.apply_async(_run_job, (job.id, job.files, job.options + ["-w:1"]),
+                                  error_callback=lambda error, job_id=job.id: self.events.put((job_id, "failed", f"{type(error).__name__}: {error}")))
+
+    def finish(self, job: Job, state: str, event: dict):
+        # Called with self.changed held. Frees the worker of a running job and drops the oldest finished jobs
+        job.state = state
+        job.finished = time()
+        self.record(job, event)
+        if self.active.pop(job.id, None) is not None:
+            self.running -= 1
+            self.dispatch()
+        self.finished.append(job.id)
+        while len(self.finished) > self.keep:
+            self.jobs.pop(self.finished.popleft(), None)
+
+    def check_workers(self):
+        # Called with self.changed held. The pool replaces a worker that died (a crash, or killed for running out of
+        # memory) without reporting anything for its job, so a running job whose worker is gone is failed here
+        self.last_check = time()
+        # Pool has no public list of its worker processes, _pool is the list it keeps them in (and replaces dead
+        # ones in), the same from Python 3.8 on
+        alive = {process.pid for process in self.pool._pool if process.is_alive()}
+        for job in list(self.active.values()):
+            if job.worker is not None and job.worker not in alive:
+                job.error = f"Worker process {job.worker} exited during the job"
+                self.finish(job, "failed", {"type": "failed", "error": job.error})
+
+    def record(self, job: Job, event: dict):
+        # Called with self.changed held
+        job.events.append(event)
+        self.changed.notify_all()
+
+    def listen(self):
+        while True:
+            try:
+                job_id, kind, value = self.events.get(timeout=WORKER_CHECK_INTERVAL)
+            except Empty:
+                job_id, kind, value = None, None, None
+            with self.changed:
+                if kind == "stop":
+                    return
+                if time() - self.last_check >= WORKER_CHECK_INTERVAL:
+                    self.check_workers()
+                if kind is None:
+                    continue
+                if kind == "ready":
+                    self.warm += 1
+                    self.changed.notify_all()
+                    continue
+                job = self.jobs.get(job_id)
+                if job is None or job.done:
+                    continue
+                if kind == "worker":
+                    job.worker = value
+                elif kind == "log":
+                    self.record(job, {"type": "log", "message": value})
+                elif kind == "progress":
+                    job.progress = value
+                    self.record(job, {"type": "progress", "value": value})
+                elif kind == "done":
+                    job.output, job.statistics = value["output"], value["statistics"]
+                    self.finish(job, "done", {"type": "done", "output": job.output, "statistics": job.statistics})
+                else:
+                    job.error = value
+                    self.finish(job, "failed", {"type": "failed", "error": value})
+
+    def events_since(self, job: Job, index: int, timeout: float) -> list[dict]:
+        # Events of job after the first index, waiting up to timeout for one if there are none yet
+        with self.changed:
+            self.changed.wait_for(lambda: len(job.events) > index or job.done, timeout)
+            return job.events[index:]
+
+    def health(self) -> dict:
+        with self.changed:
+            queued = sum(len(queue) for queue in self.queues.values())
+            return {"workers": self.workers, "warm": self.warm, "running": self.running, "queued": queued}
+
+    def close(self):
+        self.events.put((None, "stop", None))
+        self.pool.terminate()
+        self.pool.join()
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    # GET /health, GET /jobs, POST /jobs, GET /jobs/<id>, GET /jobs/<id>/events and DELETE /jobs/<id>, all JSON
+    server_version = "PyPDFCompare"
+
+    def send_json(self, status: int, body: dict | list):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def find_job(self) -> tuple[Job | None, str]:
+        parts = self.path.strip("/").split("/")
+        job = self.server.queue.jobs.get(int(parts[1])) if len(parts) > 1 and parts[1].isdigit() else None
+        if job is None:
+            self.send_json(404, {"error": f"No job {self.path}"})
+        return job, parts[2] if len(parts) > 2 else ""
+
+    def do_GET(self):
+        queue = self.server.queue
+        if self.path == "/health":
+            self.send_json(200, queue.health())
+        elif self.path == "/jobs":
+            with queue.changed:
+                self.send_json(200, [job.status() for job in queue.jobs.values()])
+        elif self.path.startswith("/jobs/"):
+            job, resource = self.find_job()
+            if job is None:
+                return
+            if resource == "events":
+                self.stream_events(job)
+            else:
+                with queue.changed:
+                    self.send_json(200, job.status())
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/jobs":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            files, options, client = job_request(request)
+        except ValueError as e:
+            self.send_json(400, {"error": str(e)})
+            return
+        job = self.server.queue.submit(files, options, client)
+        with self.server.queue.changed:
+            self.send_json(202, job.status())
+
+    def do_DELETE(self):
+        job, _ = self.find_job()
+        if job is None:
+            return
+        if self.server.queue.cancel(job):
+            self.send_json(200, job.status())
+        else:
+            self.send_json(409, {"error": f"Job {job.id} is {job.state} and can't be cancelled"})
+
+    def stream_events(self, job: Job):
+        # Newline delimited JSON, from the first event until the job finishes. The connection is closed at the end
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        index = 0
+        while True:
+            events = self.server.queue.events_since(job, index, 30.0)
+            for event in events:
+                self.wfile.write(json.dumps(event).encode() + b"\n")
+            self.wfile.flush()
+            index += len(events)
+            if job.done and index == len(job.events):
+                return
+
+    def log_message(self, format, *args):
+        # Requests aren't logged, Unix socket clients don't have an address to log anyway
+        pass
+
+class _UnixHTTPServer(ThreadingHTTPServer):
+    address_family = getattr(socket, "AF_UNIX", None)
+
+    def server_bind(self):
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float | None = None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def job_request(request: dict) -> tuple[list[str], list[str], str]:
+    """
+    Checks a submitted job and returns its files, comparison options and client name. Raises ValueError if the files
+    aren't two existing PDFs or an option isn't in the -option:value form.
+    """
+    files = request.get("files")
+    options = request.get("options", [])
+    client = request.get("client", "default")
+    if not isinstance(files, list) or len(files) != 2 or not all(isinstance(file, str) for file in files):
+        raise ValueError("files must be a list of the new and old file paths")
+    for file in files:
+        if not path.isfile(file) or not file.lower().endswith(".pdf"):
+            raise ValueError(f"Not a PDF file: {file}")
+    if not isinstance(options, list) or not all(isinstance(option, str) and option.startswith("-") and ":" in option for option in options):
+        raise ValueError("options must be a list of -option:value strings")
+    if not isinstance(client, str) or not client:
+        raise ValueError("client must be a name")
+    return [file.replace("\\", "/") for file in files], options, client
+
+def serve(workers: int, port: int = DEFAULT_PORT, socket_path: str | None = None, log=print, keep: int = DEFAULT_KEEP):
+    """
+    Runs the comparison server on localhost:port, or on a Unix socket at socket_path, until it is interrupted. The
+    last keep finished jobs can still be looked up.
+    """
+    import signal
+    if socket_path is not None:
+        if _UnixHTTPServer.address_family is None:
+            raise OSError("Unix sockets aren't supported on this platform")
+        if path.exists(socket_path):
+            remove(socket_path)
+        server = _UnixHTTPServer(socket_path, _RequestHandler)
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", port), _RequestHandler)
+    server.daemon_threads = True
+    # Stopped like an interrupt, so the workers are shut down either way
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.queue = JobQueue(workers, keep)
+    log(f"Comparison server with {workers} workers listening on {socket_path or f'http://127.0.0.1:{port}'}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.queue.close()
+        if socket_path is not None and path.exists(socket_path):
+            remove(socket_path)
+
+def connection(address: int | str, timeout: float | None = None) -> http.client.HTTPConnection:
+    """
+    Connection to a server on localhost at address, a port number or a Unix socket path.
+    """
+    if isinstance(address, int):
+        return http.client.HTTPConnection("127.0.0.1", address, timeout=timeout)
+    return _UnixHTTPConnection(address, timeout=timeout)
+
+def request(address: int | str, method: str, url: str, body: dict | None = None) -> tuple[int, dict | list]:
+    """
+    Sends a request to the server at address and returns the status and the decoded JSON response.
+    """
+    client = connection(address, timeout=30.0)
+    try:
+        client.request(method, url, body=json.dumps(body) if body is not None else None, headers={"Content-Type": "application/json"})
+        response = client.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        client.close()
+
+def job_events(address: int | str, job_id: int):
+    """
+    Yields the events of a job from the first one until it finishes.
+    """
+    client = connection(address)
+    try:
+        client.request("GET", f"/jobs/{job_id}/events")
+        response = client.getresponse()
+        if response.status != 200:
+            raise RuntimeError(json.loads(response.read())["error"])
+        for line in response:
+            yield json.loads(line)
+    finally:
+        client.close()
+
+def submit(address: int | str, files: list[str], options: list[str], client: str = "default", log=print) -> dict:
+    """
+    Submits a comparison to the server at address, passes its log messages and progress to log as they come and
+    returns the job's final status.
+    """
+    status, job = request(address, "POST", "/jobs", {"files": [path.abspath(file) for file in files], "options": options, "client": client})
+    if status != 202:
+        raise RuntimeError(job["error"])
+    for event in job_events(address, job["id"]):
+        if event["type"] == "log":
+            log(event["message"])
+        elif event["type"] == "progress":
+            log(f"Progress: {event['value']}%")
+        elif event["type"] == "queued":
+            log(f"Job {job['id']} queued at position {event['position']}")
+    status, final = request(address, "GET", f"/jobs/{job['id']}")
+    if status == 200:
+        return final
+    # The server already dropped the job (other clients finished more jobs than it keeps), its last event has the result
+    job.update(state=event["type"], output=event.get("output"), statistics=event.get("statistics"), error=event.get("error"))
+    return job
+
+def main():
+    """
+    python PyPDFCompare_server.py [options] serve
+    python PyPDFCompare_server.py [options] submit [comparison options] FilePath1 FilePath2
+    python PyPDFCompare_server.py [options] status [job]
+    python PyPDFCompare_server.py [options] cancel job
+
+    serve
+        Runs a comparison server until it is interrupted. It keeps a pool of worker processes with PyMuPDF, NumPy,
+        OpenCV and Pillow already imported, and runs each submitted comparison on one of them with its own options.
+        Jobs wait in a queue that starts them in turns per client.
+
+    submit [comparison options] FilePath1 FilePath2
+        Submits a comparison with the same options as PyPDFCompare.py (except -w, each job gets one worker) and prints
+        its log and progress until it finishes. Exits with 1 if it fails.
+
+    status [job]
+        Prints the status of a job, or of every job and the server.
+
+    cancel job
+        Removes a job from the queue, a job that has started can't be cancelled.
+
+    options:
+    -p:port, --port:port  Ex: -p:8765
+        Port on localhost the server listens on.
+        Default: 8765
+
+    -u:path, --socket:path  Ex: -u:/tmp/pypdfcompare.sock
+        Listens on (or connects to) a Unix socket at path instead of a port.
+        Default: None (Port)
+
+    -w:count, --workers:count  Ex: -w:4
+        Number of worker processes, which is how many comparisons run at once.
+        Default: 2
+
+    -cl:name, --client:name  Ex: -cl:document-control
+        Name jobs are submitted under. Clients take turns when jobs are queued.
+        Default: default
+
+    -k:count, --keep:count  Ex: -k:100
+        Number of finished jobs the server keeps with their events for status requests, older ones are dropped.
+        Default: 1000
+    """
+    args = sys.argv[1:]
+    port = DEFAULT_PORT
+    socket_path = None
+    workers = 2
+    client = "default"
+    keep = DEFAULT_KEEP
+    while args and args[0].startswith("-"):
+        option, _, value = args.pop(0).partition(":")
+        if option in ("-p", "--port") and value.isdigit():
+            port = int(value)
+        elif option in ("-u", "--socket") and value:
+            socket_path = value
+        elif option in ("-w", "--workers") and value.isdigit() and int(value) > 0:
+            workers = int(value)
+        elif option in ("-cl", "--client") and value:
+            client = value
+        elif option in ("-k", "--keep") and value.isdigit() and int(value) > 0:
+            keep = int(value)
+    command = args.pop(0) if args else None
+    address = socket_path if socket_path is not None else port
+
+    if command == "serve":
+        serve(workers, port, socket_path, keep=keep)
+        return
+    if command == "submit" and len(args) >= 2:
+        status = submit(address, args[-2:], args[:-2], client)
+        if status["state"] == "done":
+            print(f"Comparison file created: {status['output']}")
+            print(json.dumps(status["statistics"]))
+            return
+        print("Comparison cancelled" if status["state"] == "cancelled" else f"Comparison failed: {status['error']}")
+        sys.exit(1)
+    if command == "status":
+        status, body = request(address, "GET", f"/jobs/{args[0]}" if args else "/jobs")
+        if not args:
+            body = {"server": request(address, "GET", "/health")[1], "jobs": body}
+        print(json.dumps(body, indent=4))
+        sys.exit(0 if status == 200 else 1)
+    if command == "cancel" and args:
+        status, body = request(address, "DELETE", f"/jobs/{args[0]}")
+        print(json.dumps(body, indent=4))
+        sys.exit(0 if status == 200 else 1)
+    print(main.__doc__)
+    sys.exit(2)
+
+if __name__ == "__main__":
+    main()